@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TOOLS_DIR = os.path.join(PROJECT_ROOT, 'tools')
+
+sys.path.insert(0, TOOLS_DIR)
+import gfxcache
+
+
+def write_outputs(base, payload):
+    for ext in ('tiles', 'tilemap'):
+        with open('%s.%s' % (base, ext), 'wb') as outFile:
+            outFile.write(payload + ext.encode())
+
+
+class TestGfxCache(unittest.TestCase):
+    def test_store_and_fetch(self):
+        """A stored entry comes back with identical files and meta data, unknown keys miss."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cacheDir = os.path.join(tmpdir, 'cache')
+            source = os.path.join(tmpdir, 'source')
+            target = os.path.join(tmpdir, 'target')
+            write_outputs(source, b'\x01' * 64)
+            key = gfxcache.getKey('options', b'pixels')
+            self.assertIsNone(gfxcache.fetch(cacheDir, key, target, ('tiles', 'tilemap')))
+            gfxcache.store(cacheDir, key, source, ('tiles', 'tilemap'), {'actualTiles': 3})
+            self.assertEqual(gfxcache.fetch(cacheDir, key, target, ('tiles', 'tilemap')), {'actualTiles': 3})
+            for ext in ('tiles', 'tilemap'):
+                with open('%s.%s' % (source, ext), 'rb') as expected, open('%s.%s' % (target, ext), 'rb') as actual:
+                    self.assertEqual(actual.read(), expected.read())
+            # an entry missing one of the requested outputs is a miss and leaves nothing behind
+            self.assertIsNone(gfxcache.fetch(cacheDir, key, os.path.join(tmpdir, 'other'), ('tiles', 'palette')))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'other.tiles')))
+
+    def test_evict_least_recently_used(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cacheDir = os.path.join(tmpdir, 'cache')
+            source = os.path.join(tmpdir, 'source')
+            write_outputs(source, b'\x02' * 1000)
+            keys = [gfxcache.getKey(str(index)) for index in range(3)]
+            for age, key in zip((30, 20, 10), keys):
+                gfxcache.store(cacheDir, key, source, ('tiles', 'tilemap'), {})
+                past = time.time() - age
+                os.utime(os.path.join(cacheDir, key[:2], key), (past, past))
+            # the oldest entry was used last
+            gfxcache.fetch(cacheDir, keys[0], os.path.join(tmpdir, 'target'), ('tiles',))
+            self.assertEqual(gfxcache.evict(cacheDir, 4500), 1)
+            self.assertIsNone(gfxcache.fetch(cacheDir, keys[1], os.path.join(tmpdir, 'target'), ('tiles',)))
+            self.assertIsNotNone(gfxcache.fetch(cacheDir, keys[0], os.path.join(tmpdir, 'target'), ('tiles',)))
+            self.assertIsNotNone(gfxcache.fetch(cacheDir, keys[2], os.path.join(tmpdir, 'target'), ('tiles',)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,15 @@
+import json
 import os
 import sys
 import subprocess
 import shutil
 import unittest
+import unittest.mock
+import tempfile
+import time
 
+import numpy as np
+from PIL import Image
 # Add tools directory to path to import gracon if needed, 
 # but we will run it as a subprocess to test the CLI interface as intended.
 
@@ -15,6 +21,55 @@ TEST_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'output')
 # Path to the local fixture
 TEST_IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'dirk_standin.png')
 
+sys.path.insert(0, TOOLS_DIR)
+import gracon
+import vptree
+
+TRANSPARENT_RGB = (0xf8, 0x00, 0xf8)
+
+
+def create_mirror_test_image(path):
+    """16x16 image: asymmetric tile, its x-mirror, a transparent tile and a plain copy."""
+    image = Image.new('RGB', (16, 16), TRANSPARENT_RGB)
+    pattern = [(x, y) for y in range(8) for x in range(8) if x < y]
+    for x, y in pattern:
+        image.putpixel((x, y), (0xf8, 0xf8, 0x00))
+        image.putpixel((15 - x, y), (0xf8, 0xf8, 0x00))
+        image.putpixel((8 + x, 8 + y), (0xf8, 0xf8, 0x00))
+    image.putpixel((0, 7), (0x00, 0x80, 0xf8))
+    image.putpixel((15, 7), (0x00, 0x80, 0xf8))
+    image.putpixel((8, 15), (0x00, 0x80, 0xf8))
+    image.save(path)
+
+
+def load_test_tiles(tmpdir, *args):
+    path = os.path.join(tmpdir, 'mirror.png')
+    create_mirror_test_image(path)
+    options = gracon.parseOptions(['gracon.py', '-infile', path] + list(args))
+    image = gracon.getInputImage(options, path)
+    tiles = gracon.parseTiles(image, options)
+    palettes = gracon.parseGlobalPalettes(tiles, options)
+    return options, tiles, palettes
+
+
+def sprite_positions_reference(opaque, tileSizeX, tileSizeY):
+    """Sprite tile placement as parseSpriteTiles originally scanned it, one pixel at a time."""
+    height, width = opaque.shape
+    rows = [y for y in range(height) if opaque[y].any()]
+    positions = []
+    y = rows[0] if rows else 0
+    while y < height:
+        x = 0
+        while x < width:
+            if any(opaque[row, x] for row in range(y, min(y + tileSizeY, height))):
+                positions.append((x, y))
+                x += tileSizeX
+            else:
+                x += 1
+        y += tileSizeY
+    return positions
+
+
 class TestGracon(unittest.TestCase):
     def setUp(self):
         if not os.path.exists(TEST_OUTPUT_DIR):
@@ -62,5 +117,387 @@ class TestGracon(unittest.TestCase):
             else:
                 print(f"Verified {file_path} exists.")
 
+class TestGraconTileSet(unittest.TestCase):
+    def test_parse_bg_tiles_layout(self):
+        """Tiles are stored as one (tiles, 8, 8) array in row-major tile order."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            options, tiles, palettes = load_test_tiles(tmpdir)
+        self.assertEqual(tiles.pixel.shape, (4, 8, 8))
+        self.assertEqual(tiles.x.tolist(), [0, 8, 0, 8])
+        self.assertEqual(tiles.y.tolist(), [0, 0, 8, 8])
+        self.assertTrue((tiles.pixel[2] == options.get('transcol')).all())
+        self.assertTrue((tiles.pixel[1] == tiles.pixel[0][:, ::-1]).all())
+
+    def test_input_image_pixels_and_padding(self):
+        """Array conversion equals the per pixel BGR555 conversion, padding uses the transparent color."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'noise.png')
+            source = Image.fromarray(np.random.default_rng(13).integers(0, 256, size=(9, 13, 4), dtype=np.uint8), 'RGBA')
+            source.save(path)
+            options = gracon.parseOptions(['gracon.py', '-infile', path, '-prereduce', 'off', '-transcol', '0x1234'])
+            image = gracon.getInputImage(options, path)
+        source = source.convert('RGB')
+        self.assertEqual((image['resolutionX'], image['resolutionY']), (16, 16))
+        self.assertEqual((options.get('resolutionx'), options.get('resolutiony')), (16, 16))
+        self.assertEqual(image['pixels'].dtype, np.uint16)
+        expected = [[gracon.convertColorRGBToSnes(source.getpixel((x, y))) for x in range(13)] for y in range(9)]
+        self.assertEqual(image['pixels'][:9, :13].tolist(), expected)
+        padding = np.ones((16, 16), dtype=bool)
+        padding[:9, :13] = False
+        self.assertTrue((image['pixels'][padding] == 0x1234).all())
+
+    def test_sprite_tile_positions_match_pixel_scan(self):
+        """Mask based placement equals the original column by column scan."""
+        rng = np.random.default_rng(14)
+        for shape, density in (((40, 48), 0.02), ((24, 17), 0.2), ((16, 16), 0.0)):
+            opaque = rng.random(shape) < density
+            self.assertEqual(gracon.getSpriteTilePositions(opaque, 8, 8), sprite_positions_reference(opaque, 8, 8))
+
+    def test_optimize_resolves_mirrored_duplicates(self):
+        """Mirrored and plain duplicates reference the first tile with the right flip bits."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            options, tiles, palettes = load_test_tiles(tmpdir, '-tilethreshold', '1')
+        optimized = gracon.optimizeTiles(gracon.palettizeTiles(tiles, palettes), options)
+        self.assertEqual(gracon.countUniqueTiles(optimized), 2)
+
+        gracon.augmentOutIds(optimized)
+        gracon.augmentOutIds(palettes)
+        configs = [gracon.fetchTileConfig(tileId, optimized, palettes) for tileId in range(len(optimized))]
+        self.assertEqual([config['tileId'] for config in configs], [0, 0, 2, 0])
+        self.assertEqual([config['xMirror'] for config in configs], [False, True, False, False])
+        self.assertEqual([config['yMirror'] for config in configs], [False, False, False, False])
+
+    def test_reference_chains_resolve_without_recursion(self):
+        """Chains far longer than the recursion limit resolve to their root with the accumulated flip bits."""
+        count = sys.getrecursionlimit() * 3
+        rng = np.random.default_rng(18)
+        tiles = gracon.TileSet(np.zeros((count, 8, 8)), np.zeros(count), np.zeros(count))
+        # every tile references a random earlier tile or nothing
+        tiles.refId = np.where(rng.random(count) < 0.9, (rng.random(count) * np.arange(count)).astype(np.int32), gracon.NO_REF)
+        tiles.refId[0] = gracon.NO_REF
+        tiles.refId[1:count // 2] = np.arange(count // 2 - 1)
+        tiles.xMirror = rng.random(count) < 0.5
+        tiles.yMirror = rng.random(count) < 0.5
+        actualIds, xMirror, yMirror = gracon.resolveTileRefs(tiles)
+        for tileId in (0, 1, count // 2 - 1, count // 2, count - 1):
+            self.assertEqual((int(actualIds[tileId]), bool(xMirror[tileId]), bool(yMirror[tileId])),
+                             gracon.fetchActualTile(tiles, tileId, False, False))
+        self.assertTrue((tiles.refId[actualIds] == gracon.NO_REF).all())
+
+    def test_exact_duplicates_resolve_to_last_copy(self):
+        """Exact and mirrored copies get a zero-error candidate pointing at the last earlier copy."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            options, tiles, palettes = load_test_tiles(tmpdir)
+        candidates = gracon.findDuplicateCandidates(gracon.palettizeTiles(tiles, palettes), options)
+        self.assertEqual(candidates['refId'][[0, 1, 3]].tolist(), [gracon.NO_REF, 0, 1])
+        self.assertEqual(candidates['error'][[1, 3]].tolist(), [0.0, 0.0])
+        self.assertEqual(candidates['xMirror'][[1, 3]].tolist(), [True, True])
+        self.assertGreater(candidates['error'][2], 0.0)
+
+    def test_indexed_search_never_beats_exact(self):
+        """Indexed search only re-ranks a subset, so every candidate error is at least the exact one."""
+        results = {}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dirk.png')
+            Image.open(TEST_IMAGE_PATH).convert('RGB').resize((128, 112)).save(path)
+            for tileSearch in ('exact', 'indexed'):
+                options = gracon.parseOptions(['gracon.py', '-infile', path, '-tilesearch', tileSearch,
+                                               '-resolutionx', '128', '-resolutiony', '112'])
+                tiles = gracon.parseTiles(gracon.getInputImage(options, path), options)
+                tiles = gracon.palettizeTiles(tiles, gracon.parseGlobalPalettes(tiles, options))
+                results[tileSearch] = gracon.findDuplicateCandidates(tiles, options)
+        exact, indexed = results['exact'], results['indexed']
+        self.assertTrue((indexed['error'] >= exact['error']).all())
+        self.assertTrue((indexed['refId'][exact['error'] == 0] == exact['refId'][exact['error'] == 0]).all())
+        self.assertTrue((indexed['refId'] < np.arange(len(indexed['refId']))).all())
+
+    def test_tile_palette_solver_lowers_error(self):
+        """Palettes built from tile color usage never fit the tiles worse than the hue split."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dirk.png')
+            Image.open(TEST_IMAGE_PATH).convert('RGB').resize((64, 56)).save(path)
+            errors = {}
+            for solver, iterations in (('hue', '10'), ('tiles', '0'), ('tiles', '10')):
+                options = gracon.parseOptions(['gracon.py', '-infile', path, '-palettes', '4', '-bpp', '2',
+                                               '-palettesolver', solver, '-paletteiterations', iterations,
+                                               '-resolutionx', '64', '-resolutiony', '56'])
+                tiles = gracon.parseTiles(gracon.getInputImage(options, path), options)
+                palettes = gracon.parseGlobalPalettes(tiles, options)
+                self.assertLessEqual(len(palettes), 4)
+                self.assertTrue(all(len(palette['color']) == 4 for palette in palettes))
+                colors, colorIndex = np.unique(tiles.pixel.reshape(len(tiles), -1), return_inverse=True)
+                tileErrors = gracon.getTilePaletteErrors(colors, colorIndex.reshape(len(tiles), -1), palettes)
+                errors[solver, iterations] = tileErrors.min(axis=0).sum()
+        self.assertEqual(errors['tiles', '0'], errors['hue', '10'])
+        self.assertLess(errors['tiles', '10'], errors['hue', '10'])
+
+    def test_max_tiles_threshold_matches_retry_steps(self):
+        """The cached candidate errors pick the same threshold the +3 retry loop would reach."""
+        candidates = {'error': np.array([gracon.INFINITY, 0.0, 4.0, 9.5, 20.0])}
+        self.assertEqual(gracon.getMaxTilesThreshold(candidates, 1, 5), 1)
+        self.assertEqual(gracon.getMaxTilesThreshold(candidates, 1, 3), 7)
+        self.assertEqual(gracon.getMaxTilesThreshold(candidates, 1, 2), 10)
+        self.assertEqual(gracon.getMaxTilesThreshold(candidates, 12, 1), 21)
+        self.assertIsNone(gracon.getMaxTilesThreshold(candidates, 1, 0))
+
+def planar_reference(pixels, bpp):
+    """Bit-by-bit planar encoding: one MSB-first stream per bitplane, plane pairs interleaved per byte."""
+    stream = []
+    for tile in pixels:
+        planes = []
+        for plane in range(bpp):
+            bits = [(int(pixel) >> plane) & 1 for pixel in tile.ravel()]
+            planes.append([int(''.join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits) - 7, 8)])
+        for plane in range(0, bpp, 2):
+            for low, high in zip(planes[plane], planes[plane + 1]):
+                stream.extend((low, high))
+    return bytes(stream)
+
+
+class TestGraconBitplanes(unittest.TestCase):
+    def make_tiles(self, shape, maxValue):
+        tiles = gracon.TileSet.__new__(gracon.TileSet)
+        rng = np.random.default_rng(7)
+        tiles.pixel = rng.integers(0, 0x8000, size=shape).astype(np.uint16)
+        tiles.indexedPixel = rng.integers(0, maxValue, size=shape).astype(np.uint8)
+        tiles.refId = np.full(shape[0], gracon.NO_REF)
+        tiles.refId[1] = 0
+        tiles.objId = np.arange(shape[0], dtype=np.int32)
+        return tiles
+
+    def test_planar_encoding_matches_bitwise_reference(self):
+        for bpp, shape in ((2, (5, 8, 8)), (4, (5, 8, 8)), (8, (3, 8, 8)), (4, (3, 16, 16))):
+            tiles = self.make_tiles(shape, 2 ** bpp)
+            options = gracon.parseOptions(['gracon.py', '-bpp', str(bpp)])
+            expected = planar_reference(tiles.indexedPixel[tiles.refId == gracon.NO_REF], bpp)
+            self.assertEqual(gracon.getTileWriteStream(tiles, options), expected)
+
+    def test_directcolor_encoding(self):
+        """Direct color tiles store BBGGGRRR built from the top bits of each channel."""
+        tiles = self.make_tiles((3, 8, 8), 256)
+        options = gracon.parseOptions(['gracon.py', '-bpp', '8', '-directcolor', 'on'])
+        pixels = tiles.pixel[tiles.refId == gracon.NO_REF].astype(int)
+        direct = ((pixels & 0x6000) >> 7) | ((pixels & 0x380) >> 4) | ((pixels & 0x1c) >> 2)
+        self.assertEqual(gracon.getTileWriteStream(tiles, options), planar_reference(direct, 8))
+
+
+def decode_planar_tiles(stream, bpp):
+    """Palette indices of every 8x8 tile in a planar tile stream."""
+    data = np.frombuffer(stream, dtype=np.uint8).reshape(-1, bpp // 2, 8, 2)
+    bits = np.unpackbits(data, axis=2).reshape(-1, bpp // 2, 8, 8, 2)
+    return sum(bits[:, plane // 2, :, :, plane % 2].astype(np.int32) << plane for plane in range(bpp))
+
+
+class TestGraconSpriteSizes(unittest.TestCase):
+    def test_packing_covers_mask_with_fewer_objs(self):
+        """Packed OBJs cover every opaque pixel and never outnumber the fixed tile scan."""
+        rng = np.random.default_rng(15)
+        for shape, density in (((40, 48), 0.02), ((46, 40), 0.3), ((64, 64), 0.005)):
+            opaque = rng.random(shape) < density
+            for pair, (small, large) in gracon.SPRITE_SIZE_PAIRS.items():
+                objs = gracon.getPackedSpriteObjs(opaque, small, large)
+                covered = np.zeros((shape[0] + large, shape[1] + large), dtype=bool)
+                for x, y, size in objs:
+                    self.assertIn(size, (small, large))
+                    covered[y:y + size, x:x + size] = True
+                self.assertTrue(covered[:shape[0], :shape[1]][opaque].all(), pair)
+                self.assertLessEqual(len(objs), len(gracon.getSpriteTilePositions(opaque, small, small)), pair)
+
+    def test_packed_outputs_decode_to_sample(self):
+        """Tilemap entries, OBJ sizes and the OBJ name grid reproduce the verification image."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sprite.png')
+            image = Image.open(TEST_IMAGE_PATH).convert('RGB').resize((48, 40))
+            mask = Image.new('L', (48, 40), 0)
+            mask.paste(255, (5, 3, 37, 29))
+            mask.paste(255, (40, 30, 46, 38))
+            Image.composite(image, Image.new('RGB', (48, 40), TRANSPARENT_RGB), mask).save(path)
+            base = os.path.join(tmpdir, 'sprite')
+            options = gracon.parseOptions(['gracon.py', '-infile', path, '-outfilebase', base, '-mode', 'sprite',
+                                           '-spritesizes', '8x8_16x16', '-palettes', '2', '-verify', 'on'])
+            gracon.convertImage(options)
+            with open(base + '.tiles', 'rb') as tileFile, open(base + '.tilemap', 'rb') as mapFile, \
+                    open(base + '.objsize', 'rb') as sizeFile, open(base + '.palette', 'rb') as paletteFile:
+                tiles = decode_planar_tiles(tileFile.read(), 4)
+                entries = np.frombuffer(mapFile.read(), dtype=np.uint8).reshape(-1, 4)
+                sizeBits = np.unpackbits(np.frombuffer(sizeFile.read(), dtype=np.uint8), bitorder='little')
+                palette = np.frombuffer(paletteFile.read(), dtype='<u2')
+            sample = np.asarray(Image.open(base + '.sample.png').convert('RGB'))
+
+        rendered = np.zeros((40 + 16, 48 + 16), dtype=np.int32)
+        drawn = np.zeros(rendered.shape, dtype=bool)
+        for index, (x, y, tile, flags) in enumerate(entries.tolist()):
+            edge = 2 if sizeBits[index * 2 + 1] else 1
+            tile |= (flags & 1) << 8
+            for row in range(edge):
+                for column in range(edge):
+                    pixels = tiles[tile + row * 16 + column] + ((flags >> 1) & 7) * 16
+                    pixels = pixels[::-1] if flags & 0x80 else pixels
+                    pixels = pixels[:, ::-1] if flags & 0x40 else pixels
+                    rendered[y + row * 8:y + row * 8 + 8, x + column * 8:x + column * 8 + 8] = pixels
+                    drawn[y + row * 8:y + row * 8 + 8, x + column * 8:x + column * 8 + 8] = True
+        self.assertLess(len(entries), 12)
+        colors = np.stack(gracon.convertColorSnesToRGB(palette[rendered[:40, :48]]), axis=-1)
+        self.assertTrue((colors[drawn[:40, :48]] == sample[drawn[:40, :48]]).all())
+
+
+    def test_large_objs_past_the_image_edge(self):
+        """32x32 OBJs reaching more than a tile past the right and bottom edge convert and get a palette error."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sprite.png')
+            image = Image.open(TEST_IMAGE_PATH).convert('RGB').resize((48, 40))
+            mask = Image.new('L', (48, 40), 0)
+            mask.paste(255, (30, 22, 48, 40))
+            Image.composite(image, Image.new('RGB', (48, 40), TRANSPARENT_RGB), mask).save(path)
+            objs = gracon.getPackedSpriteObjs(np.asarray(mask) > 0, 8, 32)
+            self.assertTrue(any(size == 32 and x + size > 48 + 8 and y + size > 40 + 8 for x, y, size in objs))
+
+            metricsFile = os.path.join(tmpdir, 'metrics.json')
+            options = gracon.parseOptions(['gracon.py', '-infile', path, '-outfilebase', os.path.join(tmpdir, 'sprite'),
+                                           '-mode', 'sprite', '-spritesizes', '8x8_32x32', '-metrics', metricsFile])
+            stats = gracon.convertImage(options)
+            self.assertGreaterEqual(stats.paletteError, 0.0)
+
+
+class TestGraconVerify(unittest.TestCase):
+    def test_written_files_decode_to_source(self):
+        """Lossless conversions decode back to the source, mirrored duplicates included."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'mirror.png')
+            create_mirror_test_image(path)
+            for mode in ('bg', 'sprite'):
+                base = os.path.join(tmpdir, mode)
+                options = gracon.parseOptions(['gracon.py', '-infile', path, '-outfilebase', base, '-mode', mode,
+                                               '-tilethreshold', '0', '-verify', 'on'])
+                with self.assertLogs(level='INFO') as logs:
+                    gracon.convertImage(options)
+                self.assertIn('psnr inf dB, max channel error 0.', '\n'.join(logs.output))
+                sample = np.asarray(Image.open(base + '.sample.png').convert('RGB'))
+                source = np.asarray(Image.open(path).convert('RGB'))
+                self.assertTrue((sample & 0xf8 == source & 0xf8).all())
+
+
+class TestGraconBatch(unittest.TestCase):
+    def test_indir_matches_single_conversions(self):
+        """Batch mode writes the same files as one gracon run per frame."""
+        flags = ['-optimize', 'on', '-tilethreshold', '5', '-maxtiles', '20', '-palettes', '2', '-bpp', '4',
+                 '-resolutionx', '64', '-resolutiony', '56']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            indir = os.path.join(tmpdir, 'in')
+            os.makedirs(indir)
+            source = Image.open(TEST_IMAGE_PATH).convert('RGB')
+            for index, box in enumerate(((0, 0, 512, 448), (256, 256, 768, 704))):
+                source.crop(box).resize((64, 56)).save(os.path.join(indir, 'frame%s.png' % index))
+            create_mirror_test_image(os.path.join(indir, 'frame2.png'))
+
+            batch = subprocess.run([sys.executable, GRACON_SCRIPT, '-indir', indir, '-outdir', tmpdir] + flags,
+                                   capture_output=True, text=True)
+            self.assertEqual(batch.returncode, 0, batch.stderr)
+            for index in range(3):
+                single = os.path.join(tmpdir, 'single%s' % index)
+                result = subprocess.run([sys.executable, GRACON_SCRIPT, '-infile', os.path.join(indir, 'frame%s.png' % index),
+                                         '-outfilebase', single] + flags, capture_output=True, text=True)
+                self.assertEqual(result.returncode, 0, result.stderr)
+                for ext in ('.tiles', '.tilemap', '.palette'):
+                    with open(single + ext, 'rb') as expected, open(os.path.join(tmpdir, 'frame%s%s' % (index, ext)), 'rb') as actual:
+                        self.assertEqual(actual.read(), expected.read())
+
+    def test_jobs_match_serial_batch(self):
+        """Worker processes write the same files as a serial batch, without leftover temporary files."""
+        flags = ['-optimize', 'on', '-tilethreshold', '5', '-maxtiles', '20', '-palettes', '2', '-bpp', '4',
+                 '-resolutionx', '64', '-resolutiony', '56']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            indir = os.path.join(tmpdir, 'in')
+            os.makedirs(indir)
+            source = Image.open(TEST_IMAGE_PATH).convert('RGB')
+            for index in range(3):
+                source.crop((index * 128, 0, index * 128 + 512, 448)).resize((64, 56)).save(os.path.join(indir, 'frame%s.png' % index))
+            outdirs = [os.path.join(tmpdir, name) for name in ('serial', 'parallel')]
+            for outdir, jobs in zip(outdirs, ('1', '2')):
+                os.makedirs(outdir)
+                result = subprocess.run([sys.executable, GRACON_SCRIPT, '-indir', indir, '-outdir', outdir, '-jobs', jobs] + flags,
+                                        capture_output=True, text=True)
+                self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(sorted(os.listdir(outdirs[0])), sorted(os.listdir(outdirs[1])))
+            self.assertFalse([name for name in os.listdir(outdirs[1]) if name.endswith('.tmp')])
+            for name in os.listdir(outdirs[0]):
+                with open(os.path.join(outdirs[0], name), 'rb') as expected, open(os.path.join(outdirs[1], name), 'rb') as actual:
+                    self.assertEqual(actual.read(), expected.read(), name)
+
+
+class TestGraconCache(unittest.TestCase):
+    def test_cache_hit_reproduces_conversion(self):
+        """A second conversion of the same pixels and options is served from the cache with identical results."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dirk.png')
+            Image.open(TEST_IMAGE_PATH).convert('RGB').resize((64, 56)).save(path)
+            results = []
+            for name in ('first', 'second'):
+                options = gracon.parseOptions(['gracon.py', '-infile', path, '-outfilebase', os.path.join(tmpdir, name),
+                                               '-cachedir', os.path.join(tmpdir, 'cache'), '-maxtiles', '20', '-verify', 'on'])
+                stats = gracon.convertImage(options)
+                results.append((stats.actualTiles, stats.actualPalettes, options.get('tilethreshold'),
+                                options.get('resolutionx'), options.get('resolutiony')))
+            self.assertEqual(results[0], results[1])
+            self.assertTrue(os.path.isdir(os.path.join(tmpdir, 'cache')))
+            for ext in gracon.getOutputExtensions(options):
+                with open(os.path.join(tmpdir, 'first.' + ext), 'rb') as expected, open(os.path.join(tmpdir, 'second.' + ext), 'rb') as actual:
+                    self.assertEqual(actual.read(), expected.read(), ext)
+
+
+class TestGraconMetrics(unittest.TestCase):
+    def test_metrics_and_build_report(self):
+        """-metrics records stages and tile counts, cache hits are flagged and the report adds both runs up."""
+        import metrics_report
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dirk.png')
+            Image.open(TEST_IMAGE_PATH).convert('RGB').resize((64, 56)).save(path)
+            runs = []
+            for name in ('first', 'second'):
+                metricsFile = os.path.join(tmpdir, 'metrics', name + '.json')
+                options = gracon.parseOptions(['gracon.py', '-infile', path, '-outfilebase', os.path.join(tmpdir, name),
+                                               '-cachedir', os.path.join(tmpdir, 'cache'), '-maxtiles', '20',
+                                               '-metrics', metricsFile])
+                stats = gracon.convertImage(options)
+                gracon.writeMetrics([stats], time.perf_counter(), options)
+                with open(metricsFile) as inFile:
+                    runs.append(json.load(inFile))
+
+            first, second = runs[0]['frames'][0], runs[1]['frames'][0]
+            self.assertEqual(sorted(first['stages']), ['load', 'optimize', 'palettes', 'palettize', 'parse', 'write'])
+            self.assertEqual((first['totalTiles'], first['actualTiles']), (56, stats.actualTiles))
+            self.assertLessEqual(first['actualTiles'], 20)
+            self.assertEqual(first['tileThreshold'], options.get('tilethreshold'))
+            self.assertGreater(first['thresholdRetries'], 0)
+            self.assertGreater(first['paletteError'], 0)
+            self.assertEqual((first['cached'], second['cached']), (False, True))
+            for name in ('actualTiles', 'tileThreshold', 'thresholdRetries', 'paletteError'):
+                self.assertEqual(first[name], second[name], name)
+
+            # without -metrics the palette error is not computed
+            with unittest.mock.patch.dict(os.environ):
+                os.environ.pop(gracon.METRICS_DIR_VARIABLE, None)
+                options = gracon.parseOptions(['gracon.py', '-infile', path, '-outfilebase', os.path.join(tmpdir, 'plain')])
+                self.assertIsNone(gracon.convertImage(options).paletteError)
+
+            report = metrics_report.getReport(runs, 1, baseline={'seconds': 0.0, 'stages': {}, 'frameSeconds': {path: 0.0}})
+            self.assertEqual((report['frames'], report['cachedFrames'], len(report['slowestFrames'])), (2, 1, 1))
+            self.assertEqual(report['slowestFrames'][0]['cached'], False)
+            self.assertEqual(report['retriedFrames'], [path, path])
+            self.assertEqual(report['folders'][0]['frames'], 2)
+
+
+class TestVPTree(unittest.TestCase):
+    def test_nearest_matches_brute_force(self):
+        """k nearest points below an id limit equal a full scan."""
+        points = np.random.default_rng(3).integers(0, 32, size=(500, 12)).astype(float)
+        tree = vptree.VPTree(points)
+        for queryId in (1, 17, 250, 499):
+            distances = np.sqrt(((points[:queryId] - points[queryId]) ** 2).sum(axis=1))
+            expected = sorted(zip(distances.tolist(), range(queryId)), key=lambda item: (item[0], -item[1]))[:5]
+            found = tree.nearest(points[queryId], 5, queryId)
+            self.assertEqual(sorted(distance for distance, pointId in found), [distance for distance, pointId in expected])
+            self.assertTrue(all(pointId < queryId for distance, pointId in found))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TOOLS_DIR = os.path.join(PROJECT_ROOT, 'tools')
+
+sys.path.insert(0, TOOLS_DIR)
+import gracon
+import quantizer
+
+
+def greedy_reduce(colors, count):
+    """Reference reduction: drop the later color of the nearest pair, one full search per step."""
+    colors = list(colors)
+    while len(colors) > count:
+        nearest = gracon.getNearestPaletteIndices(colors)
+        colors.pop(max(nearest['id1'], nearest['id2']))
+    return colors
+
+
+class TestQuantizer(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(11)
+        # clustered colors so that equal distances and chained merges actually happen
+        self.colors = list(dict.fromkeys((rng.integers(0, 8, size=300) * 0x0421 + rng.integers(0, 3, size=300)).tolist()))
+        self.weights = rng.integers(1, 50, size=len(self.colors)).tolist()
+
+    def test_nearest_pair_matches_greedy_loop(self):
+        """The heap-based merge drops exactly the colors the full pairwise search drops."""
+        for count in (len(self.colors) - 1, 15, 4):
+            self.assertEqual(quantizer.reduceNearestPair(self.colors, self.weights, count), greedy_reduce(self.colors, count))
+
+    def test_nearest_pair_keeps_first_color(self):
+        colors = [0x1234, 0x1234 ^ 1, 0x1234 ^ 2, 0x7fff]
+        self.assertEqual(quantizer.reduceNearestPair(colors, [1] * 4, 2)[0], 0x1234)
+
+    def test_averaging_quantizers_respect_count(self):
+        for name in ('mediancut', 'kmeans'):
+            reduced = quantizer.QUANTIZERS[name](self.colors, self.weights, 15)
+            self.assertLessEqual(len(reduced), 15)
+            self.assertEqual(len(reduced), len(set(reduced)))
+            self.assertTrue(all(0 <= color <= 0x7fff for color in reduced))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TOOLS_DIR = os.path.join(PROJECT_ROOT, 'tools')
+
+sys.path.insert(0, TOOLS_DIR)
+import gracon
+import snescolor
+
+
+def similar_color_loop(color, palette):
+    """Reference nearest-color search as gracon originally did it, one palette entry at a time."""
+    best = {'error': gracon.INFINITY, 'value': None}
+    for refColor in palette:
+        diff = snescolor.colorDistance(color, refColor)
+        best = best if best['error'] < diff else {'error': diff, 'value': refColor}
+    return palette.index(best['value']), best['error']
+
+
+class TestSnesColor(unittest.TestCase):
+    def test_distances_match_scalar_formula(self):
+        """Vectorized distances equal the scalar redmean distance bit for bit."""
+        colors = np.random.default_rng(5).integers(0, 0x8000, size=(2, 2000))
+        distances = snescolor.colorDistances(colors[0], colors[1])
+        expected = [snescolor.colorDistance(a, b) for a, b in zip(colors[0].tolist(), colors[1].tolist())]
+        self.assertEqual(distances.tolist(), expected)
+
+    def test_nearest_palette_ties_and_duplicates(self):
+        """Ties go to the later entry, duplicate palette colors map to their first index."""
+        palette = [0x7c1f, 0x0000, 0x001f, 0x0000, 0x03e0, 0x001e, 0x0020, 0x0001]
+        colors = list(range(0, 0x8000, 97)) + [0x0000, 0x001f, 0x0010]
+        indices, errors = snescolor.nearestPaletteIndices(colors, palette)
+        expected = [similar_color_loop(color, palette) for color in colors]
+        self.assertEqual(indices.tolist(), [index for index, error in expected])
+        self.assertEqual(errors.tolist(), [error for index, error in expected])
+
+    def test_nearest_palette_pair_skips_first_color(self):
+        """The first palette color is never merged, the first closest pair loses its later color."""
+        palette = [0x0000, 0x7fff, 0x0001, 0x7fff, 0x0002]
+        nearest = gracon.getNearestPaletteIndices(palette)
+        self.assertEqual(max(nearest['id1'], nearest['id2']), 3)
+        self.assertEqual(nearest['difference'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+TOOLS_DIR = os.path.join(PROJECT_ROOT, 'tools')
+
+sys.path.insert(0, TOOLS_DIR)
+import snesgfx
+
+
+COLORS = np.array(((0, 0, 0), (255, 0, 0), (0, 255, 0), (0, 0, 255)), dtype=np.uint8)
+
+
+def write_frame(path, seed, width=32, height=16):
+    """Blocky frame of four colors, every 4x4 block one color."""
+    blocks = np.random.default_rng(seed).integers(0, len(COLORS), (height // 4, width // 4))
+    pixels = COLORS[np.kron(blocks, np.ones((4, 4), dtype=np.int64))]
+    Image.fromarray(pixels, 'RGB').save(path)
+    return pixels
+
+
+def run_tool(*args):
+    result = subprocess.run([sys.executable] + [str(arg) for arg in args], capture_output=True, text=True,
+                            timeout=120)
+    assert result.returncode == 0, result.stderr
+
+
+class TestSnesGfx(unittest.TestCase):
+    def test_gracon_outputs_render_like_sample(self):
+        """bg and packed sprite conversions decode to the sample image gracon writes."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'frame.png')
+            write_frame(path, 1, 48, 40)
+            for mode, extra in (('bg', ()), ('sprite', ('-spritesizes', '8x8_16x16'))):
+                base = os.path.join(tmpdir, mode)
+                run_tool(os.path.join(TOOLS_DIR, 'gracon.py'), '-infile', path, '-outfilebase', base, '-mode', mode,
+                         '-verify', 'on', *extra)
+                files = {ext: '%s.%s' % (base, ext) for ext in ('tiles', 'tilemap', 'palette', 'objsize')}
+                if mode == 'sprite':
+                    pixels = snesgfx.renderSprites(files['tiles'], files['tilemap'], files['palette'], 48, 40, 4,
+                                                   objSizes=(8, 16), objSizeData=files['objsize'])
+                else:
+                    pixels = snesgfx.renderBg(files['tiles'], files['tilemap'], files['palette'], 48, 40, 4)
+                sample = np.asarray(Image.open(base + '.sample.png').convert('RGB'))
+                np.testing.assert_array_equal(snesgfx.toRGB(pixels), sample)
+
+    def test_multi_screen_tilemaps(self):
+        """Images beyond 32x32 tiles get one tilemap per screen, stored row by row."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'frame.png')
+            for width, height, screens in ((512, 256, 2), (256, 512, 2), (512, 512, 4), (264, 256, 2)):
+                frame = write_frame(path, width + height, width, height)
+                base = os.path.join(tmpdir, 'frame')
+                run_tool(os.path.join(TOOLS_DIR, 'gracon.py'), '-infile', path, '-outfilebase', base)
+                with open(base + '.tilemap', 'rb') as tilemapFile:
+                    tilemap = tilemapFile.read()
+                self.assertEqual(len(tilemap), screens * 32 * 32 * 2)
+                pixels = snesgfx.renderBg(base + '.tiles', tilemap, base + '.palette', width, height, 4)
+                np.testing.assert_array_equal(snesgfx.toRGB(pixels), frame)
+
+    def test_animation_frames(self):
+        """Every .animation frame renders to its source frame with the palette of the first frame."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            frameDir = os.path.join(tmpdir, 'frames')
+            os.mkdir(frameDir)
+            frames = [write_frame(os.path.join(frameDir, 'frame%02d.png' % frameId), frameId) for frameId in range(3)]
+            outfile = os.path.join(tmpdir, 'test.animation')
+            run_tool(os.path.join(TOOLS_DIR, 'animationWriter.py'), '-infolder', frameDir, '-outfile', outfile)
+
+            animation = snesgfx.AnimationFile(outfile)
+            self.assertEqual((len(animation), animation.bpp), (3, 4))
+            self.assertGreater(len(animation[0].palette), 0)
+            self.assertEqual(len(animation[1].palette), 0)
+            for frameId, frame in enumerate(frames):
+                np.testing.assert_array_equal(snesgfx.toRGB(animation.render(frameId, 32, 16)), frame)
+
+    def test_tile_pool_animation(self):
+        """-tilepool frames only carry new tiles, mirrored repeats point into the pool and render unchanged."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            frameDir = os.path.join(tmpdir, 'frames')
+            os.mkdir(frameDir)
+            frames = [write_frame(os.path.join(frameDir, 'frame00.png'), 0)]
+            frames.append(frames[0][:, ::-1])
+            Image.fromarray(frames[1], 'RGB').save(os.path.join(frameDir, 'frame01.png'))
+            frames.append(write_frame(os.path.join(frameDir, 'frame02.png'), 2))
+            outfiles = {}
+            for tilePool in ('off', 'on'):
+                outfiles[tilePool] = os.path.join(tmpdir, 'pool_%s.animation' % tilePool)
+                run_tool(os.path.join(TOOLS_DIR, 'animationWriter.py'), '-infolder', frameDir, '-outfile',
+                         outfiles[tilePool], '-tilepool', tilePool)
+
+            plain = snesgfx.AnimationFile(outfiles['off'])
+            animation = snesgfx.AnimationFile(outfiles['on'])
+            self.assertEqual((plain.tilePool, animation.tilePool, animation.bpp), (False, True, 4))
+            self.assertEqual(len(animation[1].tiles), 0)
+            self.assertEqual(animation.maxTileLength, sum(len(frame.tiles) for frame in animation))
+            self.assertLess(animation.maxTileLength, sum(len(frame.tiles) for frame in plain))
+            for frameId, frame in enumerate(frames):
+                np.testing.assert_array_equal(snesgfx.toRGB(animation.render(frameId, 32, 16)), frame)
+
+    def test_tile_pool_exceeding_vram(self):
+        """A pool of addressable tile numbers that outgrows the allocatable vram is refused."""
+        import animationWriter
+        options = {'mode': 'bg', 'bpp': 8, 'tilesizex': 8, 'tilesizey': 8}
+        tileCount = animationWriter.MAX_POOL_BYTES['bg'] // 64 + 1
+        self.assertLessEqual(tileCount, animationWriter.MAX_POOL_TILES['bg'])
+        tiles = np.random.default_rng(0).integers(0, 256, tileCount * 64, dtype=np.uint8).tobytes()
+        tilemap = np.arange(tileCount, dtype='<u2').tobytes()
+        with self.assertRaises(SystemExit):
+            animationWriter.getTilePoolFrames([(tiles, tilemap, b'')], options)
+
+    def test_delta_animation(self):
+        """-delta frames only carry the changed tilemap runs and render like the full frames."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            frameDir = os.path.join(tmpdir, 'frames')
+            os.mkdir(frameDir)
+            frames = [write_frame(os.path.join(frameDir, 'frame00.png'), 0, 256, 224)]
+            for frameId in range(1, 3):
+                frame = frames[-1].copy()
+                frame[8 * frameId:8 * frameId + 16, 40:64] = COLORS[frameId]
+                Image.fromarray(frame, 'RGB').save(os.path.join(frameDir, 'frame%02d.png' % frameId))
+                frames.append(frame)
+            frames.append(frames[-1])
+            Image.fromarray(frames[-1], 'RGB').save(os.path.join(frameDir, 'frame03.png'))
+            outfile = os.path.join(tmpdir, 'delta.animation')
+            run_tool(os.path.join(TOOLS_DIR, 'animationWriter.py'), '-infolder', frameDir, '-outfile', outfile,
+                     '-delta', 'on')
+
+            animation = snesgfx.AnimationFile(outfile)
+            self.assertEqual((animation.tilePool, animation.delta, animation.bpp), (True, True, 4))
+            self.assertEqual(len(animation[0].tilemap), 4 + 32 * 32 * 2)
+            self.assertLess(len(animation[1].tilemap), 32 * 32 * 2 // 4)
+            self.assertEqual(len(animation[3].tilemap), 0)
+            for frameId, frame in enumerate(frames):
+                np.testing.assert_array_equal(snesgfx.toRGB(animation.render(frameId)), frame)
+
+    def test_palette_modes(self):
+        """Colors only later frames bring in survive -palettemode global and perframe, perframe swaps palettes."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            frameDir = os.path.join(tmpdir, 'frames')
+            os.mkdir(frameDir)
+            frames = []
+            for frameId, colors in enumerate((COLORS[:2], COLORS[2:])):
+                blocks = np.random.default_rng(frameId).integers(0, len(colors), (4, 8))
+                frames.append(colors[np.kron(blocks, np.ones((4, 4), dtype=np.int64))])
+                Image.fromarray(frames[-1], 'RGB').save(os.path.join(frameDir, 'frame%02d.png' % frameId))
+            animations = {}
+            for paletteMode in ('first', 'global', 'perframe'):
+                outfile = os.path.join(tmpdir, '%s.animation' % paletteMode)
+                run_tool(os.path.join(TOOLS_DIR, 'animationWriter.py'), '-infolder', frameDir, '-outfile', outfile,
+                         '-palettemode', paletteMode, '-jobs', '2')
+                animations[paletteMode] = snesgfx.AnimationFile(outfile)
+
+            self.assertFalse(np.array_equal(snesgfx.toRGB(animations['first'].render(1, 32, 16)), frames[1]))
+            self.assertEqual(len(animations['global'][1].palette), 0)
+            self.assertGreater(len(animations['perframe'][1].palette), 0)
+            for paletteMode in ('global', 'perframe'):
+                for frameId, frame in enumerate(frames):
+                    np.testing.assert_array_equal(snesgfx.toRGB(animations[paletteMode].render(frameId, 32, 16)), frame)
+
+    def test_msu_frames(self):
+        """Frames packed by msu1blockwriter come back with their tiles, tilemap and palette intact."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chapterDir = os.path.join(tmpdir, 'chapters', 'chapter01')
+            os.makedirs(chapterDir)
+            with open(os.path.join(chapterDir, 'chapter.id7'), 'w') as idFile:
+                idFile.write('chapter 7')
+            frames = []
+            for frameId in range(2):
+                path = os.path.join(tmpdir, 'frame%s.png' % frameId)
+                frames.append(write_frame(path, frameId + 10, 256, 224))
+                run_tool(os.path.join(TOOLS_DIR, 'gracon.py'), '-infile', path, '-outfilebase',
+                         os.path.join(chapterDir, 'frame%s.gfx_video' % frameId))
+            outfile = os.path.join(tmpdir, 'movie.msu')
+            run_tool(os.path.join(TOOLS_DIR, 'msu1blockwriter.py'), '-infilebase', os.path.join(tmpdir, 'chapters'),
+                     '-outfile', outfile, '-title', 'test')
+
+            movie = snesgfx.MsuFile(outfile)
+            self.assertEqual((movie.title, movie.bpp, len(movie)), ('TEST', 4, 1))
+            # msu1blockwriter repeats the last frame twice
+            self.assertEqual(len(movie.chapters[7]), 4)
+            for frameId, frame in enumerate(frames + frames[-1:] * 2):
+                np.testing.assert_array_equal(snesgfx.toRGB(movie.render(7, frameId)), frame)
+            with open(os.path.join(chapterDir, 'frame1.gfx_video.tiles'), 'rb') as tileFile:
+                self.assertEqual(movie.getFrame(7, 1).tiles.tobytes(), tileFile.read())
+
+    def test_empty_and_foreign_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'empty.tiles')
+            open(path, 'wb').close()
+            self.assertEqual(snesgfx.decodeTiles(path, 4).shape, (0, 8, 8))
+            with open(path, 'wb') as outFile:
+                outFile.write(b'XX' + bytes(16))
+            with self.assertRaises(ValueError):
+                snesgfx.AnimationFile(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
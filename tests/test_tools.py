@@ -109,6 +109,18 @@ def test_animation_writer(tmp_path):
             f"File should be larger than header+pointers ({min_expected_size}), got {file_size}"
 
 
+def test_animation_writer_jobs_match_serial(tmp_path):
+    """Frames converted by -jobs worker processes are written exactly like serially converted ones."""
+    source_dir = ROOT / "data" / "sprites" / "life_counter.gfx_sprite"
+    outputs = []
+    for jobs in ("1", "3"):
+        out_path = tmp_path / f"jobs{jobs}.anim"
+        run_script([str(TOOLS / "animationWriter.py"), "-mode", "sprite", "-infolder", str(source_dir),
+                    "-outfile", str(out_path), "-jobs", jobs])
+        outputs.append(out_path.read_bytes())
+    assert outputs[0] == outputs[1]
+
+
 def test_mod2snes(tmp_path):
     """Test mod2snes.py with trans_atlantic.mod fixture and validate SPCMOD output."""
     # Use the real MOD file from fixtures
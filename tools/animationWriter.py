@@ -6,25 +6,37 @@ __version__ = "0.1"
 
 '''
 takes input graphics files(usually png), converts and packs them into animation file
-first file determines palette to use
+first file determines palette to use, unless -palettemode says otherwise
 nice2have:
-  -calculate required palettes, insert new palettes as needed
-    -start at first palette, keep in buffer, save there
-    -if buffer satisfies subsequent frame, use buffer there aswell. else replace buffer
-    
   -somehow decide between frame tile uploads and packing all tiles into one tileset
 
 command line options:
 -infolder    input folder containing all animation frames, name-sorted
 -outfile    output animation file
+-tilepool   on: all frames share one tile pool, each frame only carries the tiles no earlier frame had(plain or
+            mirrored), its tilemap points into the pool. the player appends every frame's tiles behind those of
+            the frames before and starts over at frame 0, so only use it on animations played front to back.
+            default: off
+-jobs       worker processes that convert the frames, default: 1
+-palettemode
+            first: the first frame determines the palette of all frames
+            global: one palette weighted by the colors of all frames(or -palettesamples of them, evenly spread)
+            perframe: every frame gets its own palette, frames only carry it if it differs from the one before
+            and the player swaps palettes on those. can not be combined with -tilepool or -delta
+            default: first
+-palettesamples
+            frames -palettemode global builds the palette from, default: 0(all)
+-delta      on: bg only, implies -tilepool. every frame after the first only carries the tilemap runs that changed
+            since the frame before, each run is one dma transfer. default: off
 
 outfile format:
 [sprite_animation{
-  [header(8bytes){
+  [header(9bytes){
     2 bytes : "SP", header magic
-    2 bytes : max tile-size(bytes) in animation(for vram/sprite allocation)
+    2 bytes : max tile-size(bytes) in animation(for vram/sprite allocation), tile pool size with -tilepool
     2 bytes : max palette-size(bytes) in animation(for cgram)
     2 bytes : frames in animation
+    1 byte  : bpp / 2, bit 7 set if frames add to a tile pool, bit 6 set if frames hold delta tilemaps
   }],
   [pointer{
     2 bytes : relative pointer to individual sprite frame
@@ -33,10 +45,14 @@ outfile format:
   [header(6bytes){
     2 bytes : tilesize(bytes): if 0, no tiles present(use previous)
     2 bytes : spritemapsize(byte)
-    2 bytes : palettesize(byte): if 0, no tiles present(use previous)
+    2 bytes : palettesize(byte): if 0, no palette present(use previous)
   }],
   [tiles]
-  [spritemap]
+  [spritemap]: with -delta, runs of changed tilemap entries{
+    2 bytes : offset(bytes) of the run in the tilemap
+    2 bytes : run length(bytes)
+    [tilemap entries]
+  }
   [palette]
   }]
 }]  
@@ -46,9 +62,13 @@ import os
 import sys
 import math
 import time
+import concurrent.futures
+import contextlib
 import userOptions
 import gracon
+import snesgfx
 import logging
+import numpy as np
 '''
 debugfile = open('debug.log', 'wb')
 debugfile.close()
@@ -66,7 +86,28 @@ INFINITY = 1e300000
 HEADER_MAGIC = b'SP'
 HEADER_SIZE = 9
 FRAME_HEADER_SIZE = 6
+TILEPOOL_FLAG = 0x80
+DELTA_FLAG = 0x40
+# the bg player buffers and uploads one 32x32 tilemap
+DELTA_TILEMAP_LENGTH = gracon.BG_TILEMAP_SIZE * gracon.BG_TILEMAP_SIZE * 2
+# unchanged entries bridged between runs, a run header costs as much
+DELTA_RUN_GAP = 2
+# runs per frame, keeps half of the 16 dma queue slots free for tiles, palettes and other objects
+MAX_DELTA_RUNS = 8
+# dma bytes per ntsc vblank, 37 scanlines at 8 master cycles per byte, less setup overhead
+VBLANK_DMA_BYTES = 0x1800
+# tile numbers a tilemap entry can address
+MAX_POOL_TILES = {
+    'bg': 0x400,
+    'sprite': 0x200
+}
+# vram bytes the player can allocate for the pool, all of vram less the bg tilemap or the sprite name tables
+MAX_POOL_BYTES = {
+    'bg': 0x10000 - DELTA_TILEMAP_LENGTH,
+    'sprite': 0x4000
+}
 ALLOWED_FRAME_FILETYPES = ('.png', '.gif', '.bmp')
+PALETTE_MODES = ('first', 'global', 'perframe')
 
 
 def main():
@@ -149,8 +190,84 @@ def main():
             'max': 0xffff,
             'min': 1
         },
+        'spritesizes': {
+            'value': '',
+            'type': 'str'
+        },
+        'tilepool': {
+            'value': False,
+            'type': 'bool'
+        },
+        'jobs': {
+            'value': 1,
+            'type': 'int',
+            'max': 256,
+            'min': 1
+        },
+        'palettemode': {
+            'value': 'first',
+            'type': 'str'
+        },
+        'palettesamples': {
+            'value': 0,
+            'type': 'int',
+            'max': 0xffff,
+            'min': 0
+        },
+        'delta': {
+            'value': False,
+            'type': 'bool'
+        },
+        'tilesearch': {
+            'value': 'exact',
+            'type': 'str'
+        },
+        'quantizer': {
+            'value': 'nearestpair',
+            'type': 'str'
+        },
+        'prereduce': {
+            'value': True,
+            'type': 'bool'
+        },
+        'palettesolver': {
+            'value': 'hue',
+            'type': 'str'
+        },
+        'paletteiterations': {
+            'value': 10,
+            'type': 'int',
+            'max': 1000,
+            'min': 0
+        },
+        'palettetimelimit': {
+            'value': 0.0,
+            'type': 'float',
+            'max': 3600.0,
+            'min': 0.0
+        },
     })
 
+    if options.get('spritesizes'):
+        logging.error('Error, animation frames have no OBJ size table, -spritesizes is only supported by gracon.')
+        sys.exit(1)
+
+    if options.get('delta'):
+        if options.get('mode') != 'bg':
+            logging.error('Error, -delta is only supported for bg animations.')
+            sys.exit(1)
+        # unchanged tilemap entries keep pointing at the tiles of earlier frames
+        options.set('tilepool', True)
+
+    if options.get('palettemode') not in PALETTE_MODES:
+        logging.error('Error, invalid palette mode "%s", allowed are %s.' % (
+            options.get('palettemode'), ', '.join(PALETTE_MODES)))
+        sys.exit(1)
+
+    if options.get('palettemode') == 'perframe' and options.get('tilepool'):
+        logging.error('Error, -palettemode perframe can not be combined with -tilepool or -delta, pooled tiles would change colors.')
+        sys.exit(1)
+
     if not os.path.exists(options.get('infolder')):
         logging.error('Error, input folder "%s" is nonexistant.' %
                       options.get('infolder'))
@@ -167,30 +284,37 @@ def main():
     tileFiles = [frame for root, dirs, names in os.walk(options.get(
         'infolder')) for frame in names if os.path.splitext(frame)[1] in ALLOWED_FRAME_FILETYPES]
     tileFiles.sort()
-    tileFrames = [gracon.parseTiles(gracon.getInputImage(
-        options, "%s/%s" % (options.get('infolder'), frame)), options) for frame in tileFiles]
 
-    if not 0 < len(tileFrames):
+    if not 0 < len(tileFiles):
         logging.error(
             'Error, input folder "%s" does not contain any parseable frame image files.' % options.get('infolder'))
         sys.exit(1)
 
-    palette = gracon.parseGlobalPalettes(tileFrames[0], options)
-
-    tileFrames = [gracon.augmentOutIds(gracon.optimizeTiles(
-        gracon.palettizeTiles(frame, palette), options)) for frame in tileFrames]
+    tileFrames, palettes = getTileFrames(
+        ["%s/%s" % (options.get('infolder'), frame) for frame in tileFiles], options)
 
     tileMapGetter = gracon.getSpriteTileMapStream if options.get(
         'mode') == 'sprite' else gracon.getBgTileMapStream
 
-    palette = gracon.augmentOutIds(palette)
+    palettes = [gracon.augmentOutIds(palette) for palette in palettes]
     frames = [(gracon.getTileWriteStream(tileFrame, options), tileMapGetter(
-        tileFrame, palette, options), gracon.getPaletteWriteStream([], options)) for tileFrame in tileFrames]
+        tileFrame, palette, options), gracon.getPaletteWriteStream([], options)) for tileFrame, palette in zip(tileFrames, palettes)]
 
-    # append palette to first
+    # append palette to first and to every frame that swaps it
     if not options.get('directcolor'):
-        frames[0] = (gracon.getTileWriteStream(tileFrames[0], options), tileMapGetter(
-            tileFrames[0], palette, options), gracon.getPaletteWriteStream(palette, options))
+        paletteStreams = [gracon.getPaletteWriteStream(palette, options) for palette in palettes]
+        for frameId, paletteStream in enumerate(paletteStreams):
+            if frameId == 0 or paletteStream != paletteStreams[frameId - 1]:
+                frames[frameId] = frames[frameId][:2] + (paletteStream,)
+        logging.info('palette mode %s, %s tiles in %s frames, %s palette uploads.' % (
+            options.get('palettemode'), sum(len(frame[0]) for frame in frames) // getTileLength(options),
+            len(frames), len([frame for frame in frames if len(frame[2])])))
+
+    poolLength = 0
+    if options.get('tilepool'):
+        frames, poolLength = getTilePoolFrames(frames, options)
+    if options.get('delta'):
+        frames = getDeltaFrames(frames)
 
     # collect some information about frames
     maxTileLength = 0
@@ -218,6 +342,8 @@ def main():
     # write header
     outFile.write(HEADER_MAGIC)
 
+    if options.get('tilepool'):
+        maxTileLength = poolLength
     outFile.write(bytes((maxTileLength & 0xff,)))
     outFile.write(bytes(((maxTileLength & 0xff00) >> 8,)))
 
@@ -227,7 +353,8 @@ def main():
     outFile.write(bytes((framecount & 0xff,)))
     outFile.write(bytes(((framecount & 0xff00) >> 8,)))
 
-    outFile.write(bytes((int(options.get('bpp')/2) & 0xff,)))
+    flags = (TILEPOOL_FLAG if options.get('tilepool') else 0) | (DELTA_FLAG if options.get('delta') else 0)
+    outFile.write(bytes(((int(options.get('bpp')/2) | flags) & 0xff,)))
 
     # write framepointerlist
     outFile.seek(HEADER_SIZE)
@@ -264,6 +391,203 @@ def main():
                  options.get('outfile'))
 
 
+def getTileFrames(framePaths, options):
+    '''palettized and optimized tiles of all frames and the palette of every frame, see -palettemode. frames are
+    independent once their palette is known and spread over -jobs worker processes, results come back in frame order.
+    options keep the resolution of the last frame, the tilemaps are laid out for it'''
+    startTime = time.perf_counter()
+    if options.get('palettemode') == 'perframe':
+        with mapFrames(convertFrame, [(path, None) for path in framePaths], options) as results:
+            frames = list(results)
+    elif options.get('palettemode') == 'global':
+        with mapFrames(parseFrame, getPaletteSamplePaths(framePaths, options), options) as results:
+            palette = gracon.parseGlobalPalettes(joinTileSets(list(results)), options)
+        with mapFrames(convertFrame, [(path, palette) for path in framePaths], options) as results:
+            frames = list(results)
+    else:
+        firstFrame = parseFrame(framePaths[0], options)
+        palette = gracon.parseGlobalPalettes(firstFrame, options)
+        # the workers start on the later frames while the first one is optimized here
+        with mapFrames(convertFrame, [(path, palette) for path in framePaths[1:]], options) as results:
+            frames = [(optimizeFrame(firstFrame, palette, options), palette, options.get('resolutionx'), options.get('resolutiony'))]
+            frames += list(results)
+    tileFrames, palettes, resolutionX, resolutionY = zip(*frames)
+    options.set('resolutionx', resolutionX[-1])
+    options.set('resolutiony', resolutionY[-1])
+    logging.info('converted %s frames in %.2f seconds.' % (len(tileFrames), time.perf_counter() - startTime))
+    return list(tileFrames), list(palettes)
+
+
+@contextlib.contextmanager
+def mapFrames(function, tasks, options):
+    '''results of function applied to every task, in task order. with -jobs all tasks are handed to the worker
+    processes right away, the caller can do other work before collecting them. without, they run lazily in this
+    process'''
+    jobs = min(options.get('jobs'), len(tasks))
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=initFrameWorker, initargs=(options,)) as executor:
+            yield executor.map(function, tasks)
+    else:
+        yield (function(task, options) for task in tasks)
+
+
+def initFrameWorker(options):
+    '''runs once per worker process, keeps the options so that tasks only carry file names and palettes'''
+    global workerOptions
+    workerOptions = options
+
+
+def parseFrame(path, options=None):
+    options = workerOptions if options is None else options
+    return gracon.parseTiles(gracon.getInputImage(options, path), options)
+
+
+def convertFrame(task, options=None):
+    '''tiles and palette of one frame, the frame's own palette if none is given'''
+    path, palette = task
+    options = workerOptions if options is None else options
+    tiles = parseFrame(path, options)
+    if palette is None:
+        palette = gracon.parseGlobalPalettes(tiles, options)
+    return optimizeFrame(tiles, palette, options), palette, options.get('resolutionx'), options.get('resolutiony')
+
+
+def optimizeFrame(tiles, palette, options):
+    return gracon.augmentOutIds(gracon.optimizeTiles(gracon.palettizeTiles(tiles, palette), options))
+
+
+def getPaletteSamplePaths(framePaths, options):
+    '''-palettesamples frames, evenly spread and always including the first'''
+    samples = options.get('palettesamples')
+    if not samples or samples >= len(framePaths):
+        return framePaths
+    return [framePaths[frameId] for frameId in sorted(set(np.linspace(0, len(framePaths) - 1, samples).round().astype(int).tolist()))]
+
+
+def joinTileSets(tileSets):
+    '''one tile set of the tiles of all frames, palettes built from it weigh colors by their pixel count in all frames'''
+    return gracon.TileSet(np.concatenate([tiles.pixel for tiles in tileSets]),
+                          np.concatenate([tiles.x for tiles in tileSets]),
+                          np.concatenate([tiles.y for tiles in tileSets]))
+
+
+def getTileLength(options):
+    return options.get('tilesizex') * options.get('tilesizey') * options.get('bpp') // 8
+
+
+def getTilePoolFrames(frames, options):
+    '''moves the tiles of all frames into one pool. every frame keeps the tiles no earlier frame had, plain or
+    mirrored, and its tilemap is pointed into the pool. returns the frames and the pool size in bytes'''
+    bpp, tileSizeX, tileSizeY = options.get('bpp'), options.get('tilesizex'), options.get('tilesizey')
+    tileLength = getTileLength(options)
+    remapTilemap = remapSpriteTilemap if options.get('mode') == 'sprite' else remapBgTilemap
+    pool = {}
+    poolFrames = []
+    for tileStream, tilemapStream, paletteStream in frames:
+        tileRefs = []
+        newTiles = []
+        for tileId, tile in enumerate(snesgfx.decodeTiles(tileStream, bpp, tileSizeX, tileSizeY)):
+            for xMirror, yMirror in gracon.MIRROR_CONFIGS:
+                poolId = pool.get(gracon.mirrorPixels(tile, xMirror, yMirror).tobytes())
+                if poolId is not None:
+                    tileRefs.append((poolId, xMirror, yMirror))
+                    break
+            else:
+                tileRefs.append((len(pool), False, False))
+                pool[tile.tobytes()] = len(pool)
+                newTiles.append(tileStream[tileId * tileLength:(tileId + 1) * tileLength])
+        poolFrames.append((b''.join(newTiles), remapTilemap(tilemapStream, tileRefs), paletteStream))
+
+    if len(pool) > MAX_POOL_TILES[options.get('mode')]:
+        logging.error('Error, tile pool holds %s tiles, tilemaps can only address %s.' % (
+            len(pool), MAX_POOL_TILES[options.get('mode')]))
+        sys.exit(1)
+    if len(pool) * tileLength > MAX_POOL_BYTES[options.get('mode')]:
+        logging.error('Error, tile pool holds %s bytes, the player can only allocate %s bytes of vram.' % (
+            len(pool) * tileLength, MAX_POOL_BYTES[options.get('mode')]))
+        sys.exit(1)
+    frameLength = sum(len(frame[0]) for frame in frames)
+    logging.info('tile pool holds %s tiles, %s bytes instead of %s, saved %s bytes. peak tile upload per frame is %s bytes instead of %s.' % (
+        len(pool), len(pool) * tileLength, frameLength, frameLength - len(pool) * tileLength,
+        max(len(frame[0]) for frame in poolFrames), max(len(frame[0]) for frame in frames)))
+    return poolFrames, len(pool) * tileLength
+
+
+def getDeltaFrames(frames):
+    '''replaces the bg tilemap of every frame by runs of the entries that changed since the frame before. the first
+    frame holds the whole tilemap, the player starts over there'''
+    previous = None
+    deltaFrames = []
+    runCounts = []
+    for tileStream, tilemapStream, paletteStream in frames:
+        if len(tilemapStream) > DELTA_TILEMAP_LENGTH:
+            logging.error('Error, -delta frames must fit one 32x32 tilemap, frame tilemap is %s bytes.' % len(tilemapStream))
+            sys.exit(1)
+        entries = np.frombuffer(tilemapStream, dtype='<u2')
+        if previous is None or len(previous) != len(entries):
+            changed = np.arange(len(entries))
+        else:
+            changed = np.flatnonzero(entries != previous)
+        runs = getTilemapRuns(changed)
+        runCounts.append(len(runs))
+        runStream = b''.join(np.array((start * 2, (end - start) * 2), dtype='<u2').tobytes() + entries[start:end].tobytes()
+                             for start, end in runs)
+        deltaFrames.append((tileStream, runStream, paletteStream))
+        previous = entries
+
+    fullLength = sum(len(frame[1]) for frame in frames)
+    deltaLength = sum(len(frame[1]) for frame in deltaFrames)
+    uploads = [len(frame[0]) + len(frame[1]) for frame in deltaFrames[1:]] or [0]
+    logging.info('delta tilemaps hold %s bytes instead of %s, saved %s bytes, at most %s runs per frame. peak upload per frame after the first is %s bytes.' % (
+        deltaLength, fullLength, fullLength - deltaLength, max(runCounts), max(uploads)))
+    if max(uploads) > VBLANK_DMA_BYTES:
+        logging.warning('Warning, frame %s uploads %s bytes, more than the %s bytes dma can move in one vblank.' % (
+            uploads.index(max(uploads)) + 1, max(uploads), VBLANK_DMA_BYTES))
+    return deltaFrames
+
+
+def getTilemapRuns(changed):
+    '''(start, end) entry ranges covering the changed entries, one dma transfer each. gaps up to DELTA_RUN_GAP are
+    bridged, then the closest runs are merged until MAX_DELTA_RUNS are left'''
+    if not len(changed):
+        return []
+    breaks = np.flatnonzero(np.diff(changed) > DELTA_RUN_GAP + 1)
+    runs = list(zip(changed[np.concatenate(([0], breaks + 1))].tolist(),
+                    (changed[np.concatenate((breaks, [len(changed) - 1]))] + 1).tolist()))
+    while len(runs) > MAX_DELTA_RUNS:
+        runId = min(range(len(runs) - 1), key=lambda runId: runs[runId + 1][0] - runs[runId][1])
+        runs[runId:runId + 2] = [(runs[runId][0], runs[runId + 1][1])]
+    return runs
+
+
+def getTileRefArrays(tileIds, tileRefs):
+    '''pool id and mirror flips of the referenced frame tiles, ids without a frame tile are kept'''
+    size = max(len(tileRefs), int(tileIds.max()) + 1 if len(tileIds) else 0)
+    poolIds = np.arange(size, dtype=np.int32)
+    xMirror = np.zeros(size, dtype=np.int32)
+    yMirror = np.zeros(size, dtype=np.int32)
+    if tileRefs:
+        poolIds[:len(tileRefs)], xMirror[:len(tileRefs)], yMirror[:len(tileRefs)] = np.array(tileRefs, dtype=np.int32).T
+    return poolIds[tileIds], xMirror[tileIds], yMirror[tileIds]
+
+
+def remapBgTilemap(tilemapStream, tileRefs):
+    '''bg tilemap entries vhopppcc cccccccc pointed at pool tiles'''
+    entries = np.frombuffer(tilemapStream, dtype='<u2').astype(np.int32)
+    poolIds, xMirror, yMirror = getTileRefArrays(entries & 0x3ff, tileRefs)
+    entries = ((entries & ~0x3ff) ^ (xMirror << 14) ^ (yMirror << 15)) | poolIds
+    return entries.astype('<u2').tobytes()
+
+
+def remapSpriteTilemap(tilemapStream, tileRefs):
+    '''sprite tilemap entries x, y, cccccccc, vhoopppN pointed at pool tiles'''
+    entries = np.frombuffer(tilemapStream, dtype=np.uint8).reshape(-1, 4).astype(np.int32)
+    poolIds, xMirror, yMirror = getTileRefArrays(entries[:, 2] | ((entries[:, 3] & 1) << 8), tileRefs)
+    entries[:, 2] = poolIds & 0xff
+    entries[:, 3] = ((entries[:, 3] & ~1) ^ (xMirror << 6) ^ (yMirror << 7)) | (poolIds >> 8)
+    return entries.astype(np.uint8).tobytes()
+
+
 def debugLog(data, message=''):
     logging.info(message)
     debugLogRecursive(data, '')
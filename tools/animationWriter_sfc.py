@@ -8,6 +8,7 @@ import struct
 import tempfile
 import shutil
 import logging
+import concurrent.futures
 from PIL import Image
 
 # Constants
@@ -15,16 +16,20 @@ HEADER_MAGIC = b'SP'
 HEADER_SIZE = 9
 FRAME_HEADER_SIZE = 6
 ALLOWED_FRAME_FILETYPES = ('.png', '.gif', '.bmp')
+# staging area for the per frame files superfamiconv reads and writes
+TMPFS_DIR = '/dev/shm'
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-def run_command(cmd):
-    print(f"Running: {' '.join(cmd)}")
+def run_command(cmd, log):
+    # frames run side by side, their output is collected in log and printed in frame order
+    log.append(f"Running: {' '.join(cmd)}")
     try:
         output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        print(output.decode('utf-8', errors='replace'))
+        log.append(output.decode('utf-8', errors='replace'))
     except subprocess.CalledProcessError as e:
+        print('\n'.join(log))
         print(f"Error running command: {' '.join(cmd)}")
         print(f"Output: {e.output.decode('utf-8', errors='replace')}")
         sys.exit(1)
@@ -53,6 +58,8 @@ def parse_arguments():
     parser.add_argument("-bpp", type=int, default=4, help="Bits per pixel (default: 4)")
     parser.add_argument("-mode", choices=['bg', 'sprite'], default='bg', help="Mode: bg or sprite (default: bg)")
     parser.add_argument("-verbose", action="store_true", help="Enable verbose logging")
+    parser.add_argument("-jobs", type=int, default=os.cpu_count() or 1,
+                        help="Frames converted side by side (default: number of cpus)")
     
     # Ignored/Legacy arguments for compatibility
     parser.add_argument("-refpalette", help="Reference palette image (ignored)")
@@ -80,6 +87,19 @@ def get_frames(infolder):
         
     return [os.path.join(infolder, f) for f in files]
 
+def is_wsl():
+    if not hasattr(os, 'uname'):
+        return False
+    release = os.uname().release.lower()
+    return 'microsoft' in release or 'wsl' in release
+
+def get_staging_dir():
+    # tmpfs keeps the per frame files off the disk. a windows superfamiconv, native or called from WSL,
+    # can not see it, use the current directory there
+    if os.name != 'nt' and not is_wsl() and os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+        return TMPFS_DIR
+    return os.getcwd()
+
 def to_windows_path(path):
     # Check if we are on Windows
     if os.name == 'nt':
@@ -87,9 +107,7 @@ def to_windows_path(path):
 
     # Check if we are in WSL
     if hasattr(os, 'uname'):
-        release = os.uname().release
-        # print(f"DEBUG: Release: {release}, Path: {path}")
-        if 'microsoft' in release.lower() or 'wsl' in release.lower():
+        if is_wsl():
             try:
                 # If file exists, convert directly
                 if os.path.exists(path):
@@ -123,8 +141,9 @@ def quantize_image(input_image, output_image, num_colors):
         if 'transparency' in out.info:
             del out.info['transparency']
         out.save(output_image)
+        return out.size
 
-def generate_palette(sfc_path, input_image, output_palette, colors_per_palette):
+def generate_palette(sfc_path, input_image, output_palette, colors_per_palette, log):
     # superfamiconv palette -i input.png -d output.palette -C colors
     cmd = [
         sfc_path, "palette",
@@ -132,9 +151,9 @@ def generate_palette(sfc_path, input_image, output_palette, colors_per_palette):
         "-d", to_windows_path(output_palette),
         "-C", str(colors_per_palette)
     ]
-    run_command(cmd)
+    run_command(cmd, log)
 
-def generate_tiles_and_map(sfc_path, input_image, palette_file, output_tiles, output_map, bpp, tile_w, tile_h, mode):
+def generate_tiles_and_map(sfc_path, input_image, palette_file, output_tiles, output_map, bpp, tile_w, tile_h, mode, log):
     # superfamiconv tiles -i input.png -p palette.palette -d output.tiles -B bpp -W w -H h
     cmd_tiles = [
         sfc_path, "tiles",
@@ -157,8 +176,8 @@ def generate_tiles_and_map(sfc_path, input_image, palette_file, output_tiles, ou
         "-H", str(tile_h)
     ]
     
-    run_command(cmd_tiles)
-    run_command(cmd_map)
+    run_command(cmd_tiles, log)
+    run_command(cmd_map, log)
 
 def read_file(filepath):
     with open(filepath, 'rb') as f:
@@ -208,6 +227,45 @@ def find_empty_tile_id(tiles_data, bpp):
             return i
     return -1
 
+def convert_frame(frame_idx, frame_path, temp_dir, sfc_path, args):
+    # quantize, palette, tiles and map of one frame, read back into memory
+    log = []
+    palette_file = os.path.join(temp_dir, f"{frame_idx}.bin")
+    quantized_image = os.path.join(temp_dir, f"{frame_idx}.quantized.png")
+    
+    colors = 16 if args.bpp == 4 else 4
+    # if args.palettes > 1:
+    #     colors = colors * args.palettes
+    
+    # 1. Quantize image using PIL
+    # This ensures the image has at most 'colors' unique colors.
+    # PIL generates an optimal palette for this image.
+    size = quantize_image(frame_path, quantized_image, colors)
+    
+    # 2. Generate palette from QUANTIZED image
+    # superfamiconv will read the quantized image (RGB) and generate a SNES palette.
+    # Since the image has <= colors, superfamiconv should be able to fit it,
+    # assuming it can arrange them into sub-palettes correctly.
+    # If PIL picked colors that violate sub-palette constraints, superfamiconv might still fail or drop colors.
+    # But this is the best we can do without implementing the constraint solver in Python.
+    generate_palette(sfc_path, quantized_image, palette_file, colors, log)
+    
+    tiles_file = os.path.join(temp_dir, f"{frame_idx}.tiles")
+    map_file = os.path.join(temp_dir, f"{frame_idx}.map")
+    
+    # 3. Generate tiles/map from QUANTIZED image and GENERATED palette
+    # Since the palette was generated from THIS image, colors should match exactly.
+    generate_tiles_and_map(sfc_path, quantized_image, palette_file, tiles_file, map_file, 
+                           args.bpp, args.tilesizex, args.tilesizey, args.mode, log)
+    
+    return {
+        'tiles': read_file(tiles_file),
+        'map': read_file(map_file),
+        'palette': read_file(palette_file),
+        'size': size,
+        'log': log
+    }
+
 def main():
     args = parse_arguments()
     
@@ -235,10 +293,14 @@ def main():
     sfc_path = get_sfc_path()
     frames = get_frames(args.infolder)
     
-    # Use current directory for temp files to ensure Windows executable can access them
-    # (WSL /tmp might not be accessible to Windows apps)
-    with tempfile.TemporaryDirectory(dir=os.getcwd()) as temp_dir:
-        logging.info(f"Processing {len(frames)} frames...")
+    # Frames only depend on their own image: quantize, palette, tiles and map of every frame run in a
+    # bounded pool, superfamiconv works in its own processes. Results are put together in frame order.
+    with tempfile.TemporaryDirectory(dir=get_staging_dir()) as temp_dir:
+        logging.info(f"Processing {len(frames)} frames in {max(1, args.jobs)} jobs...")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+            converted_frames = list(executor.map(
+                lambda frame: convert_frame(frame[0], frame[1], temp_dir, sfc_path, args), enumerate(frames)))
 
         # 2. Process all frames
         processed_frames = []
@@ -249,40 +311,12 @@ def main():
         
         first_frame_palette_data = b''
         
-        for frame_idx, frame_path in enumerate(frames):
-            base_name = os.path.basename(frame_path)
-            
-            palette_file = os.path.join(temp_dir, f"{frame_idx}.bin")
-            quantized_image = os.path.join(temp_dir, f"{frame_idx}.quantized.png")
-            
-            colors = 16 if args.bpp == 4 else 4
-            # if args.palettes > 1:
-            #     colors = colors * args.palettes
-            
-            # 1. Quantize image using PIL
-            # This ensures the image has at most 'colors' unique colors.
-            # PIL generates an optimal palette for this image.
-            quantize_image(frame_path, quantized_image, colors)
-            
-            # 2. Generate palette from QUANTIZED image
-            # superfamiconv will read the quantized image (RGB) and generate a SNES palette.
-            # Since the image has <= colors, superfamiconv should be able to fit it,
-            # assuming it can arrange them into sub-palettes correctly.
-            # If PIL picked colors that violate sub-palette constraints, superfamiconv might still fail or drop colors.
-            # But this is the best we can do without implementing the constraint solver in Python.
-            generate_palette(sfc_path, quantized_image, palette_file, colors)
-            
-            tiles_file = os.path.join(temp_dir, f"{frame_idx}.tiles")
-            map_file = os.path.join(temp_dir, f"{frame_idx}.map")
-            
-            # 3. Generate tiles/map from QUANTIZED image and GENERATED palette
-            # Since the palette was generated from THIS image, colors should match exactly.
-            generate_tiles_and_map(sfc_path, quantized_image, palette_file, tiles_file, map_file, 
-                                   args.bpp, args.tilesizex, args.tilesizey, args.mode)
-            
-            tiles_data = read_file(tiles_file)
-            map_data = read_file(map_file)
-            palette_data = read_file(palette_file)
+        for frame_idx, converted in enumerate(converted_frames):
+            print('\n'.join(converted['log']))
+
+            tiles_data = converted['tiles']
+            map_data = converted['map']
+            palette_data = converted['palette']
             
             if frame_idx == 0:
                 first_frame_palette_data = palette_data
@@ -293,8 +327,7 @@ def main():
             if args.mode == 'sprite':
                 # We need image dimensions to calculate X/Y
                 # Use quantized image dimensions
-                with Image.open(quantized_image) as img:
-                    w, h = img.size
+                w, h = converted['size']
                 
                 # Find empty tile ID to filter out
                 empty_id = find_empty_tile_id(tiles_data, args.bpp)
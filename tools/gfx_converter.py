@@ -5,6 +5,10 @@ import os
 import shutil
 import sys
 
+import gfxcache
+
+SUPERFAMICONV_OUTPUTS = ('palette', 'tiles', 'tilemap')
+
 def run_command(cmd):
     print(f"Running: {' '.join(cmd)}")
     try:
@@ -74,8 +78,18 @@ def to_windows_path(path):
             return path
     return path
 
-def convert_superfamiconv(input_file, output_base, bpp, palettes, tools_dir, pad_to_32x32=False):
+def convert_superfamiconv(input_file, output_base, bpp, palettes, tools_dir, pad_to_32x32=False, cache_dir=''):
     exe_path = os.path.join(tools_dir, "superfamiconv", "superfamiconv.exe")
+
+    cache_key = None
+    if cache_dir:
+        cache_key = get_superfamiconv_cache_key(input_file, bpp, palettes, exe_path, pad_to_32x32)
+        if gfxcache.fetch(cache_dir, cache_key, output_base, SUPERFAMICONV_OUTPUTS) is not None:
+            print(f"Cache hit, reused superfamiconv output for {input_file}")
+            return
+        # outputs may be hardlinks into the cache, superfamiconv and the padding write in place
+        for ext in SUPERFAMICONV_OUTPUTS:
+            gfxcache.removeFile(f"{output_base}.{ext}")
     
     print(f"DEBUG: palettes={palettes}, bpp={bpp}")
     
@@ -118,8 +132,20 @@ def convert_superfamiconv(input_file, output_base, bpp, palettes, tools_dir, pad
     if pad_to_32x32:
         pad_tilemap_to_32x32(map_file)
 
+    if cache_key:
+        gfxcache.store(cache_dir, cache_key, output_base, SUPERFAMICONV_OUTPUTS, {})
+
     print(f"Successfully converted using superfamiconv: {pal_file}, {chr_file}, {map_file}")
 
+def get_superfamiconv_cache_key(input_file, bpp, palettes, exe_path, pad_to_32x32):
+    """
+    Cache key of a superfamiconv conversion: input file contents, flags and the executable itself.
+    """
+    exe_key = gfxcache.getFileKey(exe_path) if os.path.isfile(exe_path) else ''
+    with open(input_file, 'rb') as f:
+        data = f.read()
+    return gfxcache.getKey('superfamiconv', exe_key, repr((bpp, palettes, pad_to_32x32)), data)
+
 def convert_gracon(input_file, output_base, bpp, tools_dir, unknown_args):
     script_path = os.path.join(tools_dir, "gracon.py")
     
@@ -156,6 +182,11 @@ def main():
     
     # Capture other arguments to pass through or ignore
     parser.add_argument("-palettes", type=int, help="Number of palettes (legacy)")
+
+    parser.add_argument("--cache-dir", default=gfxcache.getCacheDir(),
+                        help=f"Conversion cache folder shared between builds (default: ${gfxcache.CACHE_DIR_VARIABLE}, off if unset)")
+    parser.add_argument("--cache-size", type=int, default=512,
+                        help="Cache size cap in MB, least recently used entries are dropped first (default: 512)")
     
     # Use parse_known_args to handle unknown flags like -verify, -optimize, -mode
     args, unknown = parser.parse_known_args()
@@ -171,7 +202,9 @@ def main():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     
     if args.tool == "superfamiconv":
-        convert_superfamiconv(input_file, output_base, args.bpp, args.palettes, script_dir, args.pad_to_32x32)
+        convert_superfamiconv(input_file, output_base, args.bpp, args.palettes, script_dir, args.pad_to_32x32, args.cache_dir)
+        if args.cache_dir:
+            gfxcache.evict(args.cache_dir, args.cache_size * 1024 * 1024)
     elif args.tool == "gracon":
         if args.pad_to_32x32:
             print("Note: --pad-to-32x32 is ignored for gracon (already outputs 32x32)")
@@ -181,6 +214,8 @@ def main():
         pass_through_args = unknown
         if args.palettes:
             pass_through_args.extend(["-palettes", str(args.palettes)])
+        if args.cache_dir:
+            pass_through_args.extend(["-cachedir", args.cache_dir, "-cachesize", str(args.cache_size)])
             
         convert_gracon(input_file, output_base, args.bpp, script_dir, pass_through_args)
 
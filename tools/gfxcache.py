@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache for converted graphics.
+An entry is keyed by a hash of everything that determines the output (input
+pixels, output affecting options, converter source) and holds one file per
+output extension plus a small json with data the converter reports back.
+Hits are hardlinked into place (copied if the cache is on another device),
+entries are written to a temporary folder first and renamed into place, so
+several processes and machines may share one cache folder. The folder is
+trimmed to a size limit by dropping the least recently used entries.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+CACHE_DIR_VARIABLE = 'GRACON_CACHE_DIR'
+META_FILE = 'meta.json'
+
+
+def getCacheDir(cacheDir=''):
+    '''cache folder to use, falls back to $GRACON_CACHE_DIR. empty if caching is off'''
+    return cacheDir or os.environ.get(CACHE_DIR_VARIABLE, '')
+
+
+def getKey(*parts):
+    '''sha256 of all parts, str parts are utf-8 encoded'''
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part.encode('utf-8') if isinstance(part, str) else bytes(part)
+        digest.update(b'%d:' % len(data))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def getFileKey(*filenames):
+    '''key over the contents of files, e.g. converter source code'''
+    parts = []
+    for filename in filenames:
+        with open(filename, 'rb') as sourceFile:
+            parts.append(sourceFile.read())
+    return getKey(*parts)
+
+
+def getEntryDir(cacheDir, key):
+    return os.path.join(cacheDir, key[:2], key)
+
+
+def fetch(cacheDir, key, outfilebase, exts):
+    '''puts the cached outputs of key at outfilebase.ext, returns the stored meta data or None on a miss.
+    either all outputs are replaced or none'''
+    entryDir = getEntryDir(cacheDir, key)
+    tempFiles = []
+    try:
+        with open(os.path.join(entryDir, META_FILE), 'r') as metaFile:
+            meta = json.load(metaFile)
+        for ext in exts:
+            tempFile = "%s.%s.%s.tmp" % (outfilebase, ext, os.getpid())
+            linkOrCopy(os.path.join(entryDir, ext), tempFile)
+            tempFiles.append((tempFile, "%s.%s" % (outfilebase, ext)))
+    except (IOError, OSError, ValueError):
+        for tempFile, outFile in tempFiles:
+            removeFile(tempFile)
+        return None
+    now = time.time()
+    for tempFile, outFile in tempFiles:
+        os.replace(tempFile, outFile)
+        # hardlinks share the cached timestamp, outputs must look newer than their inputs to make
+        os.utime(outFile, (now, now))
+    touch(entryDir, now)
+    return meta
+
+
+def store(cacheDir, key, outfilebase, exts, meta):
+    '''copies outfilebase.ext into the entry of key. an entry that already exists is kept'''
+    entryDir = getEntryDir(cacheDir, key)
+    if os.path.isdir(entryDir):
+        return
+    tempDir = "%s.%s.tmp" % (entryDir, os.getpid())
+    try:
+        os.makedirs(tempDir)
+        for ext in exts:
+            shutil.copyfile("%s.%s" % (outfilebase, ext), os.path.join(tempDir, ext))
+        with open(os.path.join(tempDir, META_FILE), 'w') as metaFile:
+            json.dump(meta, metaFile)
+        os.rename(tempDir, entryDir)
+    except (IOError, OSError):
+        # another process stored the same entry meanwhile, or the cache is not writable
+        shutil.rmtree(tempDir, ignore_errors=True)
+
+
+def evict(cacheDir, maxBytes):
+    '''removes least recently used entries until the cache holds at most maxBytes, returns the removed count'''
+    entries = getEntries(cacheDir)
+    totalBytes = sum(size for lastUse, size, entryDir in entries)
+    removed = 0
+    for lastUse, size, entryDir in sorted(entries):
+        if totalBytes <= maxBytes:
+            break
+        shutil.rmtree(entryDir, ignore_errors=True)
+        totalBytes -= size
+        removed += 1
+    return removed
+
+
+def getEntries(cacheDir):
+    '''(last use, size in bytes, folder) of all complete entries'''
+    entries = []
+    if not os.path.isdir(cacheDir):
+        return entries
+    for prefix in os.scandir(cacheDir):
+        if not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            if not entry.is_dir() or entry.name.endswith('.tmp'):
+                continue
+            try:
+                size = sum(item.stat().st_size for item in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue
+    return entries
+
+
+def linkOrCopy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        if not os.path.isfile(source):
+            raise
+        shutil.copyfile(source, target)
+
+
+def touch(path, now):
+    try:
+        os.utime(path, (now, now))
+    except OSError:
+        pass
+
+
+def removeFile(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+
+__all__ = ["getCacheDir", "getKey", "getFileKey", "fetch", "store", "evict"]
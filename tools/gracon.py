@@ -1,34 +1,36 @@
 #!/usr/bin/env python3
 
 import userOptions
+import quantizer
+import snescolor
+import vptree
+import gfxcache
+import snesgfx
 from PIL import ImageFont
 from PIL import ImageDraw
 from PIL import Image
+import numpy as np
 import logging
 import time
 import math
+import copy
+import io
+import json
+import concurrent.futures
 import sys
 import os
 from functools import cmp_to_key
+try:
+    import resource
+except ImportError:
+    # windows, peak memory is not reported there
+    resource = None
 __author__ = "Matthias Nagler <matt@dforce.de>"
 __url__ = ("dforce3000", "dforce3000.de")
 __version__ = "0.1"
 
-'''
-optimizations:
--flatten tile dict
-  tile['data']
-  
--flatten pixel arrays
-  tile['data']['pixel']
-  tile['data']['indexedPixel']
-  
-
-'''
-
 '''
 todo:
--check if images spanning multiple tilemaps have their tilemaps selected properly. probably not.
 -have usage string if no parameter supplied or if parameter of unknown type found
 '''
 
@@ -38,11 +40,20 @@ convert graphics to snes bitplane format
 options:
 -bpp [1/2/4/8] (color depth mode, default: 4bpp)
 -palnum [1-8] (maximum amount of palettes to allow, default: 1)
--mode [sprite|bg] (bg mode outputs tilemap, sprite mode outputs relative tilemap for 8x8 tiles)
+-mode [sprite|bg] (bg mode outputs tilemap, sprite mode outputs relative tilemap for 8x8 tiles. images larger than 32x32 tiles get one 32x32 tilemap per screen, stored row by row: 64x32, 32x64 and 64x64 screen layouts load as is)
 -optimize [on|off] (don't rearrange tiles & don't output tilemap, default: on)
 -transcol 0x[15bit transparent color] (every pixel having this color AFTER reducing image colordepth to snes 15bit format will be considered transparent. format: -bbbbbgg gggrrrrr default: 0x7C1F (pink))
+-spritesizes [8x8_16x16|8x8_32x32|...|32x32_64x64] (sprite mode only: cover the image with small and large OBJs of that OBJSEL size pair, using as few OBJs as possible. large OBJ tiles are laid out on the 16 tile wide OBJ name grid, an additional .objsize file holds the size bits of all OBJs in OAM high table format. default: off, fixed tilesize OBJs)
 -tilethreshold [int] (total difference in pixel color acceptable for two tiles to be considered the same. Cranking this value up potentially results in fewer tiles used in the converted image. this is meant to help identify parts of the image that may be optimized. default: 0)
+-tilesearch [exact|indexed] (exact compares every tile against all earlier tiles. indexed only compares against the earlier tiles closest in a reduced feature space, much faster on large images but may miss the best match. default: exact)
+-quantizer [nearestpair|mediancut|kmeans] (how the global palette is reduced to fit bpp and palettes. nearestpair drops the later color of the closest pair until it fits, mediancut and kmeans average pixel-weighted color clusters. default: nearestpair)
+-prereduce [on|off] (with -quantizer nearestpair, first reduce the image to the palette color count with PIL's adaptive palette. off skips that step and leaves the whole reduction to nearestpair, which is slower on images with many colors. default: on)
+-palettesolver [hue|tiles] (hue cuts the hue sorted global palette into consecutive palettes. tiles groups tiles by the colors they use and builds each palette from the colors of its tiles, refined over -paletteiterations rounds or until -palettetimelimit seconds passed. default: hue)
 -verify [on|off] (additionaly output converted image in png format(useful to verify that converted image looks fine)
+-metrics [file] (write json metrics of every converted image: wall time per stage, peak resident memory, tile counts before and after optimization, maxtiles threshold retries, final tilethreshold and rms palette error. default: a file per run inside $GRACON_METRICS_DIR, off if unset. tools/metrics_report.py merges them into a build report)
+-cachedir [folder] (reuse outputs of earlier conversions with identical pixels and options, default: $GRACON_CACHE_DIR, off if unset. -cachesize [MB] caps the folder, least recently used entries are dropped first. default: 512)
+
+-inlist [file] / -indir [folder] (batch mode: converts all listed images or all images of a folder in one process, -outdir [folder] sets where their outputs go, -jobs [int] spreads frames over that many worker processes)
 
 possible input formats are: all supported by python Image module (png, gif, etc.)
 input image alpha channel or transparency(gif/png) is dismissed completely. Relevant to transparent color of converted image is option -transcol" and nothing else.
@@ -87,6 +98,41 @@ INFINITY = 1e300000
 BG_TILEMAP_SIZE = 32
 LOOKBACK_TILES = 128
 EMPTY_COLOR = 0
+NO_REF = -1
+BATCH_FRAME_FILETYPES = ('.png', '.gif', '.bmp')
+METRICS_DIR_VARIABLE = 'GRACON_METRICS_DIR'
+# small and large OBJ edge length of the square OBJSEL size pairs, see -spritesizes
+SPRITE_SIZE_PAIRS = {
+    '8x8_16x16': (8, 16),
+    '8x8_32x32': (8, 32),
+    '8x8_64x64': (8, 64),
+    '16x16_32x32': (16, 32),
+    '16x16_64x64': (16, 64),
+    '32x32_64x64': (32, 64)
+}
+# OBJ tile numbers are laid out on a 16 tile wide grid, large OBJs span tile n, n+1, n+16...
+OBJ_NAME_GRID_WIDTH = snesgfx.OBJ_NAME_GRID_WIDTH
+# batch options of a -jobs worker process, see initConversionWorker
+workerOptions = None
+# options that change the output files, the conversion cache key is built from them
+CACHE_KEY_OPTIONS = ('bpp', 'palettes', 'mode', 'optimize', 'directcolor', 'transcol', 'tilethreshold', 'verify',
+                     'tilesizex', 'tilesizey', 'maxtiles', 'spritesizes', 'tilesearch', 'quantizer', 'prereduce', 'palettesolver',
+                     'paletteiterations', 'palettetimelimit')
+# Statistics fields kept with a cache entry
+CACHE_STATISTICS = ('totalTiles', 'actualTiles', 'actualPalettes', 'thresholdRetries', 'paletteError')
+# converter modules, editing any of them invalidates the conversion cache
+CACHE_SOURCE_FILES = tuple(os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+                           for name in ('gracon.py', 'quantizer.py', 'snescolor.py', 'vptree.py', 'snesgfx.py'))
+# order in which mirrored variants of a tile are compared, (xMirror, yMirror)
+MIRROR_CONFIGS = ((False, False), (True, False), (False, True), (True, True))
+# tiles compared against all earlier tiles at once, small enough to stay in cache
+TILE_BLOCK_SIZE = 32
+# nearest tiles in feature space per mirror config that get an exact comparison with -tilesearch indexed
+INDEXED_SEARCH_NEIGHBOURS = 8
+# tiles checked against exact search to report how often -tilesearch indexed differs
+TILE_SEARCH_SAMPLES = 64
+# approximate redmean channel weights (r, g, b) for tile features
+REDMEAN_FEATURE_WEIGHTS = np.sqrt(np.array((528, 1024, 751)) / 256)
 
 
 def print_usage():
@@ -100,15 +146,344 @@ def print_usage():
     print("  -verify <on/off>      Verify output (default: off)")
     print("  -transcol <hex>       Transparent color (default: 0x7C1F)")
     print("  -tilethreshold <int>  Tile optimization threshold (default: 1)")
+    print("  -spritesizes <pair>   Sprite mode: pack into small/large OBJs of an OBJSEL pair, e.g. 8x8_16x16 (default: off)")
+    print("  -tilesearch <exact/indexed> Similar tile search, indexed is faster but approximate (default: exact)")
+    print("  -quantizer <nearestpair/mediancut/kmeans> Global palette color reduction (default: nearestpair)")
+    print("  -palettesolver <hue/tiles> Split colors into palettes by hue or by tile usage (default: hue)")
+    print("  -prereduce <on/off>   Reduce image colors with PIL before -quantizer nearestpair (default: on)")
+    print("  -paletteiterations <int> Refinement rounds of -palettesolver tiles (default: 10)")
+    print("  -palettetimelimit <sec> Time limit of -palettesolver tiles, 0 is unlimited (default: 0)")
+    print("  -inlist <file>        Convert every image listed in file, one per line, optionally <tab>outfilebase")
+    print("  -indir <folder>       Convert every image in folder")
+    print("  -outdir <folder>      Output folder of -inlist/-indir frames (default: next to each image)")
+    print("  -jobs <int>           Worker processes converting -inlist/-indir frames in parallel (default: 1)")
+    print("  -cachedir <folder>    Conversion cache, hits are linked into place (default: $GRACON_CACHE_DIR, off if unset)")
+    print("  -cachesize <MB>       Size cap of the conversion cache, least recently used entries go first (default: 512)")
+    print("  -metrics <file>       Write stage timings, peak memory and tile counts as json (default: one file per run in $GRACON_METRICS_DIR, off if unset)")
     print("\nExample:")
     print("  python gracon.py -infile myimage.png -mode bg -bpp 4 -verify on")
+    print("  python gracon.py -indir frames/ -outdir build/frames -mode bg -bpp 4")
 
 def main():
     if len(sys.argv) == 1 or any(arg in sys.argv for arg in ['-h', '--help', '-help']):
         print_usage()
         sys.exit(0)
 
-    options = userOptions.Options(sys.argv, {
+    options = parseOptions(sys.argv)
+
+    if options.get('directcolor'):
+        options.set('bpp', 8)
+        options.set('palettes', 1)
+
+    if options.get('tilesearch') not in ('exact', 'indexed'):
+        logging.error('Error, invalid tile search "%s", allowed are exact and indexed.' % options.get('tilesearch'))
+        sys.exit(1)
+
+    checkSpriteSizes(options)
+
+    startTime = time.perf_counter()
+    if options.get('inlist') or options.get('indir'):
+        writeMetrics(convertMany(getBatchFrames(options), options), startTime, options)
+        trimCache(options)
+        return
+
+    if not options.get('outfilebase'):
+        options.set('outfilebase', options.get('infile'))
+
+    if not options.get('infile'):
+        print_usage()
+        sys.exit(1)
+
+    writeMetrics([convertImage(options)], startTime, options)
+    trimCache(options)
+
+
+def convertImage(options):
+    '''converts infile to outfilebase.tiles/.tilemap/.palette, returns conversion statistics'''
+    t0 = time.perf_counter()
+    cacheDir = gfxcache.getCacheDir(options.get('cachedir'))
+    cacheKey = getCacheKey(options) if cacheDir else None
+    if cacheKey:
+        stats = fetchCachedConversion(cacheDir, cacheKey, options, t0)
+        if stats:
+            return stats
+
+    stages = {}
+    inputImage = getInputImage(options, options.get('infile'))
+    stages['load'] = time.perf_counter() - t0
+    logging.info(f"Input image loaded and reduced in {stages['load']:.2f}s")
+
+    t1 = time.perf_counter()
+    tiles = parseTiles(inputImage, options)
+    stages['parse'] = time.perf_counter() - t1
+    logging.info(f"Tiles parsed in {stages['parse']:.2f}s")
+
+    t2 = time.perf_counter()
+    optimizedPalette = parseGlobalPalettes(tiles, options)
+    stages['palettes'] = time.perf_counter() - t2
+    logging.info(f"Global palettes parsed in {stages['palettes']:.2f}s")
+
+    t3 = time.perf_counter()
+    palettizedTiles = palettizeTiles(tiles, optimizedPalette)
+    stages['palettize'] = time.perf_counter() - t3
+    logging.info(f"Tiles palettized in {stages['palettize']:.2f}s")
+
+    # stupid hack that ensures certain amount of tiles are never exceeded for any given picture
+    thresholdRetries = 0
+    if options.get('optimize'):
+        t4 = time.perf_counter()
+        candidates = findDuplicateCandidates(palettizedTiles, options)
+        threshold = getMaxTilesThreshold(candidates, options.get('tilethreshold'), options.get('maxtiles'))
+        if threshold is None:
+            logging.error('Error, image can not be reduced to maxtiles %s.' % options.get('maxtiles'))
+            sys.exit(1)
+        if threshold != options.get('tilethreshold'):
+            logging.info('maxtiles %s exceeded, raised threshold from %s to %s.' % (
+                options.get('maxtiles'), options.get('tilethreshold'), threshold))
+            # the former retry loop raised the threshold by 3 per attempt
+            thresholdRetries = (threshold - options.get('tilethreshold')) // 3
+            options.set('tilethreshold', threshold)
+        optimizedTiles = applyDuplicateCandidates(palettizedTiles, candidates, threshold)
+        stages['optimize'] = time.perf_counter() - t4
+        logging.info(f"Tiles optimized in {stages['optimize']:.2f}s")
+    else:
+        optimizedTiles = palettizedTiles
+
+    # optimizedTiles = optimizeTiles( palettizedTiles, options ) if options.get('optimize') else palettizedTiles
+
+    # debugLogTileStatus(optimizedTiles)
+
+    t5 = time.perf_counter()
+    writeOutputFiles(optimizedTiles, optimizedPalette, inputImage, options)
+    stages['write'] = time.perf_counter() - t5
+    logging.info(f"Output files written in {stages['write']:.2f}s")
+
+    stats = Statistics(optimizedTiles, optimizedPalette, t0)
+    stats.thresholdRetries = thresholdRetries
+    # only -metrics reports it, normal builds skip the extra pass
+    stats.paletteError = getPaletteError(inputImage, palettizedTiles, options) if metricsEnabled(options) else None
+    stats.metrics = getMetricsRecord(stats, stages, options)
+    logging.info('conversion complete, optimized from %s to %s tiles, %s palettes used. Wasted %s seconds' % (
+        stats.totalTiles, stats.actualTiles, stats.actualPalettes, stats.timeWasted))
+    if cacheKey:
+        storeCachedConversion(cacheDir, cacheKey, stats, options)
+    return stats
+
+
+def getPaletteError(image, palettizedTiles, options):
+    '''root mean square 8 bit rgb channel error of the palettized unique tiles against the unreduced source,
+    transparent source pixels left out'''
+    unique = np.flatnonzero(palettizedTiles.refId == NO_REF)
+    tileSizeY, tileSizeX = palettizedTiles.pixel.shape[1:]
+    source = getPixelArray({
+        'resolutionX': image['resolutionX'],
+        'resolutionY': image['resolutionY'],
+        'pixels': image['sourcePixels']
+    }, *getTileArea(image, options), options)
+    yPos = palettizedTiles.y[unique].reshape(-1, 1, 1) + np.arange(tileSizeY).reshape(1, -1, 1)
+    xPos = palettizedTiles.x[unique].reshape(-1, 1, 1) + np.arange(tileSizeX).reshape(1, 1, -1)
+    sourcePixels = source[yPos, xPos]
+    opaque = sourcePixels != options.get('transcol')
+    if not opaque.any():
+        return 0.0
+    difference = (snesgfx.toRGB(palettizedTiles.pixel[unique][opaque]).astype(np.int32)
+                  - snesgfx.toRGB(sourcePixels[opaque]))
+    return math.sqrt(float(np.mean(difference * difference)))
+
+
+def getMetricsRecord(stats, stages, options, cached=False):
+    '''metrics of one conversion, see -metrics'''
+    return {
+        'infile': options.get('infile'),
+        'outfilebase': options.get('outfilebase'),
+        'mode': options.get('mode'),
+        'cached': cached,
+        'seconds': stats.timeWasted,
+        'stages': stages,
+        'peakRssKb': getPeakRss(),
+        'totalTiles': stats.totalTiles,
+        'actualTiles': stats.actualTiles,
+        'actualPalettes': stats.actualPalettes,
+        'tileThreshold': options.get('tilethreshold'),
+        'thresholdRetries': stats.thresholdRetries,
+        'paletteError': stats.paletteError
+    }
+
+
+def getPeakRss():
+    '''peak resident set size of this process in kB, None where unknown'''
+    if resource is None:
+        return None
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB everywhere else
+    return peakRss // 1024 if sys.platform == 'darwin' else peakRss
+
+
+def metricsEnabled(options):
+    return bool(options.get('metrics') or os.environ.get(METRICS_DIR_VARIABLE, ''))
+
+
+def getMetricsFile(options):
+    '''-metrics file, else one file per invocation inside $GRACON_METRICS_DIR. empty if metrics are off'''
+    if options.get('metrics'):
+        return options.get('metrics')
+    if not metricsEnabled(options):
+        return ''
+    metricsDir = os.environ.get(METRICS_DIR_VARIABLE, '')
+    target = os.path.abspath(options.get('inlist') or options.get('indir') or options.get('outfilebase'))
+    return os.path.join(metricsDir, '%s.%s.json' % (os.path.basename(target), gfxcache.getKey(target)[:12]))
+
+
+def writeMetrics(results, startTime, options):
+    '''json metrics of all conversions of this invocation'''
+    filename = getMetricsFile(options)
+    if not filename:
+        return
+    metrics = {
+        'tool': 'gracon',
+        'seconds': time.perf_counter() - startTime,
+        'jobs': options.get('jobs'),
+        'peakRssKb': getPeakRss(),
+        'frames': [stats.metrics for stats in results]
+    }
+    try:
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tempName = '%s.%s.tmp' % (filename, os.getpid())
+        with open(tempName, 'w') as metricsFile:
+            json.dump(metrics, metricsFile, indent=1)
+        os.replace(tempName, filename)
+    except OSError:
+        logging.error('unable to write metrics file %s' % filename)
+        sys.exit(1)
+
+
+def getCacheKey(options):
+    '''hash of converter source, output affecting options and input pixels. None if the input can not be read,
+    getInputImage reports that'''
+    parts = [gfxcache.getFileKey(*CACHE_SOURCE_FILES), repr([(name, options.get(name)) for name in CACHE_KEY_OPTIONS])]
+    for filename in (options.get('infile'), options.get('refpalette')):
+        if not filename:
+            parts.append('')
+            continue
+        try:
+            image = Image.open(filename)
+            parts.extend(('%sx%s' % image.size, image.convert('RGBA').tobytes()))
+        except IOError:
+            return None
+    return gfxcache.getKey(*parts)
+
+
+def getOutputExtensions(options):
+    '''files written by writeOutputFiles'''
+    exts = ['tiles', 'tilemap']
+    if not options.get('directcolor'):
+        exts.append('palette')
+        if options.get('verify'):
+            exts.append('sample_palette.png')
+    if options.get('mode') == 'sprite' and options.get('spritesizes'):
+        exts.append('objsize')
+    if options.get('verify'):
+        exts.append('sample.png')
+    return exts
+
+
+def fetchCachedConversion(cacheDir, cacheKey, options, startTime):
+    meta = gfxcache.fetch(cacheDir, cacheKey, options.get('outfilebase'), getOutputExtensions(options))
+    if meta is None:
+        return None
+    # same side effects on options as a real conversion
+    for name in ('resolutionx', 'resolutiony', 'tilethreshold'):
+        options.set(name, meta[name])
+    stats = Statistics.__new__(Statistics)
+    stats.__dict__ = {name: meta[name] for name in CACHE_STATISTICS}
+    stats.timeWasted = time.perf_counter() - startTime
+    stats.metrics = getMetricsRecord(stats, {'cache': stats.timeWasted}, options, cached=True)
+    logging.info('conversion cache hit, %s tiles, %s palettes used.' % (stats.actualTiles, stats.actualPalettes))
+    return stats
+
+
+def storeCachedConversion(cacheDir, cacheKey, stats, options):
+    meta = {name: options.get(name) for name in ('resolutionx', 'resolutiony', 'tilethreshold')}
+    meta.update({name: getattr(stats, name) for name in CACHE_STATISTICS})
+    gfxcache.store(cacheDir, cacheKey, options.get('outfilebase'), getOutputExtensions(options), meta)
+
+
+def trimCache(options):
+    cacheDir = gfxcache.getCacheDir(options.get('cachedir'))
+    if cacheDir:
+        removed = gfxcache.evict(cacheDir, options.get('cachesize') * 1024 * 1024)
+        if removed:
+            logging.info('dropped %s least recently used entries from conversion cache.' % removed)
+
+
+def convertMany(frames, options):
+    '''converts (infile, outfilebase) pairs, in this process or spread over -jobs worker processes
+
+    module level color tables stay loaded between frames. every frame gets its own copy of
+    options, so per image adjustments like a raised tilethreshold do not leak into the next one.
+    outputs are written as soon as each frame is done, results come back in frame order'''
+    startTime = time.perf_counter()
+    jobs = min(options.get('jobs'), len(frames))
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=initConversionWorker, initargs=(options,)) as executor:
+            results = list(executor.map(convertFrame, frames))
+    else:
+        results = [convertFrame(frame, options) for frame in frames]
+    logging.info('batch complete, converted %s frames in %.2f seconds.' % (len(results), time.perf_counter() - startTime))
+    return results
+
+
+def initConversionWorker(options):
+    '''runs once per worker process, keeps the batch options so that tasks only carry file names.
+    the color tables are built on import and only ever read'''
+    global workerOptions
+    workerOptions = options
+
+
+def convertFrame(frame, options=None):
+    infile, outfilebase = frame
+    frameOptions = copy.deepcopy(workerOptions if options is None else options)
+    frameOptions.set('infile', infile)
+    frameOptions.set('outfilebase', outfilebase)
+    return convertImage(frameOptions)
+
+
+def getBatchFrames(options):
+    '''(infile, outfilebase) pairs from -inlist or -indir
+
+    inlist has one input image per line, optionally followed by a tab and the output file base.
+    without one, or for indir images, the output file base is the image name without extension,
+    placed in -outdir if given or next to the image otherwise'''
+    if options.get('inlist'):
+        try:
+            with open(options.get('inlist'), 'r') as listFile:
+                entries = [line.rstrip('\r\n').split('\t') for line in listFile if line.strip()]
+        except IOError:
+            logging.error('Error, unable to read input list %s.' % options.get('inlist'))
+            sys.exit(1)
+    else:
+        if not os.path.isdir(options.get('indir')):
+            logging.error('Error, input folder "%s" is nonexistant.' % options.get('indir'))
+            sys.exit(1)
+        entries = [[os.path.join(options.get('indir'), name)] for name in sorted(os.listdir(options.get('indir')))
+                   if os.path.splitext(name)[1].lower() in BATCH_FRAME_FILETYPES]
+
+    frames = []
+    for entry in entries:
+        infile = entry[0]
+        if len(entry) > 1 and entry[1]:
+            outfilebase = entry[1]
+        else:
+            outfilebase = os.path.splitext(infile)[0]
+            if options.get('outdir'):
+                outfilebase = os.path.join(options.get('outdir'), os.path.basename(outfilebase))
+        frames.append((infile, outfilebase))
+    return frames
+
+
+def parseOptions(args):
+    return userOptions.Options(args, {
         'bpp': {
             'value': 4,
             'type': 'int',
@@ -171,6 +546,10 @@ def main():
             'value': '',
             'type': 'str'
         },
+        'spritesizes': {
+            'value': '',
+            'type': 'str'
+        },
         'infile': {
             'value': '',
             'type': 'str'
@@ -191,69 +570,80 @@ def main():
             'max': 0xffff,
             'min': 1
         },
+        'tilesearch': {
+            'value': 'exact',
+            'type': 'str'
+        },
+        'quantizer': {
+            'value': 'nearestpair',
+            'type': 'str'
+        },
+        'palettesolver': {
+            'value': 'hue',
+            'type': 'str'
+        },
+        'prereduce': {
+            'value': True,
+            'type': 'bool'
+        },
+        'inlist': {
+            'value': '',
+            'type': 'str'
+        },
+        'indir': {
+            'value': '',
+            'type': 'str'
+        },
+        'outdir': {
+            'value': '',
+            'type': 'str'
+        },
+        'jobs': {
+            'value': 1,
+            'type': 'int',
+            'max': 256,
+            'min': 1
+        },
+        'cachedir': {
+            'value': '',
+            'type': 'str'
+        },
+        'cachesize': {
+            'value': 512,
+            'type': 'int',
+            'max': 0xfffff,
+            'min': 1
+        },
+        'metrics': {
+            'value': '',
+            'type': 'str'
+        },
+        'paletteiterations': {
+            'value': 10,
+            'type': 'int',
+            'max': 1000,
+            'min': 0
+        },
+        'palettetimelimit': {
+            'value': 0.0,
+            'type': 'float',
+            'max': 3600.0,
+            'min': 0.0
+        },
     })
-    t0 = time.perf_counter()
-
-    if options.get('directcolor'):
-        options.set('bpp', 8)
-        options.set('palettes', 1)
-
-    if not options.get('outfilebase'):
-        options.set('outfilebase', options.get('infile'))
-
-    if not options.get('infile'):
-        print_usage()
-        sys.exit(1)
-
-    inputImage = getInputImage(options, options.get('infile'))
-    logging.info(f"Input image loaded and reduced in {time.perf_counter() - t0:.2f}s")
-    
-    t1 = time.perf_counter()
-    tiles = parseTiles(inputImage, options)
-    logging.info(f"Tiles parsed in {time.perf_counter() - t1:.2f}s")
-
-    t2 = time.perf_counter()
-    optimizedPalette = parseGlobalPalettes(tiles, options)
-    logging.info(f"Global palettes parsed in {time.perf_counter() - t2:.2f}s")
-
-    t3 = time.perf_counter()
-    palettizedTiles = palettizeTiles(tiles, optimizedPalette)
-    logging.info(f"Tiles palettized in {time.perf_counter() - t3:.2f}s")
-
-    # stupid hack that ensures certain amount of tiles are never exceeded for any given picture
-    if options.get('optimize'):
-        t4 = time.perf_counter()
-        optimizedTiles = optimizeTiles(palettizedTiles, options)
-        logging.info(f"Tiles optimized in {time.perf_counter() - t4:.2f}s")
-        while len([tile for tile in optimizedTiles if tile['refId'] == None]) > options.get('maxtiles'):
-            options.set('tilethreshold', options.get('tilethreshold') + 3)
-            logging.info('maxtiles %s exceed, running again with threshold %s.' % (
-                options.get('maxtiles'), options.get('tilethreshold')))
-            optimizedTiles = optimizeTiles(palettizedTiles, options)
-    else:
-        optimizedTiles = palettizedTiles
-
-    # optimizedTiles = optimizeTiles( palettizedTiles, options ) if options.get('optimize') else palettizedTiles
-
-    # debugLogTileStatus(optimizedTiles)
-
-    t5 = time.perf_counter()
-    writeOutputFiles(optimizedTiles, optimizedPalette, inputImage, options)
-    logging.info(f"Output files written in {time.perf_counter() - t5:.2f}s")
-
-    stats = Statistics(optimizedTiles, optimizedPalette, t0)
-    logging.info('conversion complete, optimized from %s to %s tiles, %s palettes used. Wasted %s seconds' % (
-        stats.totalTiles, stats.actualTiles, stats.actualPalettes, stats.timeWasted))
-
 
 def debugLogTileStatus(tiles):
-    for tile in tiles:
+    for tileId in range(len(tiles)):
         debugLog({
-            'id': tile['id'],
-            'refId': tile['refId'],
-            'xMirror': tile['xMirror'],
-            'yMirror': tile['yMirror'],
-        }, 'tile %s' % tile['id'])
+            'id': tileId,
+            'refId': int(tiles.refId[tileId]),
+            'xMirror': bool(tiles.xMirror[tileId]),
+            'yMirror': bool(tiles.yMirror[tileId]),
+        }, 'tile %s' % tileId)
+
+
+def countUniqueTiles(tiles):
+    return int(np.count_nonzero(tiles.refId == NO_REF))
 
 
 def getReferencePaletteImage(options):
@@ -265,30 +655,38 @@ def writeOutputFiles(tiles, palettes, image, options):
     outPalettes = augmentOutIds(palettes)
 
     # writeTiles( outTiles, options )
-    tileFile = getOutputFile(options, ext='tiles')
-    tileFile.write(getTileWriteStream(outTiles, options))
-    tileFile.close()
+    tileStream = getTileWriteStream(outTiles, options)
+    writeOutputFile(options, 'tiles', tileStream)
 
+    paletteStream = b''
     if not options.get('directcolor'):
         # writePalettes( outPalettes, options )
-        palFile = getOutputFile(options, ext='palette')
-        palFile.write(getPaletteWriteStream(outPalettes, options))
-        palFile.close()
+        paletteStream = getPaletteWriteStream(outPalettes, options)
+        writeOutputFile(options, 'palette', paletteStream)
         if options.get('verify'):
-            writeSamplePalette(outPalettes, options)
+            writeSamplePalette(paletteStream, options)
 
     # writeTileMap( outTiles, outPalettes, options )
-    tilemapFile = getOutputFile(options, ext='tilemap')
     tilemapStream = getSpriteTileMapStream(tiles, palettes, options) if options.get(
         'mode') == 'sprite' else getBgTileMapStream(tiles, palettes, options)
-    tilemapFile.write(tilemapStream)
-    tilemapFile.close()
+    writeOutputFile(options, 'tilemap', tilemapStream)
+    objSizeStream = b''
+    if options.get('mode') == 'sprite' and options.get('spritesizes'):
+        objSizeStream = getObjSizeStream(tiles, options)
+        writeOutputFile(options, 'objsize', objSizeStream)
 
     if options.get('verify'):
-        writeSampleImage(outTiles, outPalettes, image, options)
+        writeSampleImage(tileStream, tilemapStream, paletteStream, objSizeStream, image, options)
 
 
 def augmentOutIds(elements):
+    if isinstance(elements, TileSet):
+        unique = elements.refId == NO_REF
+        elements.outId = np.where(unique, np.cumsum(unique) - 1, NO_REF).astype(np.int32)
+        if hasObjGroups(elements):
+            elements.outId = getObjGridOutIds(elements)
+        return elements
+
     outElements = []
     outId = 0
     for element in elements:
@@ -302,195 +700,159 @@ def augmentOutIds(elements):
     return outElements
 
 
-def writeSamplePalette(palettes, options):
-    '''ugly hack, used to provide output sample w/o having to load the created files in an SNES program'''
-    realPalettes = [pal for pal in palettes if pal['refId'] == None]
-    sample = Image.new("RGB", (2 ** options.get('bpp'), len(realPalettes)),
-                       convertColorSnesToRGB(options.get('transcol')))
-    for yPos in range(len(realPalettes)):
-        for xPos in range(2 ** options.get('bpp')):
-            try:
-                color = realPalettes[yPos]['color'][xPos]
-            except IndexError:
-                color = EMPTY_COLOR
-            sample.putpixel((xPos, yPos), convertColorSnesToRGB(color))
-    outFileName = "%s.%s" % (options.get('outfilebase'), 'sample_palette.png')
-    sample.save(outFileName, 'PNG')
-
-
-def writeSampleImage(tiles, palettes, image, options):
-    '''ugly hack, used to provide output sample w/o having to load the created files in an SNES program'''
-    sample = Image.new("RGB", (image['resolutionX'], image['resolutionY']),
-                       convertColorSnesToRGB(options.get('transcol')))
-    for tile in tiles:
-        tileConfig = fetchTileConfig(tile, tiles, palettes)
-        if not options.get('directcolor'):
-            # hack, copy pixels of referenced tile into current tile
-            tile['pixel'] = tiles[tileConfig['tileId']]['indexedPixel']
-
-        actualTile = mirrorTile(
-            tile, {'x': tileConfig['xMirror'], 'y': tileConfig['yMirror']})
-        actualPalette = palettes[tileConfig['palId']]
-        for yPos in range(len(actualTile['pixel'])):
-            for xPos in range(len(actualTile['pixel'][yPos])):
-                if options.get('directcolor'):
-                    # source: -bbbbbgg gggrrrrr target: -bb---gg g--rrr--
-                    pixel = actualTile['pixel'][yPos][xPos] & 0x639c
-                else:
-                    colorIndex = actualTile['pixel'][yPos][xPos]
-                    try:
-                        pixel = actualPalette['color'][colorIndex]
-                    except IndexError:
-                        debugLog(actualPalette,
-                                 'bad palette index %s requested' % colorIndex)
-                        pixel = EMPTY_COLOR
-                pixelColor = convertColorSnesToRGB(pixel)
-                pixelPos = (actualTile['x']+xPos, actualTile['y']+yPos)
-                try:
-                    sample.putpixel(pixelPos, pixelColor)
-                except IndexError:
-                    debugLog(pixelPos, 'bad pixel position')
-    outFileName = "%s.%s" % (options.get('outfilebase'), 'sample.png')
-    # logging.debug("wrote sample image '%s'." % outFileName)
-    sample.save(outFileName, 'PNG')
-
+def writeSamplePalette(paletteStream, options):
+    '''palette file as image, one row per palette'''
+    sample = snesgfx.toRGB(snesgfx.decodePalettes(paletteStream, options.get('bpp')))
+    writeOutputImage(options, 'sample_palette.png', Image.fromarray(sample, 'RGB'))
 
-def parseTiles(image, options):
-    return parseSpriteTiles(image, options) if options.get('mode') == 'sprite' else parseBgTiles(image, options)
 
-
-def writeTileMap(tiles, palettes, options):
+def writeSampleImage(tileStream, tilemapStream, paletteStream, objSizeStream, image, options):
+    '''decodes the written files back into an image and reports how far it is off the source'''
+    renderOptions = {
+        'tileSizeX': options.get('tilesizex'),
+        'tileSizeY': options.get('tilesizey'),
+        'directColor': options.get('directcolor'),
+        'transcol': options.get('transcol')
+    }
     if options.get('mode') == 'sprite':
-        writeSpriteTileMap(tiles, palettes, options)
+        pixels = snesgfx.renderSprites(tileStream, tilemapStream, paletteStream, image['resolutionX'], image['resolutionY'],
+                                       options.get('bpp'), objSizes=SPRITE_SIZE_PAIRS.get(options.get('spritesizes')),
+                                       objSizeData=objSizeStream, **renderOptions)
     else:
-        writeBgTileMap(tiles, palettes, options)
+        pixels = snesgfx.renderBg(tileStream, tilemapStream, paletteStream, image['resolutionX'], image['resolutionY'],
+                                  options.get('bpp'), **renderOptions)
+    sample = snesgfx.toRGB(pixels)
+    psnr, maxError = getSampleError(sample, image['sourcePixels'])
+    logging.info('verified written files: psnr %.2f dB, max channel error %s.' % (psnr, maxError))
+    # logging.debug("wrote sample image '%s.sample.png'." % options.get('outfilebase'))
+    writeOutputImage(options, 'sample.png', Image.frombuffer('RGB', (sample.shape[1], sample.shape[0]), sample, 'raw', 'RGB', 0, 1))
 
 
-def getBgTileMapStream(tiles, palettes, options):
-    '''writes successive blocks of 32x32 tile tilemaps'''
-    stream = []
-    bgTilemaps = getBgTilemaps(tiles, palettes, options)
-    for tile in [tile for tilemap in bgTilemaps for tile in tilemap]:
-        stream.append(bytes([tile & 0xff]))
-        stream.append(bytes([(tile & 0xff00) >> 8]))
-    return b''.join(stream)
+def getSampleError(sample, sourcePixels):
+    '''psnr and max channel difference of the decoded image against the 15 bit source, in 8 bit rgb'''
+    difference = sample.astype(np.int32) - snesgfx.toRGB(sourcePixels)
+    meanSquareError = float(np.mean(difference * difference))
+    psnr = INFINITY if meanSquareError == 0 else 10 * math.log10(255 * 255 / meanSquareError)
+    return psnr, int(np.abs(difference).max())
 
 
-def writeBgTileMap(tiles, palettes, options):
+def parseTiles(image, options):
+    return parseSpriteTiles(image, options) if options.get('mode') == 'sprite' else parseBgTiles(image, options)
+
+
+def getBgTileMapStream(tiles, palettes, options):
     '''writes successive blocks of 32x32 tile tilemaps'''
-    bgTilemaps = getBgTilemaps(tiles, palettes, options)
-    outFile = getOutputFile(options, ext='tilemap')
-    for tile in [tile for tilemap in bgTilemaps for tile in tilemap]:
-        outFile.write(bytes((tile & 0xff,)))
-        outFile.write(bytes(((tile & 0xff00) >> 8,)))
-    outFile.close()
+    return getBgTilemaps(tiles, palettes, options).astype('<u2').tobytes()
 
 
 def getBgTilemaps(tiles, palettes, options):
-    emptyTile = getEmptyTileConfig(tiles, palettes)
-    bgTilemaps = [[emptyTile['concatConfig'] for i in range(BG_TILEMAP_SIZE * BG_TILEMAP_SIZE)] for i in range(
-        getCurrentTilemap(options.get('resolutionx'), options.get('resolutiony'), options) + 1)]
-    for tile in tiles:
-        mapId = getCurrentTilemap(tile['x'], tile['y'], options)
-        tilePos = getPositionInTilemap(tile['x'], tile['y'], options)
-        tileConfig = fetchTileConfig(tile, tiles, palettes)['concatConfig']
-
-        try:
-            bgTilemaps[mapId][tilePos] = tileConfig
-        except IndexError:
-            logging.error(
-                'invalid tilemap access in getBgTilemaps, mapId: %s, tilePos: %s' % (mapId, tilePos))
+    '''(tilemaps, 32 * 32) tilemap entries, unused entries point to the last empty tile'''
+    configs = getBgTileConfigs(getTileRefs(tiles, palettes))
+    emptyTiles = np.flatnonzero(tileIsEmpty(tiles))
+    emptyConfig = int(configs[emptyTiles[-1]]) if len(emptyTiles) else 0
+    screensX, screensY = getTilemapScreens(options)
+    bgTilemaps = np.full((screensX * screensY, BG_TILEMAP_SIZE * BG_TILEMAP_SIZE), emptyConfig, dtype=np.int32)
+
+    mapIds = getCurrentTilemap(tiles.x, tiles.y, options)
+    tilePos = getPositionInTilemap(tiles.x, tiles.y, options)
+    valid = (tiles.x < screensX * BG_TILEMAP_SIZE * options.get('tilesizex')) & (mapIds < len(bgTilemaps))
+    for tileId in np.flatnonzero(~valid).tolist():
+        logging.error(
+            'invalid tilemap access in getBgTilemaps, mapId: %s, tilePos: %s' % (mapIds[tileId], tilePos[tileId]))
+    tileIds = np.flatnonzero(valid)
+    # tiles sharing an entry overwrite each other, the last one is kept
+    entries = mapIds[tileIds] * BG_TILEMAP_SIZE * BG_TILEMAP_SIZE + tilePos[tileIds]
+    lastIds = len(entries) - 1 - np.unique(entries[::-1], return_index=True)[1]
+    bgTilemaps.ravel()[entries[lastIds]] = configs[tileIds[lastIds]]
     return bgTilemaps
 
 
-def getEmptyTileConfig(tiles, palettes):
-    '''scans for empty tile, returns fake value if none found '''
-    '''todo, do we really need an additional empty tile here sometimes?'''
-    emptyTiles = [tile for tile in tiles if tileIsEmpty(tile)]
-    try:
-        return fetchTileConfig(emptyTiles.pop(), tiles, palettes)
-    except IndexError:
-        return {'concatConfig': 0}
+def getBgTileConfigs(refs):
+    '''bg tilemap entry of every tile: vhopppcc cccccccc'''
+    return ((refs['yMirror'].astype(np.int32) << 15) | (refs['xMirror'].astype(np.int32) << 14)
+            | ((refs['palOutId'] & 0x7) << 10) | (refs['tileOutId'] & 0x3ff))
 
 
-def tileIsEmpty(tile):
-    if tile['refId'] != None:
-        return False
-    for pixel in [pixel for scanline in tile['indexedPixel'] for pixel in scanline]:
-        if pixel != 0:
-            return False
-    return True
+def tileIsEmpty(tiles):
+    '''flags unique tiles that only use palette color 0'''
+    return (tiles.refId == NO_REF) & ~tiles.indexedPixel.reshape(len(tiles), -1).any(axis=1)
 
 
 def getPositionInTilemap(xPos, yPos, options):
-    xTilePos = int(math.floor(
-        (xPos / options.get('tilesizex')) % BG_TILEMAP_SIZE))
-    yTilePos = int(math.floor(
-        (yPos / options.get('tilesizey')) % BG_TILEMAP_SIZE))
+    '''entry of a pixel position inside its 32x32 tilemap, takes ints or arrays'''
+    xTilePos = xPos // options.get('tilesizex') % BG_TILEMAP_SIZE
+    yTilePos = yPos // options.get('tilesizey') % BG_TILEMAP_SIZE
     return (BG_TILEMAP_SIZE * yTilePos) + xTilePos
 
 
 def getCurrentTilemap(xPos, yPos, options):
-    return int(math.floor(xPos / float(BG_TILEMAP_SIZE * options.get('tilesizex'))) * math.floor(yPos / float(BG_TILEMAP_SIZE * options.get('tilesizey'))))
+    '''32x32 tilemap of a pixel position. tilemaps are stored row by row, like the snes 64x32, 32x64 and 64x64
+    screen layouts'''
+    screensX = getTilemapScreens(options)[0]
+    return (yPos // (BG_TILEMAP_SIZE * options.get('tilesizey'))) * screensX + xPos // (BG_TILEMAP_SIZE * options.get('tilesizex'))
+
+
+def getTilemapScreens(options):
+    '''32x32 tilemaps needed across and down to cover the image'''
+    return (-(-options.get('resolutionx') // (BG_TILEMAP_SIZE * options.get('tilesizex'))),
+            -(-options.get('resolutiony') // (BG_TILEMAP_SIZE * options.get('tilesizey'))))
 
 
 def getSpriteTileMapStream(tiles, palettes, options):
-    stream = []
-    for tile in tiles:
-        tileConfig = fetchSpriteTileConfig(tile, tiles, palettes)
-        stream.append(bytes([tileConfig['x'] & 0xff]))
-        stream.append(bytes([tileConfig['y'] & 0xff]))
-        stream.append(bytes([tileConfig['concatConfig'] & 0xff]))
-        stream.append(bytes([(tileConfig['concatConfig'] & 0xff00) >> 8]))
-    return b''.join(stream)
-
-
-def writeSpriteTileMap(tiles, palettes, options):
-    outFile = getOutputFile(options, ext='spritemap')
-    for tile in tiles:
-        tileConfig = fetchSpriteTileConfig(tile, tiles, palettes)
-        outFile.write(bytes((tileConfig['concatConfig'] & 0xff,)))
-        outFile.write(bytes(((tileConfig['concatConfig'] & 0xff00) >> 8,)))
-        outFile.write(bytes((tileConfig['x'] & 0xff,)))
-        outFile.write(bytes((tileConfig['y'] & 0xff,)))
-    outFile.close()
-
-
-def fetchTileConfig(tile, tiles, palettes):
-    actualTile = fetchActualTile(tiles, tile['id'], False, False)
-    actualPalette = fetchActualEntity(palettes, actualTile['palette']['id'])
-    x = 1 if actualTile['xMirror'] else 0
-    y = 1 if actualTile['yMirror'] else 0
-    return {
-        'x': tile['x'],
-        'y': tile['y'],
-        'xMirror': actualTile['xMirror'],
-        'yMirror': actualTile['yMirror'],
-        'tileId': actualTile['id'],
-        'palId': actualPalette['id'],
-        'tileOutId': actualTile['outId'],
-        'palOutId': actualPalette['outId'],
-        'concatConfig': (y << 15) | (x << 14) | ((actualPalette['outId'] & 0x7) << 10) | (actualTile['outId'] & 0x3ff)
-    }
+    '''one entry per OBJ, OBJs larger than a tile are represented by their upper left tile'''
+    headIds = getObjHeadTileIds(tiles)
+    configs = getSpriteTileConfigs(tiles, getTileRefs(tiles, palettes))[headIds]
+    return np.stack((tiles.x[headIds], tiles.y[headIds], configs, configs >> 8), axis=1).astype(np.uint8).tobytes()
 
 
-def fetchSpriteTileConfig(tile, tiles, palettes):
-    actualTile = fetchActualTile(tiles, tile['id'], False, False)
-    actualPalette = fetchActualEntity(palettes, actualTile['palette']['id'])
+def getSpriteTileConfigs(tiles, refs):
+    '''sprite map attributes of every tile: vhoopppN cccccccc. mirror bits are the tile's own, sprite tiles
+    only reference unmirrored duplicates'''
     priority = 0x3
     nametable = 0x0
-    x = 1 if tile['xMirror'] else 0
-    y = 1 if tile['yMirror'] else 0
+    return ((tiles.yMirror.astype(np.int32) << 15) | (tiles.xMirror.astype(np.int32) << 14) | (priority << 12)
+            | ((refs['palOutId'] & 0x7) << 9) | (nametable << 8) | (refs['tileOutId'] & 0x3ff))
+
+
+def fetchTileConfig(tileId, tiles, palettes):
+    refs = getTileRefs(tiles, palettes)
+    return getTileConfig(tileId, tiles, refs, getBgTileConfigs(refs), refs['xMirror'], refs['yMirror'])
+
+
+def fetchSpriteTileConfig(tileId, tiles, palettes):
+    refs = getTileRefs(tiles, palettes)
+    return getTileConfig(tileId, tiles, refs, getSpriteTileConfigs(tiles, refs), tiles.xMirror, tiles.yMirror)
+
+
+def getTileConfig(tileId, tiles, refs, configs, xMirror, yMirror):
+    return {
+        'x': int(tiles.x[tileId]),
+        'y': int(tiles.y[tileId]),
+        'xMirror': bool(xMirror[tileId]),
+        'yMirror': bool(yMirror[tileId]),
+        'tileId': int(refs['tileId'][tileId]),
+        'palId': int(refs['palId'][tileId]),
+        'tileOutId': int(refs['tileOutId'][tileId]),
+        'palOutId': int(refs['palOutId'][tileId]),
+        'concatConfig': int(configs[tileId])
+    }
+
+
+def getTileRefs(tiles, palettes):
+    '''resolved reference table of all tiles: actual tile, accumulated mirror status, actual palette and the
+    output ids of both. palettes need their outIds assigned'''
+    tileIds, xMirror, yMirror = resolveTileRefs(tiles)
+    actualPalettes = [fetchActualEntity(palettes, palId) for palId in range(len(palettes))]
+    palIds = np.array([palette['id'] for palette in actualPalettes] or [NO_REF], dtype=np.int32)
+    palOutIds = np.array([palette['outId'] for palette in actualPalettes] or [NO_REF], dtype=np.int32)
+    paletteIds = tiles.paletteId[tileIds]
     return {
-        'x': tile['x'],
-        'y': tile['y'],
-        'xMirror': tile['xMirror'],
-        'yMirror': tile['yMirror'],
-        'tileId': actualTile['id'],
-        'palId': actualPalette['id'],
-        'tileOutId': actualTile['outId'],
-        'palOutId': actualPalette['outId'],
-        'concatConfig': (y << 15) | (x << 14) | (priority << 12) | ((actualPalette['outId'] & 0x7) << 9) | (nametable << 8) | (actualTile['outId'] & 0x3ff)
+        'tileId': tileIds,
+        'xMirror': xMirror,
+        'yMirror': yMirror,
+        'palId': palIds[paletteIds],
+        'tileOutId': tiles.outId[tileIds],
+        'palOutId': palOutIds[paletteIds]
     }
 
 
@@ -505,32 +867,33 @@ target format sprite tilemap:
 '''
 
 
-def writeTiles(tiles, options):
-    outFile = getOutputFile(options, ext='tiles')
-    for tile in tiles:
-        if tile['refId'] == None:
-            writeBitplaneTile(outFile, tile, options)
-    outFile.close()
-
-
-def writeBitplaneTile(outFile, tile, options):
-    bitplanes = fetchBitplanes(tile, options)
-    for i in range(0, len(bitplanes), 2):
-        while bitplanes[i].notEmpty():
-            outFile.write(bytes((bitplanes[i].first(),)))
-            outFile.write(bytes((bitplanes[i+1].first(),)))
-
-
 def getTileWriteStream(tiles, options):
-    stream = []
-    for tile in tiles:
-        if tile['refId'] == None:
-            bitplanes = fetchBitplanes(tile, options)
-            for i in range(0, len(bitplanes), 2):
-                while bitplanes[i].notEmpty():
-                    stream.append(bytes([bitplanes[i].first()]))
-                    stream.append(bytes([bitplanes[i+1].first()]))
-    return b''.join(stream)
+    '''unique tiles in snes planar format: pairs of bitplanes, interleaved byte by byte'''
+    if options.get('bpp') % 2:
+        logging.error('Error, bitplanes are written in pairs, %sbpp is not supported.' % options.get('bpp'))
+        sys.exit(1)
+    unique = np.flatnonzero(tiles.refId == NO_REF)
+    if options.get('directcolor'):
+        pixels = getDirectColorPixels(tiles.pixel[unique])
+    else:
+        pixels = tiles.indexedPixel[unique]
+    pixels = pixels.reshape(len(unique), 1, -1)
+    bitplanes = ((pixels >> np.arange(options.get('bpp'), dtype=pixels.dtype)[None, :, None]) & 1).astype(np.uint8)
+    # most significant bit first, trailing pixels that do not fill a byte are dropped
+    bitplanes = np.packbits(bitplanes, axis=-1)[..., :pixels.shape[-1] // 8]
+    planar = bitplanes.reshape(len(unique), options.get('bpp') // 2, 2, -1).swapaxes(2, 3).reshape(len(unique), -1)
+    if hasObjGroups(tiles) and len(unique):
+        # tiles go to their OBJ name grid slot, slots no tile uses stay empty
+        slots = np.zeros((int(tiles.outId[unique].max()) + 1, planar.shape[1]), dtype=np.uint8)
+        slots[tiles.outId[unique]] = planar
+        planar = slots
+    return planar.tobytes()
+
+
+def getDirectColorPixels(pixels):
+    '''source: -bbbbbgg gggrrrrr target: BBGGGRRR'''
+    pixels = pixels.astype(np.uint16)
+    return (((pixels & 0x6000) >> 7) | ((pixels & 0x380) >> 4) | ((pixels & 0x1c) >> 2)).astype(np.uint8)
 
 
 def getPaletteWriteStream(palettes, options):
@@ -541,179 +904,196 @@ def getPaletteWriteStream(palettes, options):
     return bytes(stream)
 
 
-def fetchBitplanes(tile, options):
-    bitplanes = []
-    for bitPlane in range(options.get('bpp')):
-        bitplaneTile = BitStream()
-        # debugLog(tile['pixel'],'native')
-        # debugLogExit(tile['indexedPixel'],'indexed')
-        target = 'pixel' if options.get('directcolor') else 'indexedPixel'
-        for pixel in [pixel for scanline in tile[target] for pixel in scanline]:
-            if options.get('directcolor'):
-                # source: -bbbbbgg gggrrrrr target: BBGGGRRR
-                # pixel = ((pixel & 0x7c00) >> 10) | ((pixel & 0x380) >> 7) | ((pixel & 0x1c) >> 2)
-                pixel = (((pixel & 0x6000) >> 7) | (
-                    (pixel & 0x380) >> 4) | ((pixel & 0x1c) >> 2))
-            bitplaneTile.writeBit(pixel >> bitPlane)
-        bitplanes.append(bitplaneTile)
-    return bitplanes
-
-
 def writePalettes(palettes, options):
-    outFile = getOutputFile(options, ext='palette')
-    for color in [pixel for palette in [palette for palette in palettes if palette['refId'] == None] for pixel in palette['color']]:
-        outFile.write(bytes((color & 0xff,)))
-        outFile.write(bytes(((color & 0xff00) >> 8,)))
-    outFile.close()
+    writeOutputFile(options, 'palette', getPaletteWriteStream(palettes, options))
 
 
-def getOutputFile(options, ext):
+def writeOutputFile(options, ext, data):
+    '''writes outfilebase.ext through a temporary file, nobody ever sees a partially written output'''
     outFileName = "%s.%s" % (options.get('outfilebase'), ext)
+    tempFileName = "%s.%s.tmp" % (outFileName, os.getpid())
     try:
-        outFile = open(outFileName, 'wb')
-    except IOError:
+        with open(tempFileName, 'wb') as outFile:
+            outFile.write(data)
+        os.replace(tempFileName, outFileName)
+    except (IOError, OSError):
         logging.error('unable to access output file %s' % outFileName)
         sys.exit(1)
-    return outFile
+
+
+def writeOutputImage(options, ext, image):
+    imageData = io.BytesIO()
+    image.save(imageData, 'PNG')
+    writeOutputFile(options, ext, imageData.getvalue())
 
 
 def palettizeTiles(tiles, palettes):
     '''replaces direct tile colors with best-matching entries of assigned palette'''
-    # Shared cache across all tiles for performance
-    colorCache = {}
-    result = []
-    for tile in tiles:
-        if tile['refId'] != None:
-            result.append(tile)
-        else:
-            result.append(palettizeTile(tile, palettes, colorCache))
-    return result
+    result = tiles.copy()
+    unique = np.flatnonzero(tiles.refId == NO_REF)
+    realPalettes = [pal for pal in palettes if pal['refId'] == None]
 
+    # every distinct image color is matched against every palette only once
+    shape = tiles.pixel[unique].shape
+    colors, colorIndex = np.unique(tiles.pixel[unique].ravel(), return_inverse=True)
+    colorIndex = colorIndex.reshape(shape[0], shape[1] * shape[2])
+    similarValues = []
+    similarIndices = []
+    tileErrors = []
+    for palette in realPalettes:
+        indices, errors = snescolor.nearestPaletteIndices(colors, palette['color'])
+        similarValues.append(np.array(palette['color'], dtype=np.uint16)[indices])
+        similarIndices.append(indices)
+        squareErrors = errors * errors
+        # cumulative sum adds up pixel errors in scanline order, just like a plain loop would
+        tileErrors.append(np.sqrt(np.cumsum(squareErrors[colorIndex], axis=1)[:, -1]))
+
+    optimumPalette = np.argmin(np.array(tileErrors), axis=0)
+    if hasObjGroups(tiles):
+        # all tiles of an OBJ share its palette, the one with the least error over the whole OBJ
+        objErrors = np.zeros((len(realPalettes), int(tiles.objId.max()) + 1))
+        np.add.at(objErrors, (slice(None), tiles.objId[unique]), np.array(tileErrors) ** 2)
+        optimumPalette = np.argmin(objErrors, axis=0)[tiles.objId[unique]]
+    result.pixel[unique] = np.array(similarValues, dtype=np.uint16)[optimumPalette[:, None], colorIndex].reshape(shape)
+    result.indexedPixel[unique] = np.array(similarIndices, dtype=np.uint8)[optimumPalette[:, None], colorIndex].reshape(shape)
+    result.paletteId[unique] = [realPalettes[palIndex]['id'] for palIndex in optimumPalette.tolist()]
+    return result
 
-def findOptimumTilePalette(palettes, pixels, colorCache=None):
-    if colorCache is None:
-        colorCache = {}
-    
-    optimumPalette = {'error': INFINITY}
-    for palette in [pal for pal in palettes if pal['refId'] == None]:
-        squareError = 0
-        palId = palette['id']
-        for scanline in pixels:
-            for pixel in scanline:
-                # Use cache for color lookups
-                cacheKey = (pixel, palId)
-                if cacheKey in colorCache:
-                    similarColor = colorCache[cacheKey]
-                else:
-                    similarColor = getSimilarColor(pixel, palette['color'])
-                    colorCache[cacheKey] = similarColor
-                squareError += similarColor['error'] * similarColor['error']
-        palette['error'] = math.sqrt(squareError)
-        optimumPalette = palette if palette['error'] < optimumPalette['error'] else optimumPalette
-    return optimumPalette
-
-
-def palettizeTile(tile, palettes, colorCache=None):
-    if colorCache is None:
-        colorCache = {}
-    # logging.debug('palettizing tile %s' % tile['id'])
-    palette = findOptimumTilePalette(palettes, tile['pixel'], colorCache)
-
-    indexedScanlines = []
-    scanlines = []
-
-    for scanline in tile['pixel']:
-        indexedPixels = []
-        pixels = []
-        for pixel in scanline:
-            # Use cache for color lookups
-            cacheKey = (pixel, palette['id'])
-            if cacheKey in colorCache:
-                similarColor = colorCache[cacheKey]
-            else:
-                similarColor = getSimilarColor(pixel, palette['color'])
-                colorCache[cacheKey] = similarColor
-            indexedPixels.append(palette['color'].index(similarColor['value']))
-            pixels.append(similarColor['value'])
-        # indexedPixels.append( [getSimilarColorIndex( pixel, palette['color'] ) for pixel in scanline] )
-        scanlines.append(pixels)
-        indexedScanlines.append(indexedPixels)
-    return {
-        'indexedPixel': indexedScanlines,
-        'pixel': scanlines,
-        'palette': {
-            'color': [],
-            'id': palette['id'],
-            'refId': None
-        },
-        'id': tile['id'],
-        'refId': tile['refId'],
-        'x': tile['x'],
-        'y': tile['y'],
-        'xMirror': tile['xMirror'],
-        'yMirror': tile['yMirror']
-    }
 
+def fetchActualTile(tiles, tileId, xStatus, yStatus):
+    '''follows tile references, returns actual tile id and accumulated mirror status'''
+    while tiles.refId[tileId] != NO_REF:
+        xStatus ^= bool(tiles.xMirror[tileId])
+        yStatus ^= bool(tiles.yMirror[tileId])
+        tileId = tiles.refId[tileId]
+    return int(tileId), xStatus, yStatus
 
-def fetchActualTile(entities, entityId, xStatus, yStatus):
-    if entities[entityId]['refId'] == None:
-        # logging.debug('actual    %s[%s%s]' % (entityId, 'X' if entities[entityId]['xMirror'] else 'x', 'Y' if entities[entityId]['yMirror'] else 'y'))
-        tile = entities[entityId]
-        tile['xMirror'] = xStatus
-        tile['yMirror'] = yStatus
-        return tile
-        '''
-    return {
-      'indexedPixel'  : entities[entityId]['indexedScanlines'],
-      'pixel'         : entities[entityId]['scanlines'],
-      'palette'       : entities[entityId]['palette'],
-      'id'            : entities[entityId]['id'],
-      'refId'         : entities[entityId]['refId'],
-      'x'             : entities[entityId]['x'],
-      'y'             : entities[entityId]['y'],
-      'xMirror'       : xStatus,
-      'yMirror'       : yStatus
-    }
-    '''
-        # tile = entities[entityId]
 
-    else:
-        # logging.debug('reference %s[%s%s]->%s[%s%s]' % (entityId, 'X' if entities[entityId]['xMirror'] else 'x', 'Y' if entities[entityId]['yMirror'] else 'y', entities[entityId]['refId'], 'X' if entities[entities[entityId]['refId']]['xMirror'] else 'x', 'Y' if entities[entities[entityId]['refId']]['yMirror'] else 'y'))
-        return fetchActualTile(entities, entities[entityId]['refId'], entities[entityId]['xMirror'] ^ xStatus, entities[entityId]['yMirror'] ^ yStatus)
-
-        # beide gesetzt:0
-        # 1 gesetzt: 1
-        # keins gesetzt: 0
-        '''
-    debugLog({
-      'id'  : tile['id'],
-      'refId'  : tile['refId'],
-      'xMirror'  : tile['xMirror'],
-      'yMirror'  : tile['yMirror'],
-    }, 'tile %s[%s%s]->%s[%s%s]' % tile['id'])
-    '''
-        # tile['yMirror'] = tile['yMirror'] ^ entities[entityId]['yMirror']
-        # tile['xMirror'] = tile['xMirror'] ^ entities[entityId]['xMirror']
-
-    # logging.debug('returning %s[%s%s]' % (tile['id'], 'X' if tile['xMirror'] else 'x', 'Y' if tile['yMirror'] else 'y'))
-    # return tile
+def resolveTileRefs(tiles):
+    '''fetchActualTile for all tiles at once. every pass points each tile at the target of its target, so
+    reference chains of any length collapse in log2(length) passes'''
+    unique = tiles.refId == NO_REF
+    targets = np.where(unique, np.arange(len(tiles), dtype=np.int32), tiles.refId)
+    xMirror = tiles.xMirror & ~unique
+    yMirror = tiles.yMirror & ~unique
+    while True:
+        nextTargets = targets[targets]
+        if (nextTargets == targets).all():
+            return targets, xMirror, yMirror
+        xMirror = xMirror ^ xMirror[targets]
+        yMirror = yMirror ^ yMirror[targets]
+        targets = nextTargets
 
 
 def fetchActualEntity(entities, entityId):
-    return entities[entityId] if entities[entityId]['refId'] == None else fetchActualEntity(entities, entities[entityId]['refId'])
-
-
-def parsePalettes(tiles, options):
-    return [reducePaletteColorDepth(tile['palette'], options) for tile in tiles]
+    while entities[entityId]['refId'] != None:
+        entityId = entities[entityId]['refId']
+    return entities[entityId]
 
 
 def parseGlobalPalettes(tiles, options):
     globalPalette = fetchGlobalPalette(tiles, options)
-    while (len(globalPalette) > (((options.get('bpp') ** 2) - 1) * options.get('palettes'))):
-        nearestIndices = getNearestPaletteIndices(globalPalette)
-        globalPalette.pop(max(nearestIndices['id1'], nearestIndices['id2']))
-        # logging.debug('global palette length now at %s, target is %s.' % (len(globalPalette), (((options.get('bpp') ** 2) - 1) * options.get('palettes'))))
-    return partitionGlobalPalette(globalPalette, options)
+    maxColors = ((options.get('bpp') ** 2) - 1) * options.get('palettes')
+    if options.get('quantizer') not in quantizer.QUANTIZERS:
+        logging.error('Error, invalid quantizer "%s", allowed are %s.' % (
+            options.get('quantizer'), ', '.join(quantizer.QUANTIZERS)))
+        sys.exit(1)
+    if len(globalPalette) > maxColors:
+        quantize = quantizer.QUANTIZERS[options.get('quantizer')]
+        globalPalette = quantize(globalPalette, getColorCounts(tiles.pixel, globalPalette), maxColors)
+        # nearestpair keeps a subset in input order, averaged colors need to be sorted again
+        if quantize is not quantizer.reduceNearestPair:
+            globalPalette = sorted(globalPalette, key=cmp_to_key(sortSNESColors))
+        # logging.debug('global palette length now at %s, target is %s.' % (len(globalPalette), maxColors))
+    if options.get('palettesolver') not in ('hue', 'tiles'):
+        logging.error('Error, invalid palette solver "%s", allowed are hue and tiles.' % options.get('palettesolver'))
+        sys.exit(1)
+    palettes = partitionGlobalPalette(globalPalette, options)
+    if options.get('palettesolver') == 'tiles' and not options.get('refpalette'):
+        palettes = solveTilePalettes(tiles, palettes, options)
+    return palettes
+
+
+def solveTilePalettes(tiles, palettes, options):
+    '''regroups colors into palettes so that colors used by the same tiles share a palette
+
+    starts from the hue partitioned palettes. every round builds each palette from the colors
+    of the tiles assigned to it, then moves every tile to the palette with the lowest error.
+    keeps the best round, stops when no tile moves or iterations or time limit are used up'''
+    startTime = time.perf_counter()
+    quantize = quantizer.QUANTIZERS[options.get('quantizer')]
+    colorCount = (options.get('bpp') ** 2) - 1
+    colors, colorIndex = np.unique(tiles.pixel.reshape(len(tiles), -1), return_inverse=True)
+    colorIndex = colorIndex.reshape(len(tiles), -1)
+
+    tileErrors = getTilePaletteErrors(colors, colorIndex, palettes)
+    assignment = np.argmin(tileErrors, axis=0)
+    bestPalettes, bestError, initialError = palettes, tileErrors.min(axis=0).sum(), tileErrors.min(axis=0).sum()
+    for iteration in range(options.get('paletteiterations')):
+        if options.get('palettetimelimit') and time.perf_counter() - startTime > options.get('palettetimelimit'):
+            logging.info('palette solver time limit reached after %s rounds.' % iteration)
+            break
+        assignment = seedEmptyPalettes(assignment, tileErrors.min(axis=0), options.get('palettes'))
+        candidatePalettes = [
+            getTilePalette(colors, colorIndex[assignment == palId], colorCount, quantize, palId, options)
+            for palId in range(assignment.max() + 1)]
+        tileErrors = getTilePaletteErrors(colors, colorIndex, candidatePalettes)
+        error = tileErrors.min(axis=0).sum()
+        if error < bestError:
+            bestPalettes, bestError = candidatePalettes, error
+        newAssignment = np.argmin(tileErrors, axis=0)
+        if (newAssignment == assignment).all():
+            break
+        assignment = newAssignment
+    logging.info('palette solver reduced total square error from %.0f to %.0f.' % (initialError, bestError))
+    return bestPalettes
+
+
+def getTilePaletteErrors(colors, colorIndex, palettes):
+    '''(palettes, tiles) summed square error of every tile mapped to every palette'''
+    tileErrors = []
+    for palette in palettes:
+        indices, errors = snescolor.nearestPaletteIndices(colors, palette['color'])
+        tileErrors.append((errors * errors)[colorIndex].sum(axis=1))
+    return np.array(tileErrors)
+
+
+def seedEmptyPalettes(assignment, tileErrors, paletteCount):
+    '''moves the worst matching tiles into palettes without tiles, one tile each'''
+    assignment = assignment.copy()
+    worstTiles = np.argsort(-tileErrors, kind='stable').tolist()
+    for palId in range(paletteCount):
+        if (assignment == palId).any():
+            continue
+        while worstTiles:
+            tileId = worstTiles.pop(0)
+            # never empty another palette
+            if np.count_nonzero(assignment == assignment[tileId]) > 1:
+                assignment[tileId] = palId
+                break
+    return assignment
+
+
+def getTilePalette(colors, colorIndex, colorCount, quantize, palId, options):
+    '''palette holding the colors of the given tiles, reduced to colorCount if necessary'''
+    counts = np.bincount(colorIndex.ravel(), minlength=len(colors))
+    used = (counts > 0) & (colors != options.get('transcol'))
+    paletteColors = colors[used].tolist()
+    if len(paletteColors) > colorCount:
+        paletteColors = quantize(paletteColors, counts[used].tolist(), colorCount)
+    paletteColors = sorted(paletteColors, key=cmp_to_key(sortSNESColors))
+    return {
+        'color': [options.get('transcol')] + paletteColors + [EMPTY_COLOR] * (colorCount - len(paletteColors)),
+        'refId': None,
+        'id': palId
+    }
+
+
+def getColorCounts(pixels, colors):
+    '''number of pixels of each color'''
+    pixelColors, counts = np.unique(pixels, return_counts=True)
+    colorCounts = dict(zip(pixelColors.tolist(), counts.tolist()))
+    return [colorCounts.get(color, 0) for color in colors]
 
 
 def partitionGlobalPalette(palettes, options):
@@ -740,14 +1120,21 @@ def partitionGlobalPalette(palettes, options):
 def fetchGlobalPalette(tiles, options):
     refPaletteImg = getReferencePaletteImage(options)
     if refPaletteImg:
-        return [color for color in set([pixel for scanline in refPaletteImg['pixels'] for pixel in scanline if pixel != options.get('transcol')])]
+        pixels = refPaletteImg['pixels']
+        return [color for color in set(pixels[pixels != options.get('transcol')].tolist())]
     else:
         return sorted(
-            [color for color in set([color for tile in tiles for color in tile['palette']['color'] if color != options.get('transcol')])],
+            [color for color in set([color for color in getUniqueColors(tiles.pixel) if color != options.get('transcol')])],
             key=cmp_to_key(sortSNESColors)
         )
 
 
+def getUniqueColors(pixels):
+    '''distinct colors of pixel array, in order of first appearance'''
+    colors, firstIndex = np.unique(pixels.ravel(), return_index=True)
+    return colors[np.argsort(firstIndex)].tolist()
+
+
 def checkPaletteCount(palettes, options):
     palCount = len([pal for pal in palettes if pal['refId'] == None])
     if (palCount > options.get('palettes')):
@@ -768,30 +1155,26 @@ def getPaletteById(palettes, palId):
 
 
 def getSimilarPalette(inputPalette, refPalette):
-    squareError = 0
-    for color in inputPalette['color']:
-        similarColor = getSimilarColor(color, refPalette['color'])
-        squareError += similarColor['error'] * similarColor['error']
+    indices, errors = snescolor.nearestPaletteIndices(inputPalette['color'], refPalette['color'])
     return {
         'color': [],  # colors,
         'refId': refPalette['id'],
         'id': inputPalette['id'],
-        'error': math.sqrt(squareError)
+        'error': math.sqrt(np.cumsum(errors * errors)[-1]) if len(errors) else 0.0
     }
 
 
 def getSimilarColor(color, refPalette):
-    minError = {
-        'error': INFINITY,
-        'value': None
-    }
-    for refColor in refPalette:
-        diff = compareSNESColors(color, refColor)
-        minError = minError if minError['error'] < diff else {
-            'error': diff,
-            'value': refColor
+    if not len(refPalette):
+        return {
+            'error': INFINITY,
+            'value': None
         }
-    return minError
+    index, error = snescolor.nearestPaletteIndices(color, refPalette)
+    return {
+        'error': float(error),
+        'value': refPalette[int(index)]
+    }
 
 
 def getSimilarColorIndex(color, refPalette):
@@ -807,137 +1190,275 @@ def reducePaletteColorDepth(palette, options):
 
 
 def getNearestPaletteIndices(palette):
-    diffTable = {}
-    for i in range(1, len(palette)):
-        for iRef in range(1, len(palette)):
-            if i != iRef:
-                diffIndex = "%s-%s" % (min(i, iRef), max(i, iRef))
-                diffTable[diffIndex] = {
-                    'difference': compareSNESColors(palette[i], palette[iRef]),
-                    'id1': i,
-                    'id2': iRef
-                }
-    return getMinDifferenceIds(diffTable)
-
-
-def getMinDifferenceIds(diffTable):
-    minDiff = {'difference': INFINITY}
-    for diffName, diff in diffTable.items():
-        minDiff = diff if diff['difference'] < minDiff['difference'] else minDiff
-    return minDiff
+    '''closest pair of colors, first index is never considered. on equal difference the first pair (i < iRef) wins'''
+    if len(palette) < 3:
+        return {'difference': INFINITY}
+    differences = snescolor.colorDistances(np.array(palette[1:])[:, None], np.array(palette[1:])[None, :])
+    differences[np.tril_indices(len(palette) - 1)] = INFINITY
+    i, iRef = np.unravel_index(np.argmin(differences), differences.shape)
+    return {
+        'difference': float(differences[i, iRef]),
+        'id1': int(iRef) + 1,
+        'id2': int(i) + 1
+    }
 
 
 def optimizeTiles(tiles, options):
-    return [checkDuplicateTileFast(tile, tiles, options) for tile in tiles]
-
-
-def checkDuplicateTile(tile, refTiles, options):
-    # logging.debug('optimizing tile %s of %s' % (tile['id'],len(refTiles)))
-    optimumTile = {'error': INFINITY, 'id': None}
-    for refTile in refTiles[:tile['id']]:
-        for replacedTile in [compareTile(mirrorTile, refTile) for mirrorTile in mirrorTiles(tile)]:
-            optimumTile = optimumTile if replacedTile['error'] > optimumTile['error'] else replacedTile
-    return optimumTile if optimumTile['error'] < float(options.get('tilethreshold')) and optimumTile['id'] else tile
-
-
-def checkDuplicateTileFast(tile, refTiles, options):
-    '''ugly but fast(er)'''
-    # logging.debug('optimizing tile %s of %s' % (tile['id'],len(refTiles)))
-    optimumTile = {'error': INFINITY, 'id': None}
-    mirroredTiles = mirrorTiles(tile)
-
-    # cmpStart = tile['id'] - min(LOOKBACK_TILES, tile['id'])
-    # look back through all tiles!
-    cmpStart = 0
-    for refTile in refTiles[cmpStart:tile['id']]:
-        refPixels = [pixel for scanline in refTile['pixel']
-                     for pixel in scanline]
-        for mirrorTile in mirroredTiles:
-            squareError = 0
-            inPixels = [pixel for scanline in mirrorTile['pixel']
-                        for pixel in scanline]
-
-            for i in range(len(inPixels)):
-                r = (inPixels[i] & 0x1f) - (refPixels[i] & 0x1f)
-                g = ((inPixels[i] & 0x3E0) >> 5) - \
-                    ((refPixels[i] & 0x3E0) >> 5)
-                b = ((inPixels[i] & 0x7C00) >> 10) - \
-                    ((refPixels[i] & 0x7C00) >> 10)
-                redMean = (inPixels[i] & 0x1f) + (refPixels[i] & 0x1f) // 2
-                squareError += math.sqrt((((512+redMean)*r*r) >> 8) +
-                                         4*g*g + (((767-redMean)*b*b) >> 8))**2
-            error = math.sqrt(squareError)
-            if error <= optimumTile['error']:
-                optimumTile = {
-                    'id': mirrorTile['id'],
-                    'pixel': [],
-                    'indexedPixel': [],
-                    'palette': {
-                        'color': [],
-                        'id': mirrorTile['palette']['id'],
-                        'refId': refTile['palette']['id']
-                    },
-                    'x': mirrorTile['x'],
-                    'y': mirrorTile['y'],
-                    'refId': refTile['id'],
-                    'error': error,
-                    'xMirror': mirrorTile['xMirror'],
-                    'yMirror': mirrorTile['yMirror']
-                }
-    return optimumTile if optimumTile['error'] < options.get('tilethreshold') and optimumTile['id'] else tile
-
-
-def compareTile(inputTile, refTile):
-    squareError = 0
-    inPixels = [pixel for scanline in inputTile['pixel'] for pixel in scanline]
-    refPixels = [pixel for scanline in refTile['pixel'] for pixel in scanline]
-    for error in [compareSNESColors(inPixels[i], refPixels[i]) for i in range(len(inPixels))]:
-        squareError += error * error
+    return applyDuplicateCandidates(tiles, findDuplicateCandidates(tiles, options), options.get('tilethreshold'))
+
+
+def findDuplicateCandidates(tiles, options):
+    '''best match (refId, mirror, error) of every tile against all earlier tiles, independent of threshold'''
+    if hasObjGroups(tiles):
+        return findSingleTileObjDuplicates(tiles, options)
+    candidates = getEmptyDuplicateCandidates(len(tiles))
+    colorCodes, mirroredColorCodes = getTileColorCodes(tiles)
+    mirrorIds = getTileMirrorIds(mirroredColorCodes)
+    lossyTileIds = findExactDuplicates(mirrorIds, candidates)
+    supersededBy = getSupersedingTileIds(mirrorIds)
+    errorTable = getTileErrorTable(np.unique(tiles.pixel))
+    if options.get('tilesearch') == 'indexed':
+        searchIndexedDuplicates(lossyTileIds, tiles, colorCodes, mirroredColorCodes, errorTable, candidates)
+        logTileSearchMismatches(lossyTileIds, supersededBy, colorCodes, mirroredColorCodes, errorTable, candidates)
+    else:
+        searchExactDuplicates(lossyTileIds, supersededBy, colorCodes, mirroredColorCodes, errorTable, candidates)
+    return candidates
+
+
+def findSingleTileObjDuplicates(tiles, options):
+    '''tiles of larger OBJs are addressed through the OBJ name grid and can not be replaced,
+    only OBJs of a single tile are matched against each other'''
+    candidates = getEmptyDuplicateCandidates(len(tiles))
+    singleTileIds = np.flatnonzero(np.bincount(tiles.objId)[tiles.objId] == 1)
+    if not len(singleTileIds):
+        return candidates
+    singleTiles = tiles.take(singleTileIds)
+    singleTiles.objId = np.arange(len(singleTileIds), dtype=np.int32)
+    singleCandidates = findDuplicateCandidates(singleTiles, options)
+    found = singleCandidates['refId'] != NO_REF
+    candidates['refId'][singleTileIds[found]] = singleTileIds[singleCandidates['refId'][found]]
+    for name in ('error', 'xMirror', 'yMirror'):
+        candidates[name][singleTileIds] = singleCandidates[name]
+    return candidates
+
+
+def getEmptyDuplicateCandidates(tileCount):
     return {
-        'id': inputTile['id'],
-        'pixel': [],
-        'palette': {
-            'color': [],
-            'id': inputTile['palette']['id'],
-            'refId': refTile['palette']['id']
-        },
-        'x': inputTile['x'],
-        'y': inputTile['y'],
-        'refId': refTile['id'],
-        'error': math.sqrt(squareError),
-        'xMirror': inputTile['xMirror'],
-        'yMirror': inputTile['yMirror']
+        'refId': np.full(tileCount, NO_REF, dtype=np.int32),
+        'error': np.full(tileCount, INFINITY, dtype=np.float64),
+        'xMirror': np.zeros(tileCount, dtype=bool),
+        'yMirror': np.zeros(tileCount, dtype=bool)
     }
 
 
-def mirrorTiles(tile):
-    return [
-        tile,
-        mirrorTile(tile, {'x': True, 'y': False}),
-        mirrorTile(tile, {'x': False, 'y': True}),
-        mirrorTile(tile, {'x': True, 'y': True}),
-    ]
-
-
-def mirrorTile(tile, config):
-    mirrorTile = []
-    verticalRange = range(
-        len(tile['pixel'])-1, 0-1, -1) if config['y'] else range(len(tile['pixel']))
-    for yPos in verticalRange:
-        horizontalRange = range(len(
-            tile['pixel'][yPos])-1, 0-1, -1) if config['x'] else range(len(tile['pixel'][yPos]))
-        mirrorTile.append([tile['pixel'][yPos][xPos]
-                          for xPos in horizontalRange])
-    return {
-        'id': tile['id'],
-        'pixel': mirrorTile,
-        'palette': tile['palette'],
-        'x': tile['x'],
-        'y': tile['y'],
-        'refId': None,
-        'xMirror': config['x'],
-        'yMirror': config['y']
-    }
+def searchExactDuplicates(tileIds, supersededBy, colorCodes, mirroredColorCodes, errorTable, candidates):
+    '''compares tileIds against every earlier tile'''
+    for blockStart in range(0, len(tileIds), TILE_BLOCK_SIZE):
+        blockTileIds = tileIds[blockStart:blockStart + TILE_BLOCK_SIZE]
+        # identical earlier tiles always tie, the last one wins. skip copies replaced before this block
+        refIds = np.flatnonzero(supersededBy[:blockTileIds[-1]] >= blockTileIds[0])
+        blockErrors = getTileBlockErrors(blockTileIds, refIds, colorCodes, mirroredColorCodes, errorTable)
+        setBestDuplicates(blockTileIds, refIds, blockErrors, candidates)
+
+
+def searchIndexedDuplicates(tileIds, tiles, colorCodes, mirroredColorCodes, errorTable, candidates):
+    '''compares tileIds against the earlier tiles closest in feature space only
+
+    exact copies are left out of the index, they are represented by the tile they copy'''
+    features = getTileFeatures(tiles)
+    indexIds = np.concatenate(([0], tileIds)).astype(np.intp)
+    index = vptree.VPTree(features[indexIds, 0])
+    pairTileIds = []
+    pairRefIds = []
+    for tileId in tileIds.tolist():
+        below = int(np.searchsorted(indexIds, tileId))
+        neighbours = set()
+        for mirrorFeatures in features[tileId]:
+            neighbours.update(pointId for distance, pointId in index.nearest(mirrorFeatures, INDEXED_SEARCH_NEIGHBOURS, below))
+        pairTileIds.extend([tileId] * len(neighbours))
+        pairRefIds.extend(indexIds[sorted(neighbours)].tolist())
+    if not pairTileIds:
+        return
+
+    pairTileIds = np.array(pairTileIds, dtype=np.intp)
+    pairRefIds = np.array(pairRefIds, dtype=np.intp)
+    pairErrors = getTilePairErrors(pairTileIds, pairRefIds, colorCodes, mirroredColorCodes, errorTable).ravel()
+    pairTiles = np.repeat(pairTileIds, len(MIRROR_CONFIGS))
+    # per tile the lowest error, on equal error the last compared tile and mirror wins
+    order = np.lexsort((-np.arange(len(pairErrors)), pairErrors, pairTiles))
+    optimum = order[np.concatenate(([True], pairTiles[order][1:] != pairTiles[order][:-1]))]
+    pairIndex, mirror = np.divmod(optimum, len(MIRROR_CONFIGS))
+    mirrorConfigs = np.array(MIRROR_CONFIGS, dtype=bool)
+    candidates['refId'][pairTileIds[pairIndex]] = pairRefIds[pairIndex]
+    candidates['error'][pairTileIds[pairIndex]] = pairErrors[optimum]
+    candidates['xMirror'][pairTileIds[pairIndex]] = mirrorConfigs[mirror, 0]
+    candidates['yMirror'][pairTileIds[pairIndex]] = mirrorConfigs[mirror, 1]
+
+
+def logTileSearchMismatches(tileIds, supersededBy, colorCodes, mirroredColorCodes, errorTable, candidates):
+    '''compares indexed search results against an exact search on evenly spaced sample tiles'''
+    if not len(tileIds):
+        return
+    sampleIds = tileIds[np.unique(np.linspace(0, len(tileIds) - 1, min(len(tileIds), TILE_SEARCH_SAMPLES)).astype(np.intp))]
+    exactCandidates = getEmptyDuplicateCandidates(len(candidates['error']))
+    searchExactDuplicates(sampleIds, supersededBy, colorCodes, mirroredColorCodes, errorTable, exactCandidates)
+    errorIncrease = candidates['error'][sampleIds] - exactCandidates['error'][sampleIds]
+    mismatches = np.count_nonzero(errorIncrease)
+    logging.info('indexed tile search differs from exact search on %s of %s sampled tiles (%.1f%%), mean error increase %.2f.' % (
+        mismatches, len(sampleIds), 100.0 * mismatches / len(sampleIds), errorIncrease.mean()))
+
+
+def setBestDuplicates(tileIds, refIds, blockErrors, candidates):
+    '''stores the best of blockErrors (tileIds, refIds, mirrors) for every tile'''
+    mirrorConfigs = np.array(MIRROR_CONFIGS, dtype=bool)
+    # only tiles before the current one may be referenced
+    blockErrors[refIds[None, :] >= tileIds[:, None]] = INFINITY
+    blockErrors = blockErrors.reshape(len(tileIds), -1)
+    # on equal error, the last compared tile and mirror wins
+    optimum = blockErrors.shape[1] - 1 - np.argmin(blockErrors[:, ::-1], axis=1)
+    refIndex, mirror = np.divmod(optimum, len(MIRROR_CONFIGS))
+    candidates['refId'][tileIds] = refIds[refIndex]
+    candidates['error'][tileIds] = blockErrors[np.arange(len(tileIds)), optimum]
+    candidates['xMirror'][tileIds] = mirrorConfigs[mirror, 0]
+    candidates['yMirror'][tileIds] = mirrorConfigs[mirror, 1]
+
+
+def getTileFeatures(tiles):
+    '''(tiles, mirrors, features) weighted channel means of tile quadrants
+
+    euclidean distance of these never exceeds the redmean error by much, so nearby tiles in
+    feature space are the likely matches'''
+    pixels = tiles.pixel.astype(np.float64)
+    channels = np.stack((pixels % 32, (pixels // 32) % 32, (pixels // 1024) % 32)) * REDMEAN_FEATURE_WEIGHTS[:, None, None, None]
+    splitY, splitX = pixels.shape[1] // 2, pixels.shape[2] // 2
+    quadrants = [(y, x) for y in (slice(None, splitY), slice(splitY, None)) for x in (slice(None, splitX), slice(splitX, None))]
+    features = []
+    for xMirror, yMirror in MIRROR_CONFIGS:
+        mirrored = mirrorPixels(channels, xMirror, yMirror)
+        features.append(np.concatenate([
+            mirrored[..., y, x].mean(axis=(-2, -1)).T * math.sqrt(mirrored[..., y, x].shape[-2] * mirrored[..., y, x].shape[-1])
+            for y, x in quadrants], axis=1))
+    return np.stack(features, axis=1)
+
+
+def findExactDuplicates(mirrorIds, candidates):
+    '''resolves tiles identical to an earlier tile in any mirror config through a hash index, returns ids of all other tiles
+
+    the index key is the smallest id of a tile's four mirror configs, which is the same for all
+    tiles that are mirrors of each other. redmean error is 0 for identical pixels only, so
+    these are the matches the lossy search would have picked: last earlier tile, last mirror'''
+    lastTileIds = {}
+    lossyTileIds = []
+    for tileId, tileMirrorIds in enumerate(mirrorIds.tolist()):
+        key = min(tileMirrorIds)
+        refId = lastTileIds.get(key)
+        lastTileIds[key] = tileId
+        if refId is None:
+            if tileId:
+                lossyTileIds.append(tileId)
+            continue
+        mirror = len(tileMirrorIds) - 1 - tileMirrorIds[::-1].index(int(mirrorIds[refId, 0]))
+        candidates['refId'][tileId] = refId
+        candidates['error'][tileId] = 0.0
+        candidates['xMirror'][tileId] = MIRROR_CONFIGS[mirror][0]
+        candidates['yMirror'][tileId] = MIRROR_CONFIGS[mirror][1]
+    return np.array(lossyTileIds, dtype=np.intp)
+
+
+def getSupersedingTileIds(mirrorIds):
+    '''id of the next tile with identical pixels for every tile, number of tiles if there is none'''
+    supersededBy = np.full(len(mirrorIds), len(mirrorIds), dtype=np.intp)
+    nextTileIds = {}
+    for tileId in range(len(mirrorIds) - 1, -1, -1):
+        pixelId = int(mirrorIds[tileId, 0])
+        supersededBy[tileId] = nextTileIds.get(pixelId, len(mirrorIds))
+        nextTileIds[pixelId] = tileId
+    return supersededBy
+
+
+def getTileMirrorIds(mirroredColorCodes):
+    '''numbers distinct pixel contents, returns (tiles, mirrors) ids of every mirror config of every tile'''
+    tileCount, mirrorCount, pixelCount = mirroredColorCodes.shape
+    if not tileCount:
+        return np.zeros((0, mirrorCount), dtype=np.intp)
+    _, mirrorIds = np.unique(mirroredColorCodes.reshape(-1, pixelCount), axis=0, return_inverse=True)
+    return mirrorIds.reshape(tileCount, mirrorCount)
+
+
+def applyDuplicateCandidates(tiles, candidates, threshold):
+    '''references every tile whose best candidate error is below threshold'''
+    optimizedTiles = tiles.copy()
+    duplicate = candidates['error'] < threshold
+    optimizedTiles.refId[duplicate] = candidates['refId'][duplicate]
+    optimizedTiles.xMirror[duplicate] = candidates['xMirror'][duplicate]
+    optimizedTiles.yMirror[duplicate] = candidates['yMirror'][duplicate]
+    return optimizedTiles
+
+
+def getMaxTilesThreshold(candidates, threshold, maxTiles):
+    '''smallest threshold of threshold + 3n that leaves at most maxTiles unique tiles, None if unreachable'''
+    requiredDuplicates = len(candidates['error']) - maxTiles
+    if requiredDuplicates <= 0:
+        return threshold
+    errors = np.sort(candidates['error'])
+    if not errors[requiredDuplicates - 1] < INFINITY:
+        return None
+    # errors below the threshold count as duplicate, so it must exceed the n-th smallest error
+    minThreshold = math.floor(errors[requiredDuplicates - 1]) + 1
+    return threshold + 3 * max(0, math.ceil((minThreshold - threshold) / 3))
+
+
+def getTileBlockErrors(tileIds, refIds, colorCodes, mirroredColorCodes, errorTable):
+    '''redmean errors of tileIds (all mirrors) against refIds, shape (tileIds, refIds, mirrors)
+
+    pixel errors are added up one pixel column at a time, in scanline order, so the
+    floating point result is exactly the one of a plain per-pixel loop'''
+    errorTable = errorTable.ravel()
+    mirroredCodes = mirroredColorCodes[tileIds, None, :, :] * np.int32(int(math.sqrt(len(errorTable))))
+    codes = colorCodes[None, refIds, None, :]
+    squareError = np.zeros((len(tileIds), len(refIds), len(MIRROR_CONFIGS)), dtype=np.float64)
+    pairIndex = np.empty(squareError.shape, dtype=np.int32)
+    for pixel in range(colorCodes.shape[1]):
+        np.add(mirroredCodes[..., pixel], codes[..., pixel], out=pairIndex)
+        squareError += errorTable.take(pairIndex)
+    return np.sqrt(squareError)
+
+
+def getTilePairErrors(tileIds, refIds, colorCodes, mirroredColorCodes, errorTable):
+    '''redmean errors of tileIds[i] (all mirrors) against refIds[i], shape (pairs, mirrors), summed like getTileBlockErrors'''
+    errorTable = errorTable.ravel()
+    mirroredCodes = mirroredColorCodes[tileIds] * np.int32(int(math.sqrt(len(errorTable))))
+    codes = colorCodes[refIds, None, :]
+    squareError = np.zeros((len(tileIds), len(MIRROR_CONFIGS)), dtype=np.float64)
+    pairIndex = np.empty(squareError.shape, dtype=np.int32)
+    for pixel in range(colorCodes.shape[1]):
+        np.add(mirroredCodes[..., pixel], codes[..., pixel], out=pairIndex)
+        squareError += errorTable.take(pairIndex)
+    return np.sqrt(squareError)
+
+
+def getTileColorCodes(tiles):
+    '''tile pixels as indices into sorted distinct colors, flat and for every mirror config'''
+    colors, codes = np.unique(tiles.pixel.ravel(), return_inverse=True)
+    codes = codes.reshape(tiles.pixel.shape).astype(np.int32)
+    mirroredCodes = np.stack([mirrorPixels(codes, xMirror, yMirror) for xMirror, yMirror in MIRROR_CONFIGS], axis=1)
+    return codes.reshape(len(tiles), -1), mirroredCodes.reshape(len(tiles), len(MIRROR_CONFIGS), -1)
+
+
+def getTileErrorTable(colors):
+    '''squared redmean error of every (input color, reference color) pair, as summed up by getTileBlockErrors'''
+    inColor = colors.astype(np.int32)[:, None]
+    refColor = colors.astype(np.int32)[None, :]
+    r = (inColor & 0x1f) - (refColor & 0x1f)
+    g = ((inColor & 0x3E0) >> 5) - ((refColor & 0x3E0) >> 5)
+    b = ((inColor & 0x7C00) >> 10) - ((refColor & 0x7C00) >> 10)
+    redMean = (inColor & 0x1f) + (refColor & 0x1f) // 2
+    return np.sqrt(((((512+redMean)*r*r) >> 8) + 4*g*g + (((767-redMean)*b*b) >> 8)).astype(np.float64))**2
+
+
+def mirrorPixels(pixels, xMirror, yMirror):
+    '''flips (tilesizey, tilesizex) pixel blocks horizontally and/or vertically'''
+    return pixels[..., ::-1 if yMirror else 1, ::-1 if xMirror else 1]
 
 
 def sortSNESColors(SNESCol1, SNESCol2):
@@ -947,13 +1468,7 @@ def sortSNESColors(SNESCol1, SNESCol2):
 
 
 def compareSNESColors(SNESCol1, SNESCol2):
-    color1 = ColObj(SNESCol1)
-    color2 = ColObj(SNESCol2)
-    redMean = (color1.r + color2.r) // 2
-    r = color1.r - color2.r
-    g = color1.g - color2.g
-    b = color1.b - color2.b
-    return math.sqrt((((512+redMean)*r*r) >> 8) + 4*g*g + (((767-redMean)*b*b) >> 8))
+    return snescolor.colorDistance(SNESCol1, SNESCol2)
 
 
 def compareSNESColor(col1, col2):
@@ -961,175 +1476,294 @@ def compareSNESColor(col1, col2):
 
 
 def parseSpriteTiles(image, options):
-    pos = getInitialSpritePosition(image, options)
-    tiles = []
-    while pos['y'] < image['resolutionY']:
-        pos['x'] = 0
-        while pos['x'] < image['resolutionX']:
-            if checkVlineFilled(image, pos, options):
-                tile = fetchTile(image, pos, options, len(tiles))
-                tiles.append({
-                    'id': len(tiles),
-                    'pixel': tile['pixel'],
-                    'palette': tile['palette'],
-                    'x': pos['x'],
-                    'y': pos['y'],
-                    'refId': None,
-                    'xMirror': False,
-                    'yMirror': False
-                })
-                pos['x'] += options.get('tilesizex')
-            else:
-                pos['x'] += 1
-        pos['y'] += options.get('tilesizey')
-    logging.info("parsed %s oam sprite tiles" % len(tiles))
-    return tiles
-
-
-def checkVlineFilled(image, pos, options):
-    for ypos in range(pos['y'], pos['y']+options.get('tilesizey')):
-        if isPixelOpaque(image['pixels'], ypos, pos['x'], options):
-            return True
-    return False
-
-
-def isPixelOpaque(pixels, yPos, xPos, options):
-    return getPixel(pixels, yPos, xPos, options) != options.get('transcol')
-
-
-def getPixel(pixels, yPos, xPos, options):
-    try:
-        return pixels[yPos][xPos]
-    except IndexError:
-        return options.get('transcol')
-
-
-def getInitialSpritePosition(image, options):
-    for scanline in range(len(image['pixels'])):
-        for pixel in range(len(image['pixels'][scanline])):
-            if isPixelOpaque(image['pixels'], scanline, pixel, options):
-                return {
-                    'y': scanline,
-                    'x': getInitialLeftmostPixelSprite(image, scanline, options)
-                }
-    return {  # no match found, be stupid and loop anyway
-        'y': 0,
-        'x': 0
-    }
-
-
-def getInitialLeftmostPixelSprite(image, top, options):
-    x = INFINITY
-    for scanline in range(top, top + options.get('tilesizey')):
-        for pixel in range(len(image['pixels'][scanline])):
-            if isPixelOpaque(image['pixels'], scanline, pixel, options):
-                x = min(x, pixel)
-    return x
+    '''oam sprite tiles, placed greedily left to right on tilesizey high bands starting at the first opaque scanline'''
+    tileSizeX = options.get('tilesizex')
+    tileSizeY = options.get('tilesizey')
+    opaque = image['pixels'] != options.get('transcol')
+    if options.get('spritesizes'):
+        objs = getPackedSpriteObjs(opaque, *SPRITE_SIZE_PAIRS[options.get('spritesizes')])
+        positions, objIds = getObjTilePositions(objs, tileSizeX)
+    else:
+        positions = getSpriteTilePositions(opaque, tileSizeX, tileSizeY)
+        objIds = None
+
+    pixels = getPixelArray(image, *getTileArea(image, options), options)
+    xPos = np.array([xPos for xPos, yPos in positions], dtype=np.intp).reshape(-1, 1, 1)
+    yPos = np.array([yPos for xPos, yPos in positions], dtype=np.intp).reshape(-1, 1, 1)
+    tilePixels = pixels[yPos + np.arange(tileSizeY).reshape(1, -1, 1), xPos + np.arange(tileSizeX).reshape(1, 1, -1)]
+    if options.get('spritesizes'):
+        logging.info("parsed %s oam sprites made of %s tiles" % (len(objs), len(positions)))
+    else:
+        logging.info("parsed %s oam sprite tiles" % len(positions))
+    return TileSet(tilePixels, xPos.ravel(), yPos.ravel(), objIds)
+
+
+def getSpriteTilePositions(opaque, tileSizeX, tileSizeY):
+    '''(x, y) of all sprite tiles covering the opaque mask. a tile is placed at the leftmost column of a band
+    that holds an opaque pixel, the next search starts right after that tile'''
+    height, width = opaque.shape
+    opaqueRows = np.flatnonzero(opaque.any(axis=1))
+    # no opaque pixel at all, scan from the top anyway
+    bandTops = np.arange(opaqueRows[0] if len(opaqueRows) else 0, height, tileSizeY)
+    # opaque pixels per column above each scanline, a band's column count is the difference of its bounds
+    columnCounts = np.zeros((height + 1, width), dtype=np.int32)
+    np.cumsum(opaque, axis=0, out=columnCounts[1:])
+    bandColumns = columnCounts[np.minimum(bandTops + tileSizeY, height)] - columnCounts[bandTops] > 0
+    # first filled column at or right of every column, width if there is none
+    columnIds = np.where(bandColumns, np.arange(width), width)
+    nextFilled = np.minimum.accumulate(columnIds[:, ::-1], axis=1)[:, ::-1]
+
+    positions = []
+    for yPos, bandNextFilled in zip(bandTops.tolist(), nextFilled.tolist()):
+        xPos = bandNextFilled[0] if width else width
+        while xPos < width:
+            positions.append((xPos, yPos))
+            xPos = bandNextFilled[xPos + tileSizeX] if xPos + tileSizeX < width else width
+    return positions
+
+
+def getPackedSpriteObjs(opaque, smallSize, largeSize):
+    '''(x, y, size) of as few small and large OBJs as possible covering the opaque mask.
+
+    rows are covered top down by bands of small or large OBJ height, whichever needs fewer OBJs
+    in total. within a large band every filled column starts either one large OBJ or a column of
+    small OBJs, one for every small OBJ high part of the band that holds opaque pixels. both
+    choices are solved exactly by dynamic programming, equal counts prefer small OBJs since
+    they use fewer tiles. the fixed tilesize scan is one of the covers considered, so packing
+    never needs more OBJs than it'''
+    height, width = opaque.shape
+    columnCounts = np.zeros((height + 1, width), dtype=np.int32)
+    np.cumsum(opaque, axis=0, out=columnCounts[1:])
+    filledRows = opaque.any(axis=1).tolist()
+
+    bands = {}
+    cost = [0] * (height + 1)
+    choice = [None] * (height + 1)
+    for yPos in range(height - 1, -1, -1):
+        if not filledRows[yPos]:
+            cost[yPos], choice[yPos] = cost[yPos + 1], None
+            continue
+        for size in (largeSize, smallSize):
+            bands[yPos, size] = getBandObjs(columnCounts, yPos, size, smallSize)
+            bandCost = len(bands[yPos, size]) + cost[min(yPos + size, height)]
+            if choice[yPos] is None or bandCost <= cost[yPos]:
+                cost[yPos], choice[yPos] = bandCost, size
+
+    objs = []
+    yPos = 0
+    while yPos < height:
+        if choice[yPos] is None:
+            yPos += 1
+            continue
+        objs.extend(bands[yPos, choice[yPos]])
+        yPos += choice[yPos]
+    return objs
+
+
+def getBandObjs(columnCounts, top, bandSize, smallSize):
+    '''fewest OBJs covering rows top..top+bandSize, large bandSize OBJs or columns of stacked small OBJs'''
+    height, width = columnCounts.shape[0] - 1, columnCounts.shape[1]
+    partTops = list(range(top, top + bandSize, smallSize))
+    # filled columns of every small OBJ high part of the band
+    partColumns = np.array([columnCounts[min(partTop + smallSize, height)] - columnCounts[min(partTop, height)] > 0
+                            for partTop in partTops])
+    bandColumns = partColumns.any(axis=0).tolist()
+    # filled columns before x per part, any filled column in a small OBJ wide window is a difference
+    partPrefix = np.zeros((len(partTops), width + smallSize), dtype=np.int32)
+    np.cumsum(partColumns, axis=1, out=partPrefix[:, 1:width + 1])
+    partPrefix[:, width + 1:] = partPrefix[:, width:width + 1]
+    smallCounts = (partPrefix[:, smallSize:smallSize + width] - partPrefix[:, :width] > 0).sum(axis=0).tolist()
+
+    cost = [0] * (width + bandSize + 1)
+    choice = [None] * (width + 1)
+    for xPos in range(width - 1, -1, -1):
+        if not bandColumns[xPos]:
+            cost[xPos] = cost[xPos + 1]
+            continue
+        cost[xPos], choice[xPos] = smallCounts[xPos] + cost[min(xPos + smallSize, width)], smallSize
+        if bandSize > smallSize and 1 + cost[min(xPos + bandSize, width)] < cost[xPos]:
+            cost[xPos], choice[xPos] = 1 + cost[min(xPos + bandSize, width)], bandSize
+
+    objs = []
+    xPos = 0
+    while xPos < width:
+        if choice[xPos] is None:
+            xPos += 1
+        elif choice[xPos] == smallSize:
+            objs.extend((xPos, partTop, smallSize) for partTop, filled in zip(partTops, partPrefix[:, xPos + smallSize] - partPrefix[:, xPos] > 0) if filled)
+            xPos += smallSize
+        else:
+            objs.append((xPos, top, bandSize))
+            xPos += bandSize
+    return objs
+
+
+def getObjTilePositions(objs, tileSize):
+    '''(x, y) of every tile of every OBJ, row by row, and the OBJ each tile belongs to'''
+    positions = []
+    objIds = []
+    for objId, (xPos, yPos, size) in enumerate(objs):
+        positions.extend((xPos + column, yPos + row) for row in range(0, size, tileSize) for column in range(0, size, tileSize))
+        objIds.extend([objId] * (size // tileSize) ** 2)
+    return positions, objIds
+
+
+def hasObjGroups(tiles):
+    return len(tiles) > 0 and int(tiles.objId.max()) + 1 < len(tiles)
+
+
+def getObjHeadTileIds(tiles):
+    '''first (upper left) tile of every OBJ'''
+    return np.unique(tiles.objId, return_index=True)[1]
+
+
+def getObjGridOutIds(tiles):
+    '''tile numbers on the OBJ name grid. OBJs of several tiles get a square block, the largest first, at the
+    first free spot in row order. the remaining unique tiles fill the free slots in between'''
+    tilesPerObj = np.bincount(tiles.objId)
+    heads = getObjHeadTileIds(tiles)
+    edges = np.sqrt(tilesPerObj).astype(int)
+    occupied = np.zeros((0, OBJ_NAME_GRID_WIDTH), dtype=bool)
+    outId = np.full(len(tiles), NO_REF, dtype=np.int32)
+    for objId in sorted(np.flatnonzero(tilesPerObj > 1).tolist(), key=lambda objId: -edges[objId]):
+        edge = edges[objId]
+        row, column = findFreeGridBlock(occupied, edge)
+        if row + edge > len(occupied):
+            occupied = np.vstack((occupied, np.zeros((row + edge - len(occupied), OBJ_NAME_GRID_WIDTH), dtype=bool)))
+        occupied[row:row + edge, column:column + edge] = True
+        blockIds = (row + np.arange(edge))[:, None] * OBJ_NAME_GRID_WIDTH + column + np.arange(edge)[None, :]
+        outId[heads[objId]:heads[objId] + edge * edge] = blockIds.ravel()
+    single = np.flatnonzero((tilesPerObj[tiles.objId] == 1) & (tiles.refId == NO_REF))
+    freeSlots = np.flatnonzero(~occupied.ravel())
+    extraSlots = np.arange(occupied.size, occupied.size + max(0, len(single) - len(freeSlots)))
+    outId[single] = np.concatenate((freeSlots, extraSlots))[:len(single)]
+    return outId
+
+
+def findFreeGridBlock(occupied, edge):
+    '''(row, column) of the first free edge x edge block, rows past the end count as free'''
+    for row in range(len(occupied) + 1):
+        for column in range(0, OBJ_NAME_GRID_WIDTH - edge + 1, edge):
+            if not occupied[row:row + edge, column:column + edge].any():
+                return row, column
+
+
+def getObjSizeStream(tiles, options):
+    '''OAM high table bits of every tilemap entry: 2 bits per OBJ, lowest bits first. bit 0 (x msb) stays clear,
+    bit 1 is set for large OBJs'''
+    largeTiles = (SPRITE_SIZE_PAIRS[options.get('spritesizes')][1] // options.get('tilesizex')) ** 2
+    large = np.bincount(tiles.objId)[tiles.objId[getObjHeadTileIds(tiles)]] == largeTiles
+    bits = np.zeros(-(-len(large) // 4) * 4, dtype=np.uint8)
+    bits[:len(large)] = large << 1
+    return (bits.reshape(-1, 4) << np.array([0, 2, 4, 6], dtype=np.uint8)).sum(axis=1).astype(np.uint8).tobytes()
+
+
+def checkSpriteSizes(options):
+    if not options.get('spritesizes'):
+        return
+    if options.get('spritesizes') not in SPRITE_SIZE_PAIRS:
+        logging.error('Error, invalid sprite sizes "%s", allowed are %s.' % (
+            options.get('spritesizes'), ', '.join(SPRITE_SIZE_PAIRS)))
+        sys.exit(1)
+    if options.get('tilesizex') != 8 or options.get('tilesizey') != 8:
+        logging.error('Error, -spritesizes builds OBJs from 8x8 tiles, tilesize must be 8.')
+        sys.exit(1)
 
 
 def parseBgTiles(image, options):
     '''normal bg tiles, parse whole image in tilesize-steps'''
-    pos = {
-        'x': 0,
-        'y': 0
-    }
-    tiles = []
-    while pos['y'] < image['resolutionY']:
-        pos['x'] = 0
-        while pos['x'] < image['resolutionX']:
-            tile = fetchTile(image, pos, options, len(tiles))
-            tiles.append({
-                'id': len(tiles),
-                'pixel': tile['pixel'],
-                'palette': tile['palette'],
-                'x': pos['x'],
-                'y': pos['y'],
-                'refId': None,
-                'xMirror': False,
-                'yMirror': False
-            })
-            pos['x'] += options.get('tilesizex')
-        pos['y'] += options.get('tilesizey')
-    return tiles
-
-
-def fetchTile(image, pos, options, tileId):
-    tile = []
-    palette = [options.get('transcol')]
-    # logging.debug('fetching tile %s' % tileId)
-    for yPos in range(pos['y'], pos['y']+options.get('tilesizey')):
-        tileLine = []
-        for xPos in range(pos['x'], pos['x']+options.get('tilesizex')):
-            pixel = getPixel(image['pixels'], yPos, xPos, options)
-            tileLine.append(pixel)
-            if pixel not in palette:
-                palette.append(pixel)
-        tile.append(tileLine)
-    return {
-        'pixel': tile,
-        'palette': {
-            'id': tileId,
-            'color': palette,
-            'refId': None
-        }
-    }
+    tileSizeX = options.get('tilesizex')
+    tileSizeY = options.get('tilesizey')
+    columns = int(math.ceil(image['resolutionX'] / float(tileSizeX)))
+    rows = int(math.ceil(image['resolutionY'] / float(tileSizeY)))
+    pixels = getPixelArray(image, *getTileArea(image, options), options)
+    tilePixels = pixels[:rows * tileSizeY, :columns * tileSizeX].reshape(
+        rows, tileSizeY, columns, tileSizeX).swapaxes(1, 2).reshape(-1, tileSizeY, tileSizeX)
+    yPos, xPos = np.mgrid[0:rows * tileSizeY:tileSizeY, 0:columns * tileSizeX:tileSizeX]
+    return TileSet(tilePixels, xPos.ravel(), yPos.ravel())
+
+
+def getTileArea(image, options):
+    '''width and height the pixel array tiles are cut from is padded to. sprite tiles reach up to one tile, or
+    the large OBJ size with -spritesizes, past the image edge'''
+    tileSizeX = options.get('tilesizex')
+    tileSizeY = options.get('tilesizey')
+    if options.get('mode') != 'sprite':
+        return (int(math.ceil(image['resolutionX'] / float(tileSizeX))) * tileSizeX,
+                int(math.ceil(image['resolutionY'] / float(tileSizeY))) * tileSizeY)
+    if options.get('spritesizes'):
+        reachX = reachY = SPRITE_SIZE_PAIRS[options.get('spritesizes')][1]
+    else:
+        reachX, reachY = tileSizeX, tileSizeY
+    return image['resolutionX'] + reachX, image['resolutionY'] + reachY
+
+
+def getPixelArray(image, width, height, options):
+    '''image pixels as uint16 array, padded with transparent color to at least width x height'''
+    pixels = np.full((max(height, image['resolutionY']), max(width, image['resolutionX'])),
+                     options.get('transcol'), dtype=np.uint16)
+    pixels[:image['resolutionY'], :image['resolutionX']] = image['pixels']
+    return pixels
 
 
 def getInputImage(options, filename):
     # logging.debug('parsing input image.')
     try:
         inputImage = Image.open(filename)
+        rgbPixels = np.asarray(inputImage.convert('RGB'))
     except IOError:
         logging.error('Unable to load input image "%s"' % filename)
         sys.exit(1)
 
-    paddedImage = padImageReduceColdepth(inputImage, options)
-    options.set('resolutionx', paddedImage.size[0])
-    options.set('resolutiony', paddedImage.size[1])
+    paddedPixels = padImage(rgbPixels, options)
+    pixels = getSnesPixels(reduceColdepth(paddedPixels, options))
+    options.set('resolutionx', pixels.shape[1])
+    options.set('resolutiony', pixels.shape[0])
 
     return {
-        'resolutionX': paddedImage.size[0],
-        'resolutionY': paddedImage.size[1],
-        'pixels': getSnesPixels(paddedImage)
+        'resolutionX': pixels.shape[1],
+        'resolutionY': pixels.shape[0],
+        'pixels': pixels,
+        # before color reduction, -verify measures the written files against it
+        'sourcePixels': getSnesPixels(paddedPixels)
     }
 
 
-def getSnesPixels(image):
-    '''extract color-converted pixels from image'''
-    rawPixels = list(image.getdata())
-    outputPixels = []
-    idx = 0
-    width, height = image.size
-    for y in range(height):
-        row = []
-        for x in range(width):
-            row.append(convertColorRGBToSnes(rawPixels[idx]))
-            idx += 1
-        outputPixels.append(row)
-    return outputPixels
-
-
-def padImageReduceColdepth(inputImage, options):
-    '''pad image to multiple of tilesize, fill blank areas with transparent color'''
-    paddedWidth = inputImage.size[0] if (inputImage.size[0] % options.get('tilesizex') == 0) else (
-        inputImage.size[0] - (inputImage.size[0] % options.get('tilesizex')) + options.get('tilesizex'))
-    paddedHeight = inputImage.size[1] if (inputImage.size[1] % options.get('tilesizey') == 0) else (
-        inputImage.size[1] - (inputImage.size[1] % options.get('tilesizey')) + options.get('tilesizey'))
-
-    paddedImage = Image.new('RGB', (paddedWidth, paddedHeight),
-                            convertColorSnesToRGB(options.get('transcol')))
-    paddedImage.paste(inputImage, (0, 0))
+def getSnesPixels(rgbPixels):
+    '''(height, width, 3) rgb array to (height, width) uint16 array of -bbbbbgg gggrrrrr colors'''
+    rgbPixels = rgbPixels.astype(np.uint16) & 0xf8
+    return (rgbPixels[..., 0] >> 3) | (rgbPixels[..., 1] << 2) | (rgbPixels[..., 2] << 7)
+
+
+def padImage(rgbPixels, options):
+    '''pad rgb array to multiple of tilesize, fill blank areas with transparent color'''
+    height, width = rgbPixels.shape[:2]
+    paddedWidth = -(-width // options.get('tilesizex')) * options.get('tilesizex')
+    paddedHeight = -(-height // options.get('tilesizey')) * options.get('tilesizey')
+
+    paddedPixels = np.empty((paddedHeight, paddedWidth, 3), dtype=np.uint8)
+    paddedPixels[...] = convertColorSnesToRGB(options.get('transcol'))
+    paddedPixels[:height, :width] = rgbPixels
+    return paddedPixels
+
+
+def reduceColdepth(paddedPixels, options):
+    '''reduces the image to the palette color count with PIL, only for nearestpair and -prereduce on'''
+    paddedHeight, paddedWidth = paddedPixels.shape[:2]
+    # mediancut and kmeans reduce the full BGR555 color set in parseGlobalPalettes
+    if options.get('quantizer') != 'nearestpair' or not options.get('prereduce'):
+        return paddedPixels
 
     colorCount = (((options.get('bpp') ** 2) - 1) * options.get('palettes'))
-    print(f"Reducing to {colorCount} colors. Image size: {paddedImage.size}")
+    print(f"Reducing to {colorCount} colors. Image size: {(paddedWidth, paddedHeight)}")
     sys.stdout.flush()
     # logging.info('Reducing to %s colors.' % colorCount)
-    reducedImage = paddedImage.convert(
+    reducedImage = Image.fromarray(paddedPixels, 'RGB').convert(
         'P', palette=Image.ADAPTIVE, colors=colorCount).convert('RGB')
     print("Done reducing colors.")
     sys.stdout.flush()
     # logging.debug('Done reducing colors.')
-    return reducedImage
+    return np.asarray(reducedImage)
 
 
 def convertColorSnesToRGB(inputColor):
@@ -1152,35 +1786,44 @@ def convertColorRGBToSnes(inputColor):
     #  options['infile']['value'] = args.pop()    #before-last argument should be input filename
 
 
-class BitStream():
-    def __init__(self):
-        self.bitPos = 7
-        self.byte = 0
-        self.bitStream = []
-
-    def writeBit(self, bit):
-        self.byte |= (bit & 1) << self.bitPos
-        self.bitPos -= 1
-        if self.bitPos < 0:
-            self.bitStream.append(self.byte)
-            self.byte = 0
-            self.bitPos = 7
-
-    def get(self):
-        return self.bitStream
-
-    def first(self):
-        return self.bitStream.pop(0)
-
-    def notEmpty(self):
-        return len(self.bitStream) > 0
+class TileSet():
+    '''all tiles of an image, stored as contiguous arrays indexed by tile id'''
+
+    def __init__(self, pixel, x, y, objId=None):
+        tileCount = len(pixel)
+        # (tiles, tilesizey, tilesizex) BGR555 colors, palettized colors once palettizeTiles ran
+        self.pixel = np.ascontiguousarray(pixel, dtype=np.uint16)
+        # palette indices, set by palettizeTiles
+        self.indexedPixel = np.zeros(self.pixel.shape, dtype=np.uint8)
+        self.x = np.asarray(x, dtype=np.int32).reshape(tileCount)
+        self.y = np.asarray(y, dtype=np.int32).reshape(tileCount)
+        self.paletteId = np.arange(tileCount, dtype=np.int32)
+        # id of tile that replaces this tile, NO_REF if tile is unique
+        self.refId = np.full(tileCount, NO_REF, dtype=np.int32)
+        self.xMirror = np.zeros(tileCount, dtype=bool)
+        self.yMirror = np.zeros(tileCount, dtype=bool)
+        self.outId = np.full(tileCount, NO_REF, dtype=np.int32)
+        # sprite OBJ a tile is part of, tiles of one OBJ are stored consecutively, upper left tile first
+        self.objId = np.arange(tileCount, dtype=np.int32) if objId is None else np.asarray(objId, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.pixel)
+
+    def copy(self):
+        tiles = TileSet.__new__(TileSet)
+        tiles.__dict__ = {name: value.copy() for name, value in self.__dict__.items()}
+        return tiles
+
+    def take(self, tileIds):
+        tiles = TileSet.__new__(TileSet)
+        tiles.__dict__ = {name: value[tileIds] for name, value in self.__dict__.items()}
+        return tiles
 
 
 class Statistics():
     def __init__(self, tiles, palettes, startTime):
         self.totalTiles = len(tiles)
-        self.actualTiles = len(
-            [tile for tile in tiles if tile['refId'] == None])
+        self.actualTiles = countUniqueTiles(tiles)
         self.actualPalettes = len(
             [pal for pal in palettes if pal['refId'] == None])
         self.timeWasted = time.perf_counter() - startTime
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+__author__ = "Matthias Nagler <matt@dforce.de>"
+__url__ = ("dforce3000", "dforce3000.de")
+__version__ = "0.1"
+
+"""
+Merge the json metrics gracon writes (-metrics, $GRACON_METRICS_DIR) into one build report.
+The report sums up stage timings, lists the slowest frames and folders and, given the report
+of an earlier build as -baseline, the frames that got slower since.
+"""
+
+import json
+import logging
+import os
+import sys
+
+from userOptions import Options
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+# a frame counts as regressed if it got slower by this factor and by at least the minimum
+REGRESSION_FACTOR = 1.2
+REGRESSION_MIN_SECONDS = 0.05
+
+
+def main():
+    options = Options(
+        sys.argv,
+        {
+            'indir': {'value': '', 'type': 'str'},
+            'outfile': {'value': '', 'type': 'str'},
+            'baseline': {'value': '', 'type': 'str'},
+            'top': {'value': 10, 'type': 'int', 'max': 0xffff, 'min': 1},
+        },
+    )
+
+    if not os.path.isdir(options.get('indir')):
+        logging.error('Metrics folder "%s" is nonexistant.' % options.get('indir'))
+        sys.exit(1)
+
+    runs = [readJson(os.path.join(options.get('indir'), name))
+            for name in sorted(os.listdir(options.get('indir'))) if name.endswith('.json')]
+    baseline = readJson(options.get('baseline')) if options.get('baseline') else None
+    report = getReport(runs, options.get('top'), baseline)
+
+    if options.get('outfile'):
+        try:
+            with open(options.get('outfile'), 'w') as outFile:
+                json.dump(report, outFile, indent=1)
+        except IOError:
+            logging.error('unable to access required output-file %s' % options.get('outfile'))
+            sys.exit(1)
+    logSummary(report)
+
+
+def getReport(runs, top, baseline=None):
+    '''build report of the frames of all runs, regressions against a baseline report if given'''
+    frames = [frame for run in runs for frame in run.get('frames', [])]
+    stages = {}
+    for frame in frames:
+        for stage, seconds in frame['stages'].items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+    # -jobs workers report their own peak with every frame
+    peakRss = [item['peakRssKb'] for item in runs + frames if item.get('peakRssKb') is not None]
+    paletteErrors = [frame['paletteError'] for frame in frames if frame.get('paletteError') is not None]
+
+    report = {
+        'runs': len(runs),
+        'frames': len(frames),
+        'cachedFrames': len([frame for frame in frames if frame['cached']]),
+        'seconds': sum(frame['seconds'] for frame in frames),
+        'wallSeconds': sum(run['seconds'] for run in runs),
+        'stages': stages,
+        'peakRssKb': max(peakRss) if peakRss else None,
+        'thresholdRetries': sum(frame['thresholdRetries'] for frame in frames),
+        'retriedFrames': [frame['infile'] for frame in frames if frame['thresholdRetries']],
+        'paletteError': {
+            'mean': sum(paletteErrors) / len(paletteErrors) if paletteErrors else 0.0,
+            'max': max(paletteErrors) if paletteErrors else 0.0
+        },
+        'slowestFrames': [getFrameSummary(frame) for frame in sorted(frames, key=lambda frame: -frame['seconds'])[:top]],
+        'folders': getFolders(frames)[:top],
+        'frameSeconds': {frame['infile']: frame['seconds'] for frame in frames}
+    }
+    if baseline:
+        report['regressions'] = getRegressions(report, baseline)
+    return report
+
+
+def getFrameSummary(frame):
+    return {name: frame[name] for name in ('infile', 'seconds', 'stages', 'actualTiles', 'tileThreshold', 'cached')}
+
+
+def getFolders(frames):
+    '''per input folder, e.g. a video chapter: frame count, seconds and slowest frame, slowest folder first'''
+    folders = {}
+    slowest = {}
+    for frame in frames:
+        name = os.path.dirname(frame['infile'])
+        folder = folders.setdefault(name, {'frames': 0, 'seconds': 0.0})
+        folder['frames'] += 1
+        folder['seconds'] += frame['seconds']
+        if name not in slowest or frame['seconds'] > slowest[name]['seconds']:
+            slowest[name] = frame
+    for name, folder in folders.items():
+        folder['slowest'] = slowest[name]['infile']
+    return [dict(folder=name, **folder) for name, folder in sorted(folders.items(), key=lambda item: -item[1]['seconds'])]
+
+
+def getRegressions(report, baseline):
+    '''stage and frame timings that grew against the baseline report'''
+    stages = {stage: {'seconds': seconds, 'baseline': baseline['stages'].get(stage, 0.0)}
+              for stage, seconds in report['stages'].items()}
+    frames = []
+    for infile, seconds in report['frameSeconds'].items():
+        before = baseline.get('frameSeconds', {}).get(infile)
+        if before is not None and seconds > before * REGRESSION_FACTOR and seconds - before >= REGRESSION_MIN_SECONDS:
+            frames.append({'infile': infile, 'seconds': seconds, 'baseline': before})
+    return {
+        'seconds': report['seconds'],
+        'baselineSeconds': baseline['seconds'],
+        'stages': stages,
+        'frames': sorted(frames, key=lambda frame: frame['baseline'] - frame['seconds'])
+    }
+
+
+def logSummary(report):
+    logging.info('%s frames in %s runs, %.2f seconds converting (%s cache hits), peak memory %s kB.' % (
+        report['frames'], report['runs'], report['seconds'], report['cachedFrames'], report['peakRssKb']))
+    for stage, seconds in sorted(report['stages'].items(), key=lambda item: -item[1]):
+        logging.info('  %-10s %8.2fs' % (stage, seconds))
+    if report['retriedFrames']:
+        logging.info('%s frames exceeded maxtiles, %s threshold retries in total.' % (
+            len(report['retriedFrames']), report['thresholdRetries']))
+    logging.info('slowest frames:')
+    for frame in report['slowestFrames']:
+        logging.info('  %8.2fs %s' % (frame['seconds'], frame['infile']))
+    logging.info('slowest folders:')
+    for folder in report['folders']:
+        logging.info('  %8.2fs %5s frames %s' % (folder['seconds'], folder['frames'], folder['folder']))
+    if 'regressions' in report:
+        regressions = report['regressions']
+        logging.info('%.2f seconds against %.2f of the baseline, %s frames got slower.' % (
+            regressions['seconds'], regressions['baselineSeconds'], len(regressions['frames'])))
+        for frame in regressions['frames']:
+            logging.info('  %8.2fs (was %.2fs) %s' % (frame['seconds'], frame['baseline'], frame['infile']))
+
+
+def readJson(filename):
+    try:
+        with open(filename, 'r') as inFile:
+            return json.load(inFile)
+    except (IOError, ValueError):
+        logging.error('unable to read metrics file %s' % filename)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Palette reduction for the 15-bit SNES color space.
+Every quantizer takes a list of distinct colors, their pixel counts and the
+number of colors to keep, and returns the reduced color list.
+
+nearestpair: repeatedly drops the later color of the closest pair (redmean),
+             the first color is never dropped. Colors are kept, not averaged.
+mediancut:   splits the pixel-weighted color box along its widest channel.
+kmeans:      refines the median cut palette with weighted k-means.
+"""
+
+import heapq
+
+import numpy as np
+
+import snescolor
+
+KMEANS_ITERATIONS = 8
+# approximate redmean channel weights (r, g, b), squared
+CHANNEL_WEIGHTS = np.array((528, 1024, 751)) / 256
+
+
+def reduceNearestPair(colors, weights, count):
+    """drops colors until count are left, identical to picking the first closest pair
+    (by position) every time and removing its later color. each color keeps its closest
+    later neighbour in a heap, entries are only refreshed when their neighbour is gone"""
+    colors = list(colors)
+    if len(colors) <= count:
+        return colors
+    values = np.array(colors, dtype=np.int32)
+    alive = np.ones(len(colors), dtype=bool)
+    heap = [entry for entry in (getNearestLater(values, alive, index) for index in range(1, len(colors))) if entry]
+    heapq.heapify(heap)
+    remaining = len(colors)
+    while remaining > count and heap:
+        distance, index, nearest = heapq.heappop(heap)
+        if not alive[index]:
+            continue
+        # entries whose neighbour was dropped meanwhile are only refreshed
+        if alive[nearest]:
+            alive[nearest] = False
+            remaining -= 1
+        entry = getNearestLater(values, alive, index)
+        if entry:
+            heapq.heappush(heap, entry)
+    return [color for color, isAlive in zip(colors, alive.tolist()) if isAlive]
+
+
+def getNearestLater(values, alive, index):
+    """(distance, index, nearest) of the closest alive color after index, first one on equal distance"""
+    later = np.flatnonzero(alive[index + 1:]) + index + 1
+    if not len(later):
+        return None
+    distances = snescolor.colorDistances(values[index], values[later])
+    nearest = int(np.argmin(distances))
+    return (float(distances[nearest]), index, int(later[nearest]))
+
+
+def reduceMedianCut(colors, weights, count):
+    """splits the box with the widest weighted channel range at its weighted median until count boxes exist"""
+    colors = list(colors)
+    if len(colors) <= count:
+        return colors
+    channels = getWeightedChannels(colors)
+    weights = np.asarray(weights, dtype=np.float64)
+    boxes = [np.arange(len(colors))]
+    while len(boxes) < count:
+        ranges = [np.ptp(channels[box], axis=0).max() if len(box) > 1 else -1 for box in boxes]
+        boxIndex = int(np.argmax(ranges))
+        if ranges[boxIndex] <= 0:
+            break
+        box = boxes.pop(boxIndex)
+        channel = int(np.argmax(np.ptp(channels[box], axis=0)))
+        box = box[np.argsort(channels[box, channel], kind='stable')]
+        cumulative = np.cumsum(weights[box])
+        split = min(max(int(np.searchsorted(cumulative, cumulative[-1] / 2)) + 1, 1), len(box) - 1)
+        boxes[boxIndex:boxIndex] = [box[:split], box[split:]]
+    return getUniqueColors([getMeanColor(colors, weights, box) for box in boxes])
+
+
+def reduceKMeans(colors, weights, count):
+    """weighted k-means on the redmean-weighted channels, seeded with the median cut palette"""
+    colors = list(colors)
+    if len(colors) <= count:
+        return colors
+    weights = np.asarray(weights, dtype=np.float64)
+    centers = reduceMedianCut(colors, weights, count)
+    for iteration in range(KMEANS_ITERATIONS):
+        cluster = np.argmin(snescolor.colorDistances(np.array(colors)[:, None], np.array(centers)[None, :]), axis=1)
+        refined = getUniqueColors([
+            getMeanColor(colors, weights, np.flatnonzero(cluster == center))
+            for center in range(len(centers)) if (cluster == center).any()])
+        if refined == centers:
+            break
+        centers = refined
+    return centers
+
+
+def getWeightedChannels(colors):
+    colors = np.array(colors, dtype=np.int32)
+    return np.stack((snescolor.RED[colors], snescolor.GREEN[colors], snescolor.BLUE[colors]), axis=1) * np.sqrt(CHANNEL_WEIGHTS)
+
+
+def getMeanColor(colors, weights, box):
+    """pixel-weighted average color of box, rounded to BGR555"""
+    values = np.array(colors, dtype=np.int32)[box]
+    boxWeights = weights[box] if weights[box].sum() > 0 else np.ones(len(box))
+    r, g, b = [int(round(np.average(channel[values], weights=boxWeights))) for channel in (snescolor.RED, snescolor.GREEN, snescolor.BLUE)]
+    return r | (g << 5) | (b << 10)
+
+
+def getUniqueColors(colors):
+    return list(dict.fromkeys(colors))
+
+
+QUANTIZERS = {
+    'nearestpair': reduceNearestPair,
+    'mediancut': reduceMedianCut,
+    'kmeans': reduceKMeans
+}
+
+
+__all__ = ["QUANTIZERS", "reduceNearestPair", "reduceMedianCut", "reduceKMeans"]
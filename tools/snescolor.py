@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Color math for the 15-bit SNES color space (-bbbbbgg gggrrrrr).
+Channel values of all 32768 colors are precomputed once, distances and
+nearest palette entries are computed for whole color arrays in one call.
+"""
+
+import math
+
+import numpy as np
+
+COLOR_COUNT = 0x8000
+
+RED = np.arange(COLOR_COUNT, dtype=np.int32) & 0x1f
+GREEN = (np.arange(COLOR_COUNT, dtype=np.int32) & 0x3e0) >> 5
+BLUE = (np.arange(COLOR_COUNT, dtype=np.int32) & 0x7c00) >> 10
+
+# same values as python tuples, for scalar lookups without numpy overhead
+CHANNELS = list(zip(RED.tolist(), GREEN.tolist(), BLUE.tolist()))
+
+
+def colorDistance(color1, color2):
+    """redmean distance of two colors"""
+    r1, g1, b1 = CHANNELS[color1 & 0x7fff]
+    r2, g2, b2 = CHANNELS[color2 & 0x7fff]
+    redMean = (r1 + r2) // 2
+    r = r1 - r2
+    g = g1 - g2
+    b = b1 - b2
+    return math.sqrt((((512+redMean)*r*r) >> 8) + 4*g*g + (((767-redMean)*b*b) >> 8))
+
+
+def colorDistances(colors, refColors):
+    """redmean distances of color arrays, broadcast against each other. same values as colorDistance"""
+    colors = np.asarray(colors, dtype=np.int32) & 0x7fff
+    refColors = np.asarray(refColors, dtype=np.int32) & 0x7fff
+    redMean = (RED[colors] + RED[refColors]) // 2
+    r = RED[colors] - RED[refColors]
+    g = GREEN[colors] - GREEN[refColors]
+    b = BLUE[colors] - BLUE[refColors]
+    return np.sqrt(((((512+redMean)*r*r) >> 8) + 4*g*g + (((767-redMean)*b*b) >> 8)).astype(np.float64))
+
+
+def nearestPaletteIndices(colors, palette):
+    """maps every color to its nearest palette entry, returns (indices, distances) shaped like colors.
+
+    on equal distance the later palette entry wins. if that color appears in the palette more
+    than once, the index of its first appearance is returned."""
+    colors = np.asarray(colors, dtype=np.int32)
+    palette = np.asarray(palette, dtype=np.int32)
+    distances = colorDistances(colors[..., None], palette)
+    nearest = len(palette) - 1 - np.argmin(distances[..., ::-1], axis=-1)
+    firstIndex = np.argmax(palette[:, None] == palette[None, :], axis=1)
+    return firstIndex[nearest], np.take_along_axis(distances, nearest[..., None], axis=-1)[..., 0]
+
+
+__all__ = ["colorDistance", "colorDistances", "nearestPaletteIndices"]
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Readers for the graphics files the converters write, decoded with numpy.
+Covers planar tiles (.tiles), BG tilemaps and sprite maps (.tilemap), OBJ size
+tables (.objsize), CGRAM palettes (.palette), animationWriter's .animation
+files and msu1blockwriter's .msu container. Files are memory mapped, frame
+parts are views into the mapping and only decoded on request, so large
+animations and MSU-1 data files can be scanned without reading them whole.
+
+Decoded pixels are 15 bit snes colors (-bbbbbgg gggrrrrr) in uint16 arrays of
+(height, width), toRGB turns them into 8 bit rgb arrays for PIL.
+"""
+
+import mmap
+import struct
+
+import numpy as np
+
+TILEMAP_SIZE = 32
+OBJ_NAME_GRID_WIDTH = 16
+EMPTY_COLOR = 0
+TRANSPARENT_COLOR = 0x7c1f
+
+ANIMATION_MAGIC = b'SP'
+ANIMATION_HEADER = struct.Struct('<2sHHHB')
+# bits 7 and 6 of the bpp byte, see animationWriter -tilepool and -delta
+ANIMATION_TILEPOOL_FLAG = 0x80
+ANIMATION_DELTA_FLAG = 0x40
+ANIMATION_BPP_MASK = 0x3f
+ANIMATION_FRAME_HEADER = struct.Struct('<HHH')
+
+MSU_MAGIC = b'S-MSU1'
+MSU_HEADER = struct.Struct('<6s21sBBB')
+MSU_HEADER_SIZE = 0x20
+MSU_CHAPTER_HEADER = struct.Struct('<B3s')
+MSU_FRAME_HEADER = struct.Struct('<HI')
+# .msu stores log2 of the tile size in bytes instead of the bit depth
+MSU_COLOR_DEPTHS = {4: 2, 5: 4, 6: 8}
+
+
+def mapFile(filename):
+    '''read only uint8 array of the whole file. empty files can not be mapped and come back as empty array'''
+    with open(filename, 'rb') as inFile:
+        try:
+            data = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return np.zeros(0, dtype=np.uint8)
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def getBytes(data):
+    '''uint8 array view of bytes, bytearrays, arrays or a filename'''
+    if isinstance(data, str):
+        return mapFile(data)
+    return np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data.view(np.uint8).ravel()
+
+
+def getWords(data):
+    '''little endian 16 bit words, a trailing odd byte is dropped'''
+    data = getBytes(data)
+    return data[:len(data) & ~1].view('<u2')
+
+
+def decodeTiles(data, bpp, tileSizeX=8, tileSizeY=8, directColor=False):
+    '''(tiles, tileSizeY, tileSizeX) pixel values of a planar tile stream, palette indices or, with directColor,
+    snes colors. bitplanes come in pairs interleaved byte by byte, a trailing partial tile is dropped'''
+    planeBytes = tileSizeX * tileSizeY // 8
+    data = getBytes(data)
+    data = data[:len(data) // (planeBytes * bpp) * planeBytes * bpp].reshape(-1, bpp // 2, planeBytes, 2)
+    bits = np.unpackbits(data, axis=2).reshape(len(data), bpp // 2, tileSizeY, tileSizeX, 2).astype(np.uint16)
+    values = np.zeros((len(data), tileSizeY, tileSizeX), dtype=np.uint16)
+    for plane in range(bpp):
+        values |= bits[:, plane // 2, :, :, plane % 2] << plane
+    if directColor:
+        # source: BBGGGRRR target: -bb---gg g--rrr--
+        values = ((values & 0xc0) << 7) | ((values & 0x38) << 4) | ((values & 0x7) << 2)
+    return values
+
+
+def decodePalettes(data, bpp):
+    '''(palettes, 2 ** bpp) colors of a palette stream, missing entries of the last palette are EMPTY_COLOR'''
+    colorsPerPalette = 2 ** bpp
+    colors = getWords(data)
+    palettes = np.full((-(-len(colors) // colorsPerPalette), colorsPerPalette), EMPTY_COLOR, dtype=np.uint16)
+    palettes.ravel()[:len(colors)] = colors
+    return palettes
+
+
+def decodeBgTilemap(data):
+    '''fields of every BG tilemap entry (vhopppcc cccccccc)'''
+    entries = getWords(data).astype(np.int32)
+    return {
+        'tileId': entries & 0x3ff,
+        'paletteId': (entries >> 10) & 0x7,
+        'priority': (entries >> 13) & 1 == 1,
+        'xMirror': (entries >> 14) & 1 == 1,
+        'yMirror': (entries >> 15) & 1 == 1
+    }
+
+
+def decodeSpriteMap(data, objSizeData=b''):
+    '''fields of every sprite map entry (x, y, cccccccc, vhoopppN). large tells which OBJs use the second
+    OBJ size, taken from the OAM high table layout of an .objsize stream'''
+    entries = getBytes(data)
+    entries = entries[:len(entries) & ~3].reshape(-1, 4).astype(np.int32)
+    large = np.zeros(len(entries), dtype=bool)
+    sizeBits = np.unpackbits(getBytes(objSizeData), bitorder='little')[1::2][:len(entries)] == 1
+    large[:len(sizeBits)] = sizeBits
+    return {
+        'x': entries[:, 0],
+        'y': entries[:, 1],
+        'tileId': entries[:, 2] | ((entries[:, 3] & 1) << 8),
+        'paletteId': (entries[:, 3] >> 1) & 0x7,
+        'priority': (entries[:, 3] >> 4) & 0x3,
+        'xMirror': (entries[:, 3] >> 6) & 1 == 1,
+        'yMirror': (entries[:, 3] >> 7) & 1 == 1,
+        'large': large
+    }
+
+
+def getTileColors(tilePixels, tileIds, paletteIds, xMirror, yMirror, palettes, directColor=False):
+    '''colors of the referenced tiles, mirrored and looked up in their palettes. unknown tiles stay index 0'''
+    tileSizeY, tileSizeX = tilePixels.shape[1:]
+    pixels = np.zeros((len(tileIds), tileSizeY, tileSizeX), dtype=np.uint16)
+    known = tileIds < len(tilePixels)
+    rows = np.where(yMirror[:, None], np.arange(tileSizeY)[::-1], np.arange(tileSizeY))
+    columns = np.where(xMirror[:, None], np.arange(tileSizeX)[::-1], np.arange(tileSizeX))
+    pixels[known] = tilePixels[tileIds[known, None, None], rows[known, :, None], columns[known, None, :]]
+    if directColor:
+        return pixels
+    colorsPerPalette = palettes.shape[1]
+    colors = np.full(max(len(palettes), 8) * colorsPerPalette + max(colorsPerPalette, 256), EMPTY_COLOR, dtype=np.uint16)
+    colors[:palettes.size] = palettes.ravel()
+    return colors[paletteIds[:, None, None] * colorsPerPalette + pixels]
+
+
+def getBgTilemapIndices(columns, rows):
+    '''(rows, columns) tilemap entry of every tile of an image. 32x32 tilemaps are stored row by row'''
+    yTile, xTile = np.mgrid[0:rows, 0:columns]
+    mapIds = (yTile // TILEMAP_SIZE) * -(-columns // TILEMAP_SIZE) + xTile // TILEMAP_SIZE
+    return mapIds * TILEMAP_SIZE * TILEMAP_SIZE + (yTile % TILEMAP_SIZE) * TILEMAP_SIZE + xTile % TILEMAP_SIZE
+
+
+def renderBg(tiles, tilemap, palettes, width, height, bpp, tileSizeX=8, tileSizeY=8, directColor=False,
+             transcol=TRANSPARENT_COLOR):
+    '''(height, width) image of a BG tilemap. tiles, tilemap and palettes are raw streams, entries missing from
+    a short tilemap and the area right of or below the last full tile are transcol'''
+    tilePixels = decodeTiles(tiles, bpp, tileSizeX, tileSizeY, directColor)
+    entries = getWords(tilemap)
+    columns, rows = width // tileSizeX, height // tileSizeY
+    indices = getBgTilemapIndices(columns, rows).ravel()
+    present = indices < len(entries)
+    fields = decodeBgTilemap(entries[indices[present]])
+    colors = np.full((len(indices), tileSizeY, tileSizeX), transcol, dtype=np.uint16)
+    colors[present] = getTileColors(tilePixels, fields['tileId'], fields['paletteId'], fields['xMirror'],
+                                    fields['yMirror'], decodePalettes(palettes, bpp), directColor)
+    pixels = colors.reshape(rows, columns, tileSizeY, tileSizeX).swapaxes(1, 2).reshape(rows * tileSizeY, columns * tileSizeX)
+    image = np.full((height, width), transcol, dtype=np.uint16)
+    image[:pixels.shape[0], :pixels.shape[1]] = pixels
+    return image
+
+
+def renderSprites(tiles, spriteMap, palettes, width, height, bpp, tileSizeX=8, tileSizeY=8, directColor=False,
+                  transcol=TRANSPARENT_COLOR, objSizes=None, objSizeData=b''):
+    '''(height, width) image of a sprite map, lower entries drawn on top like on the snes. objSizes is the
+    (small, large) OBJ edge length pair objSizeData selects from, every OBJ is a single tile without it.
+    tiles of larger OBJs are read from the 16 tile wide OBJ name grid, OBJs clip at the image border'''
+    tilePixels = decodeTiles(tiles, bpp, tileSizeX, tileSizeY, directColor)
+    fields = decodeSpriteMap(spriteMap, objSizeData)
+    edges = np.ones(len(fields['x']), dtype=np.int32)
+    if objSizes:
+        edges = np.where(fields['large'], objSizes[1], objSizes[0]) // tileSizeX
+    # one row per tile of every OBJ: OBJ, column and row inside the OBJ
+    tileCounts = edges * edges
+    objIds = np.repeat(np.arange(len(edges)), tileCounts)
+    tileIndex = np.arange(len(objIds)) - np.repeat(np.cumsum(tileCounts) - tileCounts, tileCounts)
+    column, row = tileIndex % edges[objIds], tileIndex // edges[objIds]
+    xMirror, yMirror = fields['xMirror'][objIds], fields['yMirror'][objIds]
+    # mirrored OBJs swap their tiles as well
+    tileColumn = np.where(xMirror, edges[objIds] - 1 - column, column)
+    tileRow = np.where(yMirror, edges[objIds] - 1 - row, row)
+    tileIds = fields['tileId'][objIds] + tileRow * OBJ_NAME_GRID_WIDTH + tileColumn
+    colors = getTileColors(tilePixels, tileIds, fields['paletteId'][objIds], xMirror, yMirror,
+                           decodePalettes(palettes, bpp), directColor)
+
+    reach = max(tileSizeX, tileSizeY) * (int(edges.max()) if len(edges) else 1)
+    image = np.full((height + reach, width + reach), transcol, dtype=np.uint16)
+    xPos = fields['x'][objIds] + column * tileSizeX
+    yPos = fields['y'][objIds] + row * tileSizeY
+    for tileId in range(len(objIds) - 1, -1, -1):
+        image[yPos[tileId]:yPos[tileId] + tileSizeY, xPos[tileId]:xPos[tileId] + tileSizeX] = colors[tileId]
+    return image[:height, :width]
+
+
+def toRGB(colors):
+    '''(..., 3) uint8 rgb array of snes colors, low bits filled up from the high ones like gracon's samples'''
+    colors = np.asarray(colors, dtype=np.uint16)
+    rgb = np.stack(((colors & 0x1f) << 3, (colors & 0x3e0) >> 2, (colors & 0x7c00) >> 7), axis=-1)
+    return (rgb | (rgb >> 5)).astype(np.uint8)
+
+
+class Frame():
+    '''tiles, tilemap and palette stream of one animation or msu frame, views into the mapped file'''
+
+    def __init__(self, tiles, tilemap, palette, bpp):
+        self.tiles = tiles
+        self.tilemap = tilemap
+        self.palette = palette
+        self.bpp = bpp
+
+    def render(self, width, height, mode='bg', palette=None, **kwargs):
+        '''decoded image, palette overrides the frame's own palette stream, e.g. one shared by all frames'''
+        renderer = renderSprites if mode == 'sprite' else renderBg
+        return renderer(self.tiles, self.tilemap, self.palette if palette is None else palette, width, height,
+                        self.bpp, **kwargs)
+
+
+class AnimationFile():
+    '''.animation file of animationWriter: header, 16 bit frame pointers, frames of tiles, tilemap and palette.
+    the first frame carries a palette, later frames only if they swap it, render uses the last one. in a tile pool animation every frame
+    only carries the tiles earlier frames did not have, render puts together the pool up to the frame. delta frames
+    only carry the tilemap runs that changed, render applies the runs of all frames up to the frame'''
+
+    def __init__(self, filename):
+        self.data = mapFile(filename)
+        if len(self.data) < ANIMATION_HEADER.size:
+            raise ValueError('%s is too short for an animation header.' % filename)
+        magic, self.maxTileLength, self.maxPaletteLength, frameCount, halfBpp = ANIMATION_HEADER.unpack_from(self.data)
+        if magic != ANIMATION_MAGIC:
+            raise ValueError('%s is no animation file, magic is %r.' % (filename, magic))
+        self.tilePool = bool(halfBpp & ANIMATION_TILEPOOL_FLAG)
+        self.delta = bool(halfBpp & ANIMATION_DELTA_FLAG)
+        self.bpp = (halfBpp & ANIMATION_BPP_MASK) * 2
+        self.framePointers = getWords(self.data[ANIMATION_HEADER.size:ANIMATION_HEADER.size + frameCount * 2]).tolist()
+        if len(self.framePointers) != frameCount:
+            raise ValueError('%s is truncated, frame pointer list is incomplete.' % filename)
+
+    def __len__(self):
+        return len(self.framePointers)
+
+    def __getitem__(self, frameId):
+        pointer = self.framePointers[frameId]
+        lengths = ANIMATION_FRAME_HEADER.unpack_from(self.data, pointer)
+        offsets = np.cumsum((pointer + ANIMATION_FRAME_HEADER.size,) + lengths).tolist()
+        return Frame(*[self.data[start:end] for start, end in zip(offsets, offsets[1:])], bpp=self.bpp)
+
+    def __iter__(self):
+        return (self[frameId] for frameId in range(len(self)))
+
+    def render(self, frameId, width=256, height=224, mode='bg', **kwargs):
+        frame = self[frameId]
+        if self.tilePool:
+            tiles = np.concatenate([self[poolFrameId].tiles for poolFrameId in range(frameId + 1)])
+            frame = Frame(tiles, frame.tilemap, frame.palette, self.bpp)
+        if self.delta:
+            tilemap = np.zeros(TILEMAP_SIZE * TILEMAP_SIZE * 2, dtype=np.uint8)
+            for deltaFrameId in range(frameId + 1):
+                applyTilemapRuns(tilemap, self[deltaFrameId].tilemap)
+            frame = Frame(frame.tiles, tilemap, frame.palette, self.bpp)
+        return frame.render(width, height, mode, palette=self.getPalette(frameId), **kwargs)
+
+    def getPalette(self, frameId):
+        '''palette stream in place at a frame, the one of the frame itself or the closest earlier frame'''
+        for paletteFrameId in range(frameId, 0, -1):
+            if len(self[paletteFrameId].palette):
+                return self[paletteFrameId].palette
+        return self[0].palette
+
+
+def applyTilemapRuns(tilemap, runs):
+    '''writes delta runs of 16 bit tilemap offset, 16 bit length and entries into the tilemap byte array'''
+    position = 0
+    while position < len(runs):
+        offset, length = getWords(runs[position:position + 4]).tolist()
+        tilemap[offset:offset + length] = runs[position + 4:position + 4 + length]
+        position += 4 + length
+    return tilemap
+
+
+class MsuFile():
+    '''msu1blockwriter data file: header, 32 bit chapter pointers, chapters holding their id and 32 bit frame
+    pointers, frames of tilemap, tiles and palette. the palette length is stored in 8 bits, a full 256 color
+    palette reads as empty'''
+
+    def __init__(self, filename):
+        self.data = mapFile(filename)
+        if len(self.data) < MSU_HEADER_SIZE:
+            raise ValueError('%s is too short for an msu1 header.' % filename)
+        magic, title, colorDepth, self.fps, chapterCount = MSU_HEADER.unpack_from(self.data)
+        if magic != MSU_MAGIC or colorDepth not in MSU_COLOR_DEPTHS:
+            raise ValueError('%s is no msu1 data file.' % filename)
+        self.title = title.decode('ascii', 'replace').rstrip()
+        self.colorDepth = colorDepth
+        self.bpp = MSU_COLOR_DEPTHS[colorDepth]
+        self.chapters = {}
+        chapterPointers = self.data[MSU_HEADER_SIZE:MSU_HEADER_SIZE + chapterCount * 4].view('<u4').tolist()
+        for pointer in chapterPointers:
+            chapterId, frameCount = MSU_CHAPTER_HEADER.unpack_from(self.data, pointer)
+            frameCount = int.from_bytes(frameCount, 'little')
+            start = pointer + MSU_CHAPTER_HEADER.size
+            self.chapters[chapterId] = self.data[start:start + frameCount * 4].view('<u4').tolist()
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def getFrame(self, chapterId, frameId):
+        pointer = self.chapters[chapterId][frameId]
+        frameNumber, lengths = MSU_FRAME_HEADER.unpack_from(self.data, pointer)
+        tilemapLength = (lengths & 0x7ff) * 2
+        tilesLength = ((lengths >> 11) & 0x7ff) << self.colorDepth
+        paletteLength = ((lengths >> 22) & 0xff) * 2
+        offsets = np.cumsum((pointer + MSU_FRAME_HEADER.size, tilemapLength, tilesLength, paletteLength)).tolist()
+        tilemap, tiles, palette = [self.data[start:end] for start, end in zip(offsets, offsets[1:])]
+        return Frame(tiles, tilemap, palette, self.bpp)
+
+    def getFrames(self, chapterId):
+        return (self.getFrame(chapterId, frameId) for frameId in range(len(self.chapters[chapterId])))
+
+    def render(self, chapterId, frameId, width=256, height=224, **kwargs):
+        return self.getFrame(chapterId, frameId).render(width, height, **kwargs)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Vantage point tree for nearest neighbour lookups in euclidean feature space.
+Used by gracon.py to find candidate reference tiles without scanning all
+earlier tiles.
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+LEAF_SIZE = 16
+
+
+class VPTree:
+    def __init__(self, points, leafSize=LEAF_SIZE):
+        self.points = np.asarray(points, dtype=np.float64)
+        # plain tuples, math.dist on these is much faster than numpy for single points
+        self.pointTuples = [tuple(point) for point in self.points.tolist()]
+        self.leafSize = leafSize
+        self.root = self.__build(np.arange(len(self.points)))
+
+    def nearest(self, query, count=1, below=None):
+        """returns up to count (distance, id) pairs closest to query, nearest first.
+        if below is given, only points with a smaller id are considered."""
+        query = tuple(np.asarray(query, dtype=np.float64).tolist())
+        below = len(self.points) if below is None else below
+        found = []
+        if self.root is not None:
+            self.__search(self.root, query, count, below, found)
+        return sorted((-negDistance, pointId) for negDistance, pointId in found)
+
+    def __build(self, ids):
+        if not len(ids):
+            return None
+        if len(ids) <= self.leafSize:
+            return {'ids': ids.tolist()}
+
+        # vantage point: point farthest from the centroid, deterministic and spread out
+        points = self.points[ids]
+        vantage = int(np.argmax(np.sum((points - points.mean(axis=0)) ** 2, axis=1)))
+        vantageId = int(ids[vantage])
+        distances = self.__distances(ids, self.points[vantageId])
+        ids = np.delete(ids, vantage)
+        distances = np.delete(distances, vantage)
+        radius = float(np.median(distances))
+        inside = distances <= radius
+        return {
+            'vantage': vantageId,
+            'radius': radius,
+            'inside': self.__build(ids[inside]),
+            'outside': self.__build(ids[~inside])
+        }
+
+    def __search(self, node, query, count, below, found):
+        if 'ids' in node:
+            for pointId in node['ids']:
+                if pointId < below:
+                    self.__offer(found, count, math.dist(self.pointTuples[pointId], query), pointId)
+            return
+
+        distance = math.dist(self.pointTuples[node['vantage']], query)
+        if node['vantage'] < below:
+            self.__offer(found, count, distance, node['vantage'])
+
+        first, second = ('inside', 'outside') if distance <= node['radius'] else ('outside', 'inside')
+        if node[first] is not None:
+            self.__search(node[first], query, count, below, found)
+        # other side can only hold closer points if the search sphere crosses the partition boundary
+        if node[second] is not None and abs(distance - node['radius']) <= self.__worst(found, count):
+            self.__search(node[second], query, count, below, found)
+
+    def __offer(self, found, count, distance, pointId):
+        # max-heap on distance, on equal distance the later point is kept
+        entry = (-distance, pointId)
+        if len(found) < count:
+            heapq.heappush(found, entry)
+        elif entry > found[0]:
+            heapq.heapreplace(found, entry)
+
+    def __worst(self, found, count):
+        return -found[0][0] if len(found) == count else float('inf')
+
+    def __distances(self, ids, query):
+        return np.sqrt(np.sum((self.points[ids] - query) ** 2, axis=1))
+
+
+__all__ = ["VPTree"]